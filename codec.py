@@ -0,0 +1,345 @@
+"""
+Module with the codecs used to turn protocol messages into bytes and back. JSON is the default and
+is always available; the compact binary codec packs every value behind a one-byte type tag and sends
+the field names and values that appear in almost every message (e.g. 'identifier', 'status',
+'active') as a one-byte index into a shared key table, which makes messages smaller and quicker to
+encode than JSON
+
+The codec of a connection is negotiated in the 'connect' exchange: the device lists the codecs it
+supports in the 'codecs' field of its connection message (most preferred first) and the HUB answers
+with the one it picked in the 'codec' field of its response. Devices that don't list any codecs (and
+HUBs that don't answer with one) keep using JSON
+"""
+
+import json
+import struct
+
+# Value type tags of the binary codec
+NONE = 0
+TRUE = 1
+FALSE = 2
+INT8 = 3
+INT32 = 4
+INT64 = 5
+FLOAT = 6
+STR = 7
+KEY = 8
+LIST = 9
+DICT = 10
+
+INT8_STRUCT = struct.Struct("!b")
+INT32_STRUCT = struct.Struct("!i")
+INT64_STRUCT = struct.Struct("!q")
+FLOAT_STRUCT = struct.Struct("!d")
+LENGTH_STRUCT = struct.Struct("!H")
+
+# Longest string (in bytes), list or dict the binary codec can encode
+MAX_LENGTH = 2**16 - 1
+
+# Strings sent as a one-byte index by the binary codec. Both ends must have the same table, so it
+# can't be changed once in use; a different table needs a codec with a new name
+KEY_TABLE = (
+    "id",
+    "action",
+    "result",
+    "success",
+    "failure",
+    "event",
+    "readings",
+    "identifier",
+    "status",
+    "threshold",
+    "switch",
+    "brightness",
+    "motion",
+    "temp",
+    "active",
+    "inactive",
+    "on",
+    "off",
+    "value",
+    "get_readings",
+    "set_thres",
+    "set_activate",
+    "set_deactivate",
+    "set_on",
+    "set_off",
+    "set_disconnect",
+    "batch",
+    "actions",
+    "subscribe",
+    "unsubscribe",
+    "interval",
+    "change",
+    "encoding",
+    "delta",
+    "seq",
+    "base",
+    "fields",
+    "full",
+    "ack",
+    "resync",
+)
+KEY_INDEX = {key: index for index, key in enumerate(KEY_TABLE)}
+
+
+class JsonCodec:
+    """
+    The JsonCodec class encodes messages as UTF-8 JSON.
+
+    Attributes:
+        name (str): The name of the codec used in the 'connect' exchange.
+    """
+
+    name = "json"
+
+    def encode(self, msg):
+        """
+        Encode a message.
+
+        Args:
+            msg (dict): The message to encode.
+
+        Returns:
+            bytes: The encoded message.
+        """
+        return json.dumps(msg).encode("utf-8")
+
+    def decode(self, data):
+        """
+        Decode a message.
+
+        Args:
+            data (bytes): The encoded message.
+
+        Returns:
+            dict: The decoded message.
+        """
+        return json.loads(data.decode("utf-8"))
+
+
+class BinaryCodec:
+    """
+    The BinaryCodec class encodes messages in a compact tagged binary format. Every value is a
+    one-byte type tag followed by its big-endian payload; strings found in the key table are sent
+    as their one-byte index instead. It handles the same values as JSON (dicts with string keys,
+    lists, strings, numbers, booleans and None).
+
+    Attributes:
+        name (str): The name of the codec used in the 'connect' exchange.
+    """
+
+    name = "bin1"
+
+    def encode(self, msg):
+        """
+        Encode a message.
+
+        Args:
+            msg (dict): The message to encode.
+
+        Returns:
+            bytes: The encoded message.
+
+        Raises:
+            ValueError: If the message contains a value that can't be encoded (including strings,
+            lists and dicts longer than MAX_LENGTH).
+        """
+        out = bytearray()
+        self._encode_value(msg, out)
+        return bytes(out)
+
+    def _encode_value(self, value, out):
+        """
+        Append the encoding of a single value.
+
+        Args:
+            value: The value to encode. out (bytearray): The buffer to append to.
+        """
+        # bool must be checked before int, as bool is a subclass of int
+        if value is None:
+            out.append(NONE)
+        elif value is True:
+            out.append(TRUE)
+        elif value is False:
+            out.append(FALSE)
+        elif isinstance(value, int):
+            if -128 <= value <= 127:
+                out.append(INT8)
+                out += INT8_STRUCT.pack(value)
+            elif -(2**31) <= value < 2**31:
+                out.append(INT32)
+                out += INT32_STRUCT.pack(value)
+            elif -(2**63) <= value < 2**63:
+                out.append(INT64)
+                out += INT64_STRUCT.pack(value)
+            else:
+                raise ValueError(f"Integer {value} is too large to encode")
+        elif isinstance(value, float):
+            out.append(FLOAT)
+            out += FLOAT_STRUCT.pack(value)
+        elif isinstance(value, str):
+            index = KEY_INDEX.get(value)
+            if index is not None:
+                out.append(KEY)
+                out.append(index)
+            else:
+                data = value.encode("utf-8")
+                out.append(STR)
+                self._encode_length(data, out)
+                out += data
+        elif isinstance(value, (list, tuple)):
+            out.append(LIST)
+            self._encode_length(value, out)
+            for item in value:
+                self._encode_value(item, out)
+        elif isinstance(value, dict):
+            out.append(DICT)
+            self._encode_length(value, out)
+            for key, item in value.items():
+                if not isinstance(key, str):
+                    raise ValueError(f"Dict key {key!r} is not a string")
+                self._encode_value(key, out)
+                self._encode_value(item, out)
+        else:
+            raise ValueError(f"Can't encode value of type {type(value).__name__}")
+
+    @staticmethod
+    def _encode_length(value, out):
+        """
+        Append the length of a string, list or dict.
+
+        Args:
+            value: The (encoded) string, list or dict. out (bytearray): The buffer to append to.
+
+        Raises:
+            ValueError: If the length doesn't fit in the length field.
+        """
+        if len(value) > MAX_LENGTH:
+            raise ValueError(
+                f"{type(value).__name__} of length {len(value)} is too long to encode"
+                f" (at most {MAX_LENGTH})"
+            )
+        out += LENGTH_STRUCT.pack(len(value))
+
+    def decode(self, data):
+        """
+        Decode a message.
+
+        Args:
+            data (bytes): The encoded message.
+
+        Returns:
+            dict: The decoded message.
+
+        Raises:
+            ValueError: If the data is not a valid encoding.
+        """
+        try:
+            value, offset = self._decode_value(data, 0)
+        except (IndexError, struct.error) as e:
+            raise ValueError(f"Truncated message: {e}") from e
+
+        if offset != len(data):
+            raise ValueError(f"{len(data) - offset} bytes left over after the message")
+        return value
+
+    def _decode_value(self, data, offset):
+        """
+        Decode the value starting at an offset.
+
+        Args:
+            data (bytes): The encoded message. offset (int): Where the value starts.
+
+        Returns:
+            tuple: The value and the offset just past it.
+        """
+        tag = data[offset]
+        offset += 1
+
+        if tag == NONE:
+            return None, offset
+        if tag == TRUE:
+            return True, offset
+        if tag == FALSE:
+            return False, offset
+        if tag == INT8:
+            return INT8_STRUCT.unpack_from(data, offset)[0], offset + INT8_STRUCT.size
+        if tag == INT32:
+            return INT32_STRUCT.unpack_from(data, offset)[0], offset + INT32_STRUCT.size
+        if tag == INT64:
+            return INT64_STRUCT.unpack_from(data, offset)[0], offset + INT64_STRUCT.size
+        if tag == FLOAT:
+            return FLOAT_STRUCT.unpack_from(data, offset)[0], offset + FLOAT_STRUCT.size
+        if tag == KEY:
+            return KEY_TABLE[data[offset]], offset + 1
+
+        (length,) = LENGTH_STRUCT.unpack_from(data, offset)
+        offset += LENGTH_STRUCT.size
+
+        if tag == STR:
+            end = offset + length
+            if end > len(data):
+                raise ValueError("Truncated string")
+            return data[offset:end].decode("utf-8"), end
+        if tag == LIST:
+            items = []
+            for _ in range(length):
+                item, offset = self._decode_value(data, offset)
+                items.append(item)
+            return items, offset
+        if tag == DICT:
+            items = {}
+            for _ in range(length):
+                key, offset = self._decode_value(data, offset)
+                if not isinstance(key, str):
+                    raise ValueError(f"Dict key {key!r} is not a string")
+                items[key], offset = self._decode_value(data, offset)
+            return items, offset
+
+        raise ValueError(f"Unknown type tag {tag}")
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+
+# The codecs known to this side, keyed by name
+CODECS = {JSON.name: JSON, BINARY.name: BINARY}
+
+# The codecs a device offers in its connection message, most preferred first
+PREFERRED = [BINARY.name, JSON.name]
+
+
+def get_codec(name):
+    """
+    Get a codec by name.
+
+    Args:
+        name (str): The codec name, or None for the default (JSON).
+
+    Returns:
+        The codec, or None if the name is unknown.
+    """
+    if name is None:
+        return JSON
+    return CODECS.get(name)
+
+
+def negotiate(offered):
+    """
+    Pick the codec to use from the codecs offered in a connection message.
+
+    Args:
+        offered (list): The names of the codecs the device supports, most preferred first, or None
+        if it didn't offer any.
+
+    Returns:
+        The first offered codec known to this side, or JSON if there is none.
+    """
+    if not isinstance(offered, list):
+        return JSON
+
+    for name in offered:
+        if isinstance(name, str) and name in CODECS:
+            return CODECS[name]
+    return JSON
@@ -0,0 +1,171 @@
+"""
+Module with the classes used to send device readings as deltas. Instead of the full readings dict,
+the device sends only the fields that changed since the last snapshot the HUB acknowledged, tagged
+with a sequence number; the HUB merges each delta onto the snapshot it was based on to rebuild the
+full readings. Most readings change by one field per update, so this cuts down the bytes to encrypt
+and send
+
+A delta message looks like: {"seq": 7, "base": 5, "fields": {"brightness": 61}} where base is the
+sequence number of the snapshot the fields apply to, or None for a full snapshot
+"""
+
+# The device falls back to a full snapshot if this many snapshots are waiting to be acknowledged
+MAX_UNACKED = 64
+
+# The HUB acknowledges after merging this many snapshots (requests to the device also carry the
+# acknowledgement, so this is only needed for a device pushing readings)
+ACK_EVERY = 8
+
+
+class DeltaEncoder:
+    """
+    The DeltaEncoder class is used by the device to turn readings into delta messages. It keeps the
+    snapshots it sent until the HUB acknowledges them; deltas are always taken against the latest
+    acknowledged snapshot, so a delta never depends on a message the HUB may not have merged.
+
+    Example usage:
+        encoder = DeltaEncoder() msg = encoder.encode(device.get_readings()) encoder.ack(msg["seq"])
+    """
+
+    def __init__(self):
+        """Initialize a new DeltaEncoder instance."""
+        self.seq = 0
+        self._base_seq = None
+        self._base = None
+        self._sent = {}
+
+    def encode(self, readings, full=False):
+        """
+        Build the delta message of the readings.
+
+        Args:
+            readings (dict): The current readings. full (bool): Whether to send a full snapshot
+            regardless of the acknowledged snapshot.
+
+        Returns:
+            dict: The delta message.
+        """
+        self.seq += 1
+        readings = dict(readings)
+        self._sent[self.seq] = readings
+
+        # A full snapshot is sent when asked for, when nothing has been acknowledged yet, when the
+        # fields themselves changed, or when the HUB has fallen too far behind with acknowledgements
+        if (
+            full
+            or self._base is None
+            or readings.keys() != self._base.keys()
+            or len(self._sent) > MAX_UNACKED
+        ):
+            if len(self._sent) > MAX_UNACKED:
+                self._sent = {self.seq: readings}
+
+            # The HUB drops its older snapshots when it merges a full one, so deltas can only
+            # resume once this snapshot (or a later one) is acknowledged
+            self._base_seq = None
+            self._base = None
+            return {"seq": self.seq, "base": None, "fields": readings}
+
+        fields = {k: v for k, v in readings.items() if self._base[k] != v}
+        return {"seq": self.seq, "base": self._base_seq, "fields": fields}
+
+    def ack(self, seq):
+        """
+        Record that the HUB has merged the snapshot with the given sequence number.
+
+        Args:
+            seq (int): The acknowledged sequence number.
+        """
+        if seq not in self._sent:
+            return
+
+        self._base_seq = seq
+        self._base = self._sent[seq]
+        self._sent = {k: v for k, v in self._sent.items() if k > seq}
+
+    def reset(self):
+        """Forget the acknowledged snapshot, so that the next message is a full snapshot."""
+        self._base_seq = None
+        self._base = None
+
+
+class DeltaMerger:
+    """
+    The DeltaMerger class is used by the HUB to rebuild the full readings of a device from its
+    delta messages.
+
+    Attributes:
+        readings (dict): The latest merged readings (None until the first snapshot). seq (int): The
+        sequence number of the latest merged readings. unacked (int): Number of snapshots merged
+        since the last acknowledgement.
+
+    Example usage:
+        merger = DeltaMerger() readings = merger.apply(msg) if merger.ack_due(): send {"action":
+        "ack", "seq": merger.take_ack()}
+    """
+
+    def __init__(self):
+        """Initialize a new DeltaMerger instance."""
+        self.readings = None
+        self.seq = None
+        self.unacked = 0
+        self._snapshots = {}
+        self._min_base = 0
+        self._full_unacked = False
+
+    def apply(self, msg):
+        """
+        Merge a delta message.
+
+        Args:
+            msg (dict): The delta message.
+
+        Returns:
+            dict: The full readings, or None if the message is based on a snapshot that is unknown
+            (in which case a full snapshot must be requested).
+        """
+        base = msg.get("base")
+        if base is None:
+            readings = dict(msg["fields"])
+            self._full_unacked = True
+        else:
+            if base not in self._snapshots:
+                return None
+            readings = dict(self._snapshots[base])
+            readings.update(msg["fields"])
+            self._min_base = max(self._min_base, base)
+
+        self.seq = msg["seq"]
+        self.readings = readings
+        self._snapshots[self.seq] = readings
+        self.unacked += 1
+
+        # The device only moves its base forward (to snapshots acknowledged later), so snapshots
+        # older than the newest base seen aren't needed anymore
+        self._snapshots = {
+            k: v for k, v in self._snapshots.items() if k >= self._min_base
+        }
+        return readings
+
+    def ack_due(self):
+        """
+        Check whether an acknowledgement should be sent now. A full snapshot is acknowledged right
+        away (the device sends full snapshots until it is), anything else every ACK_EVERY snapshots.
+
+        Returns:
+            bool: True if take_ack() should be called and its result sent to the device.
+        """
+        return self._full_unacked or self.unacked >= ACK_EVERY
+
+    def take_ack(self):
+        """
+        Get the sequence number to acknowledge, if there is anything to acknowledge.
+
+        Returns:
+            int: The sequence number of the latest merged readings, or None.
+        """
+        if not self.unacked:
+            return None
+        self.unacked = 0
+        self._full_unacked = False
+        return self.seq
@@ -0,0 +1,350 @@
+"""
+Module with the registry of the devices known to the HUB. The registry is changed by the HUB server
+(as devices connect and disconnect) while the menu reads it from another thread, so every change is
+made under a lock and readers never see a half-made change: each device's entry is replaced rather
+than changed in place, and lists of device ids are handed out as immutable snapshots (tuples) that
+are only rebuilt after the registry has changed (copy-on-write). The registry also keeps indexes of
+the devices by device type, connection state, status and whether their latest reading reached their
+threshold, so a query such as "all connected Thermostats" or "all inactive SmartLocks" only looks at
+the devices in the smallest matching index instead of scanning every registered device
+"""
+
+import threading
+
+from model.device import STATUSES, SWITCHES
+
+# The reading compared against the threshold for each kind of device that has a sensor (SmartLocks
+# don't have one)
+MEASUREMENT_FIELDS = ("brightness", "motion", "temp")
+
+# The shared string of each status and switch value. Readings decoded from the devices' messages
+# hold their own copies of these strings; swapping them for the shared ones keeps the readings
+# mirrored for thousands of devices from holding thousands of copies of 'active' and 'on'
+CANONICAL_VALUES = {value: value for value in STATUSES + SWITCHES}
+
+
+def over_threshold(readings):
+    """
+    Check whether the readings of a device have reached its threshold, using the same comparison as
+    the devices themselves (see model/device.py).
+
+    Args:
+        readings (dict): The readings of the device.
+
+    Returns:
+        bool: True if the device's measurement is at or over its threshold, False otherwise.
+    """
+    threshold = readings.get("threshold")
+    if not isinstance(threshold, (int, float)):
+        return False
+
+    for field in MEASUREMENT_FIELDS:
+        value = readings.get(field)
+        if isinstance(value, (int, float)):
+            return value >= threshold
+    return False
+
+
+def canonical_readings(readings):
+    """
+    Replace the status and switch values of readings with the shared strings (in place).
+
+    Args:
+        readings (dict): The readings of a device.
+
+    Returns:
+        dict: The same readings.
+    """
+    for field in ("status", "switch"):
+        value = readings.get(field)
+        if isinstance(value, str):
+            readings[field] = CANONICAL_VALUES.get(value, value)
+    return readings
+
+
+class DeviceRegistry:
+    """
+    The DeviceRegistry class holds the registered devices keyed by device id. Each entry is a dict
+    with the fields 'conn' (the device's connection, or None if not connected) and 'devtype'.
+    Entries must not be changed in place; use the registry's functions instead.
+
+    Example usage:
+        registry = DeviceRegistry({"Light1": "SmartLight"}) registry.connect("Light1",
+        "SmartLight", conn) for deviceid in registry.ids(connected=True): ...
+    """
+
+    def __init__(self, devices=None):
+        """
+        Initialize a new DeviceRegistry instance.
+
+        Args:
+            devices (dict): Optional device type of each registered device keyed by device id (all
+            registered as not connected).
+        """
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._by_type = {}
+        self._connected = {}
+        self._by_status = {}
+        self._status = {}
+        self._over = {}
+        self._snapshots = {}
+
+        for deviceid, devtype in (devices or {}).items():
+            self._set(deviceid, {"conn": None, "devtype": devtype})
+
+    def _set(self, deviceid, entry):
+        """
+        Replace the entry of a device and update the indexes (the caller holds the lock).
+
+        Args:
+            deviceid (str): The device id. entry (dict): The new entry, or None to remove the
+            device.
+        """
+        old = self._entries.get(deviceid)
+        if old is not None:
+            self._by_type[old["devtype"]].pop(deviceid, None)
+            if not self._by_type[old["devtype"]]:
+                del self._by_type[old["devtype"]]
+            self._connected.pop(deviceid, None)
+
+        if entry is None:
+            self._entries.pop(deviceid, None)
+            self._set_status(deviceid, None)
+            self._over.pop(deviceid, None)
+        else:
+            self._entries[deviceid] = entry
+            # Dicts with None values are used as insertion ordered sets
+            self._by_type.setdefault(entry["devtype"], {})[deviceid] = None
+            if entry["conn"] is not None:
+                self._connected[deviceid] = None
+
+        # The snapshots taken so far no longer match the registry
+        self._snapshots.clear()
+
+    def _set_status(self, deviceid, status):
+        """
+        Update the status index of a device (the caller holds the lock).
+
+        Args:
+            deviceid (str): The device id. status (str): The new status, or None if not known.
+
+        Returns:
+            bool: True if the status changed, False otherwise.
+        """
+        old = self._status.get(deviceid)
+        if old == status:
+            return False
+
+        if old is not None:
+            del self._status[deviceid]
+            self._by_status[old].pop(deviceid, None)
+            if not self._by_status[old]:
+                del self._by_status[old]
+
+        if status is not None:
+            self._status[deviceid] = status
+            self._by_status.setdefault(status, {})[deviceid] = None
+        return True
+
+    def update_readings(self, deviceid, readings):
+        """
+        Update the status and threshold indexes with the latest readings of a device. Readings come
+        in far more often than the indexes change, so the snapshots are only dropped if they did.
+        The status and switch values of the readings are swapped for the shared strings (see
+        canonical_readings()).
+
+        Args:
+            deviceid (str): The device id. readings (dict): The latest readings of the device.
+        """
+        canonical_readings(readings)
+        with self._lock:
+            if deviceid not in self._entries:
+                return
+
+            changed = self._set_status(deviceid, readings.get("status"))
+
+            over = over_threshold(readings)
+            if over != (deviceid in self._over):
+                changed = True
+                if over:
+                    self._over[deviceid] = None
+                else:
+                    del self._over[deviceid]
+
+            if changed:
+                self._snapshots.clear()
+
+    def connect(self, deviceid, devtype, conn):
+        """
+        Record the connection of a device, registering it if it is new.
+
+        Args:
+            deviceid (str): The device id. devtype (str): The device type. conn: The connection.
+
+        Returns:
+            tuple: The device's previous connection (or None) and whether the device is new.
+        """
+        with self._lock:
+            old = self._entries.get(deviceid)
+            self._set(deviceid, {"conn": conn, "devtype": devtype})
+            if old is None:
+                return None, True
+            return old["conn"], False
+
+    def disconnect(self, deviceid, conn=None):
+        """
+        Mark a device as not connected.
+
+        Args:
+            deviceid (str): The device id. conn: If given, the device is only marked as not
+            connected if this is still its connection (i.e. it hasn't reconnected in the meantime).
+
+        Returns:
+            bool: True if the device was marked as not connected, False otherwise.
+        """
+        with self._lock:
+            old = self._entries.get(deviceid)
+            if old is None or old["conn"] is None:
+                return False
+            if conn is not None and old["conn"] is not conn:
+                return False
+            self._set(deviceid, {"conn": None, "devtype": old["devtype"]})
+            return True
+
+    def remove(self, deviceid):
+        """
+        Remove a device from the registry.
+
+        Args:
+            deviceid (str): The device id.
+
+        Returns:
+            dict: The removed entry, or None if the device wasn't registered.
+        """
+        with self._lock:
+            old = self._entries.get(deviceid)
+            if old is not None:
+                self._set(deviceid, None)
+            return old
+
+    def get(self, deviceid, default=None):
+        """
+        Get the entry of a device.
+
+        Args:
+            deviceid (str): The device id. default: Returned if the device isn't registered.
+
+        Returns:
+            dict: The entry with the fields 'conn' and 'devtype', or the default.
+        """
+        # Entries are replaced, never changed, so a single lookup needs no lock
+        return self._entries.get(deviceid, default)
+
+    def conn(self, deviceid):
+        """
+        Get the connection of a device.
+
+        Args:
+            deviceid (str): The device id.
+
+        Returns:
+            The connection, or None if the device isn't registered or connected.
+        """
+        entry = self._entries.get(deviceid)
+        return entry["conn"] if entry is not None else None
+
+    def ids(self, connected=False, devtype=None):
+        """
+        Get the ids of the registered devices.
+
+        Args:
+            connected (bool): Whether to only return connected devices. devtype (str): Optional
+            device type to return the devices of.
+
+        Returns:
+            tuple: Snapshot of the device ids.
+        """
+        return self.query(devtype=devtype, connected=True if connected else None)
+
+    def query(self, devtype=None, connected=None, status=None, over=None):
+        """
+        Get the ids of the registered devices matching all the given criteria (None matches any).
+        The devices are taken from the smallest index of the criteria and checked against the
+        others, so the cost depends on the size of that index rather than on the whole registry.
+        The order is the order of that index.
+
+        Args:
+            devtype (str): The device type. connected (bool): Whether the device is connected.
+            status (str): The status of the latest readings, e.g. 'inactive'. over (bool): Whether
+            the latest readings are at or over the threshold (see over_threshold()).
+
+        Returns:
+            tuple: Snapshot of the device ids.
+
+        Example usage:
+            registry.query(devtype="Thermostat", connected=True) registry.query(devtype="SmartLock",
+            status="inactive") registry.query(over=True)
+        """
+        key = (devtype, connected, status, over)
+        snapshot = self._snapshots.get(key)
+        if snapshot is not None:
+            return snapshot
+
+        with self._lock:
+            # The indexes of the criteria that select devices; a False criterion can only filter
+            indexes = []
+            if devtype is not None:
+                indexes.append(self._by_type.get(devtype, {}))
+            if connected:
+                indexes.append(self._connected)
+            if status is not None:
+                indexes.append(self._by_status.get(status, {}))
+            if over:
+                indexes.append(self._over)
+
+            if indexes:
+                candidates = min(indexes, key=len)
+                indexes.remove(candidates)
+            else:
+                candidates = self._entries
+
+            filters = [index.__contains__ for index in indexes]
+            if connected is False:
+                filters.append(lambda k: k not in self._connected)
+            if over is False:
+                filters.append(lambda k: k not in self._over)
+
+            snapshot = self._snapshots[key] = tuple(
+                k for k in candidates if all(f(k) for f in filters)
+            )
+            return snapshot
+
+    def devtypes(self):
+        """
+        Get the number of registered devices of each device type.
+
+        Returns:
+            dict: The number of devices keyed by device type.
+        """
+        with self._lock:
+            return {devtype: len(ids) for devtype, ids in self._by_type.items()}
+
+    def items(self):
+        """
+        Get the registered devices and their entries.
+
+        Returns:
+            list: Snapshot of (device id, entry) pairs.
+        """
+        with self._lock:
+            return list(self._entries.items())
+
+    def __contains__(self, deviceid):
+        return deviceid in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self.ids())
@@ -17,13 +17,32 @@ import socket
 import threading
 import time
 
+import codec
+import framing
 import utils
+from delta import DeltaEncoder
 from model.device import Device, MotionSensor, SmartLight, SmartLock, Thermostat
+from model.dispatch import actions
+from scheduler import TickScheduler
 
 # Set logging level to logging.ERROR to view error logs
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
 
 
+# Number of seconds between simulated sensor data updates...
+SENSE_INTERVAL = 5
+
+# ...give or take this many seconds, so that devices started together don't update in lockstep
+SENSE_JITTER = 0.5
+
+# Number of seconds without hearing from the HUB (it sends heartbeats to quiet connections) after
+# which the HUB is taken to be gone; this is also the timeout of every read from (and write to) it
+HUB_TIMEOUT = utils.HEARTBEAT_INTERVAL * utils.HEARTBEAT_MISSES
+
+# Whether to print every request received from the HUB (turned off when simulating a whole fleet of
+# devices, see fleet_simulator.py)
+PRINT_REQUESTS = True
+
 # This is the pre-defined list of sensors. Feel free to add to it, ensuring that the identifiers are
 # unique
 DEVICE_LIST = [
@@ -42,6 +61,17 @@ DEVICE_LIST = [
 ]
 
 
+def report(msg):
+    """
+    Print a message about a request received from the HUB, unless turned off with PRINT_REQUESTS.
+
+    Args:
+        msg (str): The message.
+    """
+    if PRINT_REQUESTS:
+        print(msg)
+
+
 def display_devices():
     """
     The server username and password are hard-coded in this simulation to avoid repeated inputs. A
@@ -72,19 +102,286 @@ def display_devices():
         print(f"{ind}: {dev}")
 
 
-def simulate_data_update(device, running):
+class TelemetrySubscription:
+    """
+    The TelemetrySubscription class holds the HUB's telemetry subscription of this device. Once the
+    HUB has subscribed, the device pushes its readings to the HUB as they are sensed instead of
+    waiting to be polled.
+
+    Attributes:
+        active (bool): Whether the HUB is subscribed. interval (float): Push the readings at least
+        every this many seconds (None for no periodic push). change (float): Push the readings as
+        soon as a numeric reading moves by at least this much since the last push (None to push on
+        any change). If neither interval nor change is set, readings are pushed whenever they
+        change.
+        encoding (str): 'delta' to push the readings as deltas (see delta.py), or None to push the
+        full readings.
+    """
+
+    def __init__(self):
+        """Initialize a new (inactive) TelemetrySubscription instance."""
+        self.active = False
+        self.interval = None
+        self.change = None
+        self.encoding = None
+        self._last_readings = None
+        self._last_push = 0.0
+        self._lock = threading.Lock()
+
+    def configure(self, interval=None, change=None, encoding=None):
+        """
+        Start (or change) the subscription.
+
+        Args:
+            interval (float): Periodic push interval in seconds, or None. change (float): Change
+            threshold, or None. encoding (str): 'delta' or None.
+        """
+        with self._lock:
+            self.active = True
+            self.interval = interval
+            self.change = change
+            self.encoding = encoding
+            self._last_readings = None
+
+    def cancel(self):
+        """Stop the subscription."""
+        with self._lock:
+            self.active = False
+
+    def _changed(self, readings):
+        """
+        Check whether the readings changed enough since the last push.
+
+        Args:
+            readings (dict): The current readings.
+
+        Returns:
+            bool: True if the readings should be pushed because of a change.
+        """
+        for field, value in readings.items():
+            last = self._last_readings.get(field)
+            if value == last:
+                continue
+            # Numeric readings must move by at least change (if set); anything else is a change
+            if (
+                self.change is not None
+                and isinstance(value, (int, float))
+                and isinstance(last, (int, float))
+                and abs(value - last) < self.change
+            ):
+                continue
+            return True
+        return False
+
+    def take_due(self, readings, now):
+        """
+        Check whether the readings are due to be pushed, and if so, record them as pushed.
+
+        Args:
+            readings (dict): The current readings. now (float): The current time (seconds).
+
+        Returns:
+            bool: True if the readings should be pushed to the HUB.
+        """
+        with self._lock:
+            if not self.active:
+                return False
+
+            if self._last_readings is None:
+                due = True
+            elif self.interval is not None and now - self._last_push >= self.interval:
+                due = True
+            elif self.interval is not None and self.change is None:
+                # Periodic subscription only
+                due = False
+            else:
+                due = self._changed(readings)
+
+            if due:
+                self._last_readings = readings
+                self._last_push = now
+            return due
+
+
+def readings_push(device, subscription, encoder):
+    """
+    Build the message pushing the device readings to the HUB, if the subscription says they are
+    due. The caller holds the session lock, since the delta encoder may be used.
+
+    Args:
+        device (Device): The simulated device. subscription (TelemetrySubscription): The HUB's
+        subscription. encoder (DeltaEncoder): The delta encoder of the connection.
+
+    Returns:
+        dict: The message to push, or None if the readings aren't due.
     """
-    Simulate data updates to the sensor of the selected device at regular intervals. This function
-    runs in a separate thread
+    readings = device.get_readings()
+    if not subscription.take_due(readings, time.monotonic()):
+        return None
+
+    # Pushed messages carry an 'event' field instead of a message id
+    msg = {"event": "readings"}
+    if subscription.encoding == "delta":
+        msg["delta"] = encoder.encode(readings)
+    else:
+        msg["result"] = readings
+    return msg
+
+
+def push_readings(hub, session, device, subscription, encoder):
+    """
+    Push the device readings to the HUB if the subscription says they are due.
+
+    Args:
+        hub (socket): The socket connected to the HUB. session (SessionCipher): The session cipher
+        of the connection. device (Device): The simulated device. subscription
+        (TelemetrySubscription): The HUB's subscription. encoder (DeltaEncoder): The delta encoder
+        of the connection.
+    """
+    # Deltas are encoded and sent under the session lock so that they reach the HUB in sequence
+    # order
+    with session.lock:
+        msg = readings_push(device, subscription, encoder)
+        if msg is not None and not utils.send_encrypted_message(hub, msg, session):
+            print("Pushing readings to hub failed!")
+
+
+def simulate_data_update(device, scheduler, on_sense=None, interval=SENSE_INTERVAL):
+    """
+    Schedule simulated data updates to the sensor of a device at regular intervals. The updates are
+    run by the scheduler's thread (see scheduler.py), which can drive any number of devices.
+
+    Args:
+        device (Device): The simulated device. scheduler (TickScheduler): The scheduler to run the
+        updates. on_sense (callable): Optional function called after every data update. interval
+        (float): Number of seconds between data updates.
+
+    Returns:
+        Job: The scheduled job (to cancel it), or None if the device doesn't have a sensor.
     """
     # Smart lock in this implementation doesn't have any sensors, so do nothing if it is
     if isinstance(device, SmartLock):
-        return
+        return None
 
-    while running:
+    def update():
         # Simulate data update from sensors
         device.sense()
-        time.sleep(5)
+        if on_sense is not None:
+            on_sense()
+
+    return scheduler.schedule(update, interval, jitter=SENSE_JITTER)
+
+
+def handle_action(device, request_data):
+    """
+    Carry out a single action requested by the HUB on the device. The action is dispatched to the
+    device class' handler through the action registry (see model/dispatch.py), so new device types
+    only need to register their handlers in model/device.py
+
+    Args:
+        device (Device): The simulated device. request_data (dict): The decrypted request,
+        containing the 'action' field and any action parameters.
+
+    Returns:
+        The result of the action, to be sent back to the HUB in the 'result' field.
+    """
+    report(f"Request '{request_data.get('action')}' received from HUB")
+    return actions.dispatch(device, request_data)
+
+
+def handle_batch(device, request_data):
+    """
+    Carry out a batch of actions requested by the HUB in a single message, in order. This lets the
+    HUB e.g. configure a device (threshold + activate + switch on) in one round trip.
+
+    Args:
+        device (Device): The simulated device. request_data (dict): The decrypted request, with the
+        sub-actions in its 'actions' field.
+
+    Returns:
+        list: The result of each sub-action, in the same order. A sub-action that fails gets a
+        'failure - ...' result and doesn't stop the ones after it.
+    """
+    report("Batch of actions received from HUB")
+    results = []
+    for sub_request in request_data.get("actions", []):
+        # A batch can't disconnect the device or contain further batches
+        if not isinstance(sub_request, dict) or "action" not in sub_request:
+            results.append("failure - invalid action")
+        elif sub_request["action"] in ("set_disconnect", "batch"):
+            results.append("failure - not allowed in batch")
+        else:
+            try:
+                results.append(handle_action(device, sub_request))
+            except Exception as e:  # pylint: disable=broad-except
+                logging.error(
+                    "Error carrying out batch action: %s",
+                    e,
+                    exc_info=True,
+                )
+                results.append(f"failure - {sub_request['action']} failed")
+    return results
+
+
+def handle_request(device, request_data, subscription, encoder):
+    """
+    Work out the response to a request from the HUB (other than 'set_disconnect', which closes the
+    connection and is left to the caller). This is shared by the device loop below and the fleet
+    simulator (see fleet_simulator.py). The caller holds the session lock, since the delta encoder
+    may be used.
+
+    Args:
+        device (Device): The simulated device. request_data (dict): The decrypted request.
+        subscription (TelemetrySubscription): The HUB's subscription. encoder (DeltaEncoder): The
+        delta encoder of the connection.
+
+    Returns:
+        dict: The response to send back to the HUB (without the message id), or None if the
+        request isn't answered.
+    """
+    # Any message may carry the HUB's acknowledgement of the latest readings it merged
+    if request_data.get("ack") is not None:
+        encoder.ack(request_data["ack"])
+
+    action = request_data.get("action")
+
+    # Acknowledgements and resync requests of the delta encoding aren't answered
+    if action == "ack":
+        encoder.ack(request_data.get("seq"))
+        return None
+
+    if action == "resync":
+        encoder.reset()
+        return None
+
+    # Heartbeats are answered with a 'pong' event
+    if action == "ping":
+        return {"event": "pong"}
+
+    # Carry out the action (or batch of actions) and return the result
+    if action == "subscribe":
+        report("Request to subscribe to telemetry received from HUB")
+        subscription.configure(
+            request_data.get("interval"),
+            request_data.get("change"),
+            request_data.get("encoding"),
+        )
+        return {"result": "success"}
+
+    if action == "unsubscribe":
+        report("Request to unsubscribe from telemetry received from HUB")
+        subscription.cancel()
+        return {"result": "success"}
+
+    if action == "batch":
+        return {"result": handle_batch(device, request_data)}
+
+    if action == "get_readings" and request_data.get("encoding") == "delta":
+        report("Request 'get_readings' received from HUB")
+        readings = device.get_readings()
+        return {"delta": encoder.encode(readings, request_data.get("full", False))}
+
+    return {"result": handle_action(device, request_data)}
 
 
 def secure_connect_to_server(device: Device):
@@ -96,10 +393,8 @@ def secure_connect_to_server(device: Device):
     # Load the Fernet key to decrypt the credentials file
     fer_key = utils.load_fernet_key("./Secrets/dev_enc.key")
 
-    # Load the HUB public key and device private key for encryption purposes
+    # Load the HUB public key used to wrap the session key in the connection message
     hub_pub_key = utils.load_public_key("./Secrets/hub_pub.key")
-    # Load the device private key for decryption purposes
-    _, dev_private_key = utils.load_keys(None, "./Secrets/dev_prv.key")
 
     # Check to make sure that the keys are not None which means either they weren't found or
     # couldn't be loaded for whatever reason, meaning nothing can continue; no keys, no Device
@@ -108,9 +403,6 @@ def secure_connect_to_server(device: Device):
         assert (
             hub_pub_key is not None
         ), "No HUB public key found. Please generate it by running './initialise.py'"
-        assert (
-            dev_private_key is not None
-        ), "No device private key found. Please generate it by running './initialise.py'"
         assert (
             fer_key is not None
         ), "No encryption key found. Please generate it by running './initialise.py'"
@@ -125,6 +417,11 @@ def secure_connect_to_server(device: Device):
     print("\nAttempting to connect to the HUB using credentials...")
     hub = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
+    # Every read from the HUB times out after HUB_TIMEOUT, and TCP keepalive probes the connection
+    # while it is idle, so that a HUB that went away is noticed
+    hub.settimeout(HUB_TIMEOUT)
+    utils.set_keepalive(hub)
+
     # If connection works, great; if not, close and exit.
     try:
         hub.connect(("127.0.0.1", 8080))
@@ -149,16 +446,27 @@ def secure_connect_to_server(device: Device):
     # Add in the server credentials to the connection message
     connectmsg.update(creds)
 
-    # Use the utils.send_encrypted_message function to encrypt and send the message If it works,
-    # great. If not, bail out.
-    if utils.send_encrypted_message(hub, connectmsg, pub_key=hub_pub_key):
+    # Offer the message codecs this device supports; the HUB picks one in its response
+    connectmsg["codecs"] = codec.PREFERRED
+
+    # Use the utils.seal_handshake function to create the session key for this connection, wrap it
+    # with the HUB public key and encrypt the message with it. If it works, great. If not, bail out.
+    session, handshake = utils.seal_handshake(connectmsg, hub_pub_key)
+    try:
+        assert session is not None, "Unable to create the session key"
+        framing.send_frame(hub, handshake)
         print("Connection message sent.")
-    else:
-        print("Error sending connection message. Exiting...")
+    except Exception as e:
+        print(f"Error sending connection message: {e}. Exiting...")
         exit(1)
 
-    # Message was sent, now get a response from the HUB
-    request = hub.recv(1024)
+    # Message was sent, now get a response from the HUB. All reads go through a frame reader so
+    # that each read returns exactly one whole message
+    reader = framing.FrameReader(hub)
+    try:
+        request = reader.recv_frame()
+    except OSError:
+        request = None
 
     # If the connection is lost, bail out.
     if not request:
@@ -166,197 +474,79 @@ def secure_connect_to_server(device: Device):
         exit(1)
 
     # Decrypt the response from the HUB
-    request_data = utils.decrypt_message(request, dev_private_key)
+    request_data = session.decrypt(request)
 
     # If the response doesn't contain the 'result' field or it does but the result is not 'success',
     # bail out.
-    if not ("result" in request_data) or request_data["result"] != "success":
+    if (
+        not request_data
+        or not ("result" in request_data)
+        or request_data["result"] != "success"
+    ):
         print("Unable to connect to the hub. Aborting...")
         exit(1)
 
-    print("Connected to the HUB")
+    # Switch to the codec the HUB picked (HUBs that don't negotiate codecs stay with JSON)
+    msg_codec = codec.get_codec(request_data.get("codec"))
+    if msg_codec is None:
+        print("The HUB picked an unknown message codec. Aborting...")
+        exit(1)
+    session.codec = msg_codec
+
+    print(f"Connected to the HUB (using the {msg_codec.name} codec)")
+
+    # The HUB's telemetry subscription; readings are pushed after every data update and action
+    subscription = TelemetrySubscription()
 
-    running = True
+    # Readings asked for with the 'delta' encoding are sent as deltas against the last snapshot the
+    # HUB acknowledged. The encoder is shared with the scheduler thread, so it is only used
+    # while holding the session lock
+    encoder = DeltaEncoder()
 
-    # Start data simulation thread
-    update_thread = threading.Thread(target=simulate_data_update(device, running))
-    update_thread.daemon = True
-    update_thread.start()
+    def on_sense():
+        push_readings(hub, session, device, subscription, encoder)
+
+    # Start the data simulation, run by the scheduler thread
+    scheduler = TickScheduler()
+    simulate_data_update(device, scheduler, on_sense)
+    scheduler.start()
 
     # Continuously wait for HUB requests and handle them appropriately
     while True:
         try:
             # Receive requests from the HUB
-            request = hub.recv(1024)
+            request = reader.recv_frame()
 
             if not request:
                 break
 
             # Decrypt the message
-            request_data = utils.decrypt_message(request, dev_private_key)
+            request_data = session.decrypt(request)
+
+            # If the message can't be decrypted, don't act on it
+            if request_data is None:
+                print("Message could not be decrypted")
+                continue
+
+            # Answer the HUB's heartbeats quietly
+            if request_data.get("action") == "ping":
+                utils.send_encrypted_message(hub, {"event": "pong"}, session)
+                continue
 
             print("Message received from HUB")
 
             if "action" in request_data:
                 action = request_data["action"]
 
-                if action == "get_readings":
-                    # Retreieve the device readings
-                    print("Request for readings received from HUB")
-                    msg = {"result": device.get_readings()}
-                    if utils.send_encrypted_message(hub, msg, hub_pub_key):
-                        print("Responded to HUB")
-                    else:
-                        print("Responding to hub failed!")
-
-                elif action == "set_thres":
-                    # Set the device threshold
-                    print("Request to set threshold received from HUB")
-                    device.set_threshold(request_data["value"])
-                    msg = {"result": "success"}
-                    if utils.send_encrypted_message(hub, msg, hub_pub_key):
-                        print("Responded to HUB")
-                    else:
-                        print("Responding to hub failed!")
-
-                elif action == "set_activate":
-                    # Activate the device note that activation has different effects on the
-                    # different devices in this simulation For SmartLight, it activates the
-                    # automatic light sensor, so it will start using the threshold to turn on/off
-                    # the light For MotionSensor and Thermostat it will start the device using the
-                    # given threshold to issue alerts / adjust temperature For SmartLock this
-                    # disables the lock and unlock functions
-                    print("Request to set activate received from HUB")
-
-                    if device.status == "active":
-                        res = "already active"
-                    else:
-                        device.activate()
-                        res = "success"
-
-                    msg = {"result": res}
-                    if utils.send_encrypted_message(hub, msg, hub_pub_key):
-                        print("Responded to HUB")
-                    else:
-                        print("Responding to hub failed!")
-
-                elif action == "set_deactivate":
-                    # Deactivate the device note that deactivation has different effects on the
-                    # different devices in this simulation For SmartLight, it deactivates the
-                    # automatic light sensor, so it will just remain either on or off depending on
-                    # what it was For MotionSensor and Thermostat it will stop the device from using
-                    # the given threshold For SmartLock this disables the lock and unlock functions
-                    print("Request to set deactivate received from HUB")
-
-                    if device.status == "inactive":
-                        res = "already inactive"
-                    else:
-                        device.deactivate()
-                        res = "success"
-
-                    msg = {"result": res}
-                    if utils.send_encrypted_message(hub, msg, hub_pub_key):
-                        print("Responded to HUB")
-                    else:
-                        print("Responding to hub failed!")
-
-                elif action == "set_on":
-                    # Turn on mean different things to the different devices in this simulation For
-                    # SmartLight, it means deactivate the automatic light sensor and set it to on
-                    # For MotionSensor and Thermostat it means start sensing motion/temperature For
-                    # SmartLock it means lock, but only if the lock status is 'active'
-
-                    print("Request to turn on received from HUB")
-                    res = ""
-
-                    if isinstance(device, SmartLight):
-                        device.deactivate()
-                        device.switch_on()
-                        res = "Manual override (threshold deactivated); lighted switched on"
-
-                    elif isinstance(device, MotionSensor):
-                        if device.switch == "on":
-                            res = "already on"
-                        else:
-                            device.switch_on()
-                            res = "success - motion sensor engaged"
-
-                    elif isinstance(device, SmartLock):
-                        if device.status == "inactive":
-                            res = "failure - lock is inactive"
-                        else:
-                            if device.switch == "on":
-                                res = "already locked"
-                            else:
-                                device.lock()
-                                res = "success - lock engaged"
-
-                    elif isinstance(device, Thermostat):
-                        if device.switch == "on":
-                            res = "already on"
-                        else:
-                            device.switch_on()
-                            res = "success - thermostat engaged"
-
-                    # Send the response back to the HUB
-                    msg = {"result": res}
-                    if utils.send_encrypted_message(hub, msg, hub_pub_key):
-                        print("Responded to HUB")
-                    else:
-                        print("Responding to hub failed!")
-
-                elif action == "set_off":
-                    # Turn off means different things to the different devices in this simulation
-                    # For SmartLight, it means deactivate the automatic light sensor and set it to
-                    # off For MotionSensor and Thermostat it means stop sensing motion/temperature
-                    # For SmartLock it means unlock, but only if the lock status is 'active'
-
-                    print("Request to turn off received from HUB")
-                    res = ""
-
-                    if isinstance(device, SmartLight):
-                        device.deactivate()
-                        device.switch_off()
-                        res = "Manual override (threshold deactivated); lighted switched off"
-
-                    elif isinstance(device, MotionSensor):
-                        if device.switch == "off":
-                            res = "already off"
-                        else:
-                            device.switch_off()
-                            res = "success - motion sensor disengaged"
-
-                    elif isinstance(device, SmartLock):
-                        if device.status == "inactive":
-                            res = "failure - lock is inactive"
-                        else:
-                            if device.switch == "off":
-                                res = "already unlocked"
-                            else:
-                                device.unlock()
-                                res = "success - lock disengaged"
-
-                    elif isinstance(device, Thermostat):
-                        if device.switch == "off":
-                            res = "already off"
-                        else:
-                            device.switch_off()
-                            res = "success - thermostat disengaged"
-
-                    # Send the result back to the HUB
-                    msg = {"result": res}
-                    if utils.send_encrypted_message(hub, msg, hub_pub_key):
-                        print("Responded to HUB")
-                    else:
-                        print("Responding to hub failed!")
-
-                elif action == "set_disconnect":
+                if action == "set_disconnect":
                     # Disconnect this device from the HUB. Close and shut down.
                     print("Request to disconnect received from HUB")
-                    running = False
+                    scheduler.stop()
 
                     msg = {"result": "success"}
-                    if utils.send_encrypted_message(hub, msg, hub_pub_key):
+                    if utils.send_encrypted_message(
+                        hub, utils.reply_to(request_data, msg), session
+                    ):
                         print("Responded to HUB. Shutting down...")
                     else:
                         print("Responding to hub failed! Oh oh!")
@@ -364,9 +554,29 @@ def secure_connect_to_server(device: Device):
                     hub.close()
                     break
 
+                # Carry out the action and send the result (if any) back to the HUB
+                with session.lock:
+                    msg = handle_request(device, request_data, subscription, encoder)
+                    if msg is None:
+                        continue
+
+                    if utils.send_encrypted_message(
+                        hub, utils.reply_to(request_data, msg), session
+                    ):
+                        print("Responded to HUB")
+                    else:
+                        print("Responding to hub failed!")
+
+                # Actions may have changed the readings too
+                push_readings(hub, session, device, subscription, encoder)
+
             else:
                 print("Message not understood")
 
+        except socket.timeout:
+            print("No word from the HUB for too long; it must have gone away")
+            break
+
         except Exception as e:
             logging.error(
                 "Error: %s",
@@ -374,10 +584,10 @@ def secure_connect_to_server(device: Device):
                 exc_info=True,
             )
             print("Something went wrong - please check the error logs")
-            running = False
             break
 
     print("HUB closed connection. Closing...")
+    scheduler.stop()
     hub.close()
 
 
@@ -0,0 +1,507 @@
+"""
+This module simulates a whole fleet of IoT devices in one process, to load-test the HUB. Unlike
+device_service.py (one interactively chosen device per process), it runs without any input: 1. N
+devices are created with a configurable mix of device types (using the model/device.py classes) 2.
+The devices connect to the HUB at a configurable rate (ramp-up), so the HUB's capacity can be
+measured as the load builds up 3. All the connections are served by a single asyncio event loop,
+answering the HUB's requests the same way device_service.py does (see handle_request()) 4. Every
+SENSE_INTERVAL seconds the sensors of the whole fleet are updated at once (see model/fleet.py) and
+the connected devices push their readings if subscribed
+
+Example usage:
+    python fleet_simulator.py --devices 5000 --mix SmartLight=3,Thermostat=1 --ramp-up 500
+"""
+
+import argparse
+import asyncio
+import contextlib
+import logging
+import time
+
+import codec
+import device_service
+import framing
+import utils
+from delta import DeltaEncoder
+from device_service import HUB_TIMEOUT, TelemetrySubscription, handle_request, readings_push
+from hub_server import HUB_HOST, HUB_PORT, percentile, raise_open_files_limit
+from model.device import MotionSensor, SmartLight, SmartLock, Thermostat
+from model.fleet import DeviceFleet, device_type
+
+# Set logging level to logging.ERROR to view error logs
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+# The device classes the fleet can be made of, keyed by device type
+DEVICE_TYPES = {
+    cls.__name__: cls for cls in (SmartLight, MotionSensor, SmartLock, Thermostat)
+}
+
+# Default number of devices and mix of device types (relative weights)
+DEFAULT_DEVICES = 1000
+DEFAULT_MIX = "SmartLight=1,MotionSensor=1,SmartLock=1,Thermostat=1"
+
+# Default number of devices that start connecting per second
+RAMP_UP_RATE = 200
+
+# Number of seconds a device gets to complete its connection before it counts as failed
+CONNECT_TIMEOUT = 10.0
+
+
+def parse_mix(text):
+    """
+    Parse a mix of device types such as 'SmartLight=3,Thermostat=1'. A type without a weight counts
+    as weight 1.
+
+    Args:
+        text (str): Comma separated device types with their relative weights.
+
+    Returns:
+        dict: The weight of each device type keyed by device type.
+
+    Raises:
+        ValueError: If a device type is unknown, a weight isn't a non-negative number or all the
+        weights are 0.
+    """
+    mix = {}
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+
+        devtype, _, weight = part.partition("=")
+        devtype = devtype.strip()
+        if devtype not in DEVICE_TYPES:
+            raise ValueError(
+                f"Unknown device type '{devtype}' (known: {', '.join(DEVICE_TYPES)})"
+            )
+
+        weight = float(weight) if weight.strip() else 1.0
+        if weight < 0:
+            raise ValueError(f"Weight of {devtype} is negative")
+        mix[devtype] = mix.get(devtype, 0) + weight
+
+    if sum(mix.values()) <= 0:
+        raise ValueError("The mix doesn't contain any device")
+    return mix
+
+
+def build_fleet(count, mix, prefix="Sim"):
+    """
+    Create the devices of the fleet. The number of devices of each type follows the weights of the
+    mix (largest remainder rounding), and the types are interleaved so that the ramp-up connects a
+    steady mix of device types rather than all the devices of one type first.
+
+    Args:
+        count (int): Number of devices. mix (dict): The weight of each device type (see
+        parse_mix()). prefix (str): Prefix of the device identifiers, so that several simulators
+        can connect to the same HUB without clashing.
+
+    Returns:
+        list: The devices, e.g. SmartLight('Sim-SmartLight-1').
+    """
+    total = sum(mix.values())
+    shares = {devtype: count * weight / total for devtype, weight in mix.items()}
+    counts = {devtype: int(share) for devtype, share in shares.items()}
+
+    # Hand out the devices left over by rounding down to the largest remainders
+    left = count - sum(counts.values())
+    for devtype in sorted(shares, key=lambda t: counts[t] - shares[t])[:left]:
+        counts[devtype] += 1
+
+    # Device n of a type of k devices is placed at (n + 0.5) / k along the fleet
+    slots = []
+    for devtype, number in counts.items():
+        for n in range(number):
+            slots.append(((n + 0.5) / number, devtype, n + 1))
+    slots.sort(key=lambda slot: slot[0])
+
+    return [
+        DEVICE_TYPES[devtype](f"{prefix}-{devtype}-{n}") for _, devtype, n in slots
+    ]
+
+
+class VirtualDevice:
+    """
+    The VirtualDevice class is the connection of one simulated device to the HUB. It plays the part
+    of device_service.secure_connect_to_server() over asyncio streams. Everything runs in the event
+    loop thread, so the session lock isn't needed. Instances are kept small (using __slots__) since
+    the simulator may hold thousands of them.
+
+    Attributes:
+        device (Device): The simulated device. subscription (TelemetrySubscription): The HUB's
+        telemetry subscription. encoder (DeltaEncoder): The delta encoder of the connection.
+        session (SessionCipher): The session cipher of the connection (once connected). reader
+        (asyncio.StreamReader): Stream the HUB's messages are read from. writer
+        (asyncio.StreamWriter): Stream messages to the HUB are written to.
+    """
+
+    __slots__ = ("device", "subscription", "encoder", "session", "reader", "writer")
+
+    def __init__(self, device):
+        """Initialize a new VirtualDevice instance."""
+        self.device = device
+        self.subscription = TelemetrySubscription()
+        self.encoder = DeltaEncoder()
+        self.session = None
+        self.reader = None
+        self.writer = None
+
+    @property
+    def connected(self):
+        """bool: Whether the device is connected to the HUB."""
+        return self.session is not None and self.writer is not None
+
+    async def connect(self, host, port, creds, crypto):
+        """
+        Connect to the HUB and send the connection message.
+
+        Args:
+            host (str): Address of the HUB. port (int): Port of the HUB. creds (dict): The 'user'
+            and 'pass' to present. crypto (CryptoContext): The context of the HUB public key.
+
+        Raises:
+            OSError: If the connection fails. ConnectionError: If the HUB refuses the connection.
+        """
+        self.reader, self.writer = await asyncio.open_connection(
+            host, port, limit=framing.DEFAULT_MAX_FRAME_SIZE
+        )
+        sock = self.writer.get_extra_info("socket")
+        if sock is not None:
+            utils.set_keepalive(sock)
+
+        connectmsg = {
+            "action": "connect",
+            "devid": self.device.identifier,
+            "devtype": device_type(self.device),
+        }
+        connectmsg.update(creds)
+        connectmsg["codecs"] = codec.PREFERRED
+
+        session, handshake = utils.seal_handshake(connectmsg, crypto)
+        if session is None:
+            raise ConnectionError("Unable to create the session key")
+        framing.write_frame(self.writer, handshake)
+        await self.writer.drain()
+
+        reply = await framing.read_frame(self.reader)
+        request_data = session.decrypt(reply) if reply else None
+        if not request_data or request_data.get("result") != "success":
+            raise ConnectionError("Connection refused by the HUB")
+
+        msg_codec = codec.get_codec(request_data.get("codec"))
+        if msg_codec is None:
+            raise ConnectionError("The HUB picked an unknown message codec")
+        session.codec = msg_codec
+        self.session = session
+
+    async def serve(self):
+        """
+        Answer the HUB's requests until the HUB closes the connection (or asks to disconnect, or
+        isn't heard from for HUB_TIMEOUT seconds).
+        """
+        while True:
+            try:
+                request = await asyncio.wait_for(framing.read_frame(self.reader), HUB_TIMEOUT)
+            except (OSError, framing.FrameError, asyncio.TimeoutError):
+                request = None
+            if not request:
+                return
+
+            request_data = self.session.decrypt(request)
+            if request_data is None or "action" not in request_data:
+                continue
+
+            if request_data["action"] == "set_disconnect":
+                self._send(utils.reply_to(request_data, {"result": "success"}))
+                await self.writer.drain()
+                return
+
+            msg = handle_request(self.device, request_data, self.subscription, self.encoder)
+            if msg is not None:
+                self._send(utils.reply_to(request_data, msg))
+
+                # Actions may have changed the readings too
+                self.push()
+                await self.writer.drain()
+
+    def push(self):
+        """Push the device readings to the HUB if the subscription says they are due."""
+        msg = readings_push(self.device, self.subscription, self.encoder)
+        if msg is not None:
+            self._send(msg)
+
+    def _send(self, msg):
+        """
+        Queue an encrypted message on the connection.
+
+        Args:
+            msg (dict): The message.
+        """
+        data = self.session.encrypt(msg)
+        if data is not None:
+            framing.write_frame(self.writer, data)
+
+    def close(self):
+        """Close the connection to the HUB."""
+        if self.writer is not None:
+            self.writer.close()
+        self.session = None
+        self.writer = None
+
+
+class FleetSimulator:
+    """
+    The FleetSimulator class connects a fleet of virtual devices to the HUB at a steady rate and
+    serves all their connections in one event loop.
+
+    Attributes:
+        fleet (DeviceFleet): The state of all the simulated devices. devices (list): The
+        VirtualDevice of each simulated device (over its view in the fleet). host (str): Address of
+        the HUB. port (int): Port of the HUB. creds (dict): The 'user' and 'pass' the devices
+        present. crypto (CryptoContext): The context of the HUB public key, shared by all the
+        devices. ramp_up (float): Number of devices that start connecting per second. sense_interval
+        (float): Number of seconds between simulated sensor data updates. connected (int): Number of
+        devices currently connected. failures (dict): Number of failed connections keyed by reason.
+        connect_latencies (list): Seconds each successful connection took.
+
+    Example usage:
+        simulator = FleetSimulator(build_fleet(1000, mix), HUB_HOST, HUB_PORT, creds, crypto)
+        asyncio.run(simulator.run(duration=60))
+    """
+
+    def __init__(
+        self,
+        devices,
+        host,
+        port,
+        creds,
+        crypto,
+        ramp_up=RAMP_UP_RATE,
+        sense_interval=device_service.SENSE_INTERVAL,
+    ):
+        """Initialize a new FleetSimulator instance."""
+        self.fleet = DeviceFleet(len(devices))
+        self.devices = [VirtualDevice(view) for view in self.fleet.extend(devices)]
+        self.host = host
+        self.port = port
+        self.creds = creds
+        self.crypto = crypto
+        self.ramp_up = ramp_up
+        self.sense_interval = sense_interval
+        self.connected = 0
+        self.failures = {}
+        self.connect_latencies = []
+        self._serving = []
+        self._stopped = None
+
+    async def run(self, duration=None):
+        """
+        Connect the fleet and serve it for a while.
+
+        Args:
+            duration (float): Number of seconds to run for (counted from the start of the ramp-up),
+            or None to run until stop() is called or the HUB has closed every connection.
+        """
+        loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        started = loop.time()
+        sensing = asyncio.ensure_future(self._sense_loop())
+
+        try:
+            # Start the devices' connections at the ramp-up rate; each one connects on its own so
+            # that a slow handshake doesn't hold the next devices back
+            starting = []
+            for i, vdev in enumerate(self.devices):
+                delay = started + i / self.ramp_up - loop.time()
+                if delay > 0:
+                    await self._wait_stopped(delay)
+                if self._stopped.is_set():
+                    break
+                starting.append(asyncio.ensure_future(self._start(vdev)))
+
+            await asyncio.gather(*starting)
+            print(f"Ramp-up finished after {loop.time() - started:.1f}s: {self.summary()}")
+
+            remaining = None if duration is None else started + duration - loop.time()
+            if remaining is None or remaining > 0:
+                served = asyncio.gather(*self._serving)
+                stop = asyncio.ensure_future(self._stopped.wait())
+                await asyncio.wait(
+                    [served, stop], timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+                )
+                stop.cancel()
+
+        finally:
+            sensing.cancel()
+            for vdev in self.devices:
+                vdev.close()
+            if self._serving:
+                await asyncio.wait(self._serving)
+
+    async def _wait_stopped(self, timeout):
+        """
+        Wait until stop() is called, or for a number of seconds at most.
+
+        Args:
+            timeout (float): The number of seconds.
+        """
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._stopped.wait(), timeout)
+
+    def stop(self):
+        """Stop the ramp-up and disconnect every device; run() returns once they are closed."""
+        if self._stopped is not None:
+            self._stopped.set()
+        for vdev in self.devices:
+            vdev.close()
+
+    async def _start(self, vdev):
+        """
+        Connect a device and start serving its connection.
+
+        Args:
+            vdev (VirtualDevice): The device.
+        """
+        begin = time.monotonic()
+        try:
+            await asyncio.wait_for(
+                vdev.connect(self.host, self.port, self.creds, self.crypto),
+                CONNECT_TIMEOUT,
+            )
+        except (OSError, ConnectionError, asyncio.TimeoutError) as e:
+            reason = type(e).__name__
+            self.failures[reason] = self.failures.get(reason, 0) + 1
+            vdev.close()
+            return
+
+        self.connect_latencies.append(time.monotonic() - begin)
+        self._serving.append(asyncio.ensure_future(self._serve(vdev)))
+
+    async def _serve(self, vdev):
+        """
+        Serve the connection of a device until it is closed.
+
+        Args:
+            vdev (VirtualDevice): The device.
+        """
+        self.connected += 1
+        try:
+            await vdev.serve()
+        except Exception as e:  # pylint: disable=broad-except
+            logging.error(
+                "Error serving %s: %s",
+                vdev.device.identifier,
+                e,
+                exc_info=True,
+            )
+        finally:
+            self.connected -= 1
+            vdev.close()
+
+    async def _sense_loop(self):
+        """
+        Simulate data updates to the sensors of the connected devices at regular intervals. The
+        ticks are kept on a fixed-rate grid (as in scheduler.py), so a slow tick doesn't make the
+        following ones drift, and ticks missed entirely are skipped.
+        """
+        loop = asyncio.get_running_loop()
+        due = loop.time()
+        while True:
+            due += self.sense_interval
+            now = loop.time()
+            if due <= now:
+                due += ((now - due) // self.sense_interval + 1) * self.sense_interval
+            await asyncio.sleep(due - now)
+
+            self.fleet.tick()
+            for vdev in self.devices:
+                if vdev.connected and vdev.subscription.active:
+                    vdev.push()
+
+    def summary(self):
+        """
+        Build a summary of the fleet's connections.
+
+        Returns:
+            dict: Number of devices, connected devices and failed connections (in total and by
+            reason), and the p50/p90/p99/max connection latency (in milliseconds).
+        """
+        latencies = sorted(latency * 1000 for latency in self.connect_latencies)
+        summary = {
+            "devices": len(self.devices),
+            "connected": self.connected,
+            "failed": sum(self.failures.values()),
+            "failures": dict(self.failures),
+        }
+        for name, pct in (("p50_ms", 50), ("p90_ms", 90), ("p99_ms", 99), ("max_ms", 100)):
+            value = percentile(latencies, pct)
+            summary[name] = round(value, 2) if value is not None else None
+        return summary
+
+
+def main():
+    """Parse the command line, load the keys and credentials and run the fleet."""
+    parser = argparse.ArgumentParser(
+        description="Simulate a fleet of devices connecting to the HUB"
+    )
+    parser.add_argument("--devices", type=int, default=DEFAULT_DEVICES, help="number of devices")
+    parser.add_argument(
+        "--mix", default=DEFAULT_MIX, help="device types and weights, e.g. SmartLight=3,SmartLock=1"
+    )
+    parser.add_argument(
+        "--ramp-up", type=float, default=RAMP_UP_RATE, help="devices connecting per second"
+    )
+    parser.add_argument("--prefix", default="Sim", help="prefix of the device identifiers")
+    parser.add_argument("--host", default=HUB_HOST, help="address of the HUB")
+    parser.add_argument("--port", type=int, default=HUB_PORT, help="port of the HUB")
+    parser.add_argument(
+        "--duration", type=float, default=None, help="seconds to run for (default: until Ctrl+C)"
+    )
+    parser.add_argument(
+        "--sense-interval",
+        type=float,
+        default=device_service.SENSE_INTERVAL,
+        help="seconds between sensor data updates",
+    )
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.devices < 1 or args.ramp_up <= 0:
+        parser.error("--devices and --ramp-up must be positive")
+
+    # Load the keys and credentials the same way device_service.py does
+    fer_key = utils.load_fernet_key("./Secrets/dev_enc.key")
+    hub_pub_key = utils.load_public_key("./Secrets/hub_pub.key")
+    if hub_pub_key is None or fer_key is None:
+        print("\n\nERROR: key(s) not found. Please generate them by running './initialise.py'")
+        print("Exiting...")
+        exit(1)
+    creds = utils.load_and_decrypt_fernet(fer_key, "./Secrets/creds.bin")
+
+    # Every connection is a file descriptor, and a fleet's requests aren't worth printing one by one
+    raise_open_files_limit()
+    device_service.PRINT_REQUESTS = False
+
+    simulator = FleetSimulator(
+        build_fleet(args.devices, mix, args.prefix),
+        args.host,
+        args.port,
+        creds,
+        utils.CryptoContext(public_key=hub_pub_key),
+        ramp_up=args.ramp_up,
+        sense_interval=args.sense_interval,
+    )
+
+    print(f"Connecting {args.devices} devices at {args.ramp_up:g} per second...")
+    try:
+        asyncio.run(simulator.run(args.duration))
+    except KeyboardInterrupt:
+        pass
+    print(f"Fleet stopped: {simulator.summary()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Module with helper functions and classes for sending and receiving length-prefixed frames over a
+socket. TCP is a byte stream, so one recv() call can return part of a message or several messages
+at once; every frame is therefore sent as a 4-byte big-endian length followed by the payload, and
+read back through a buffered FrameReader that reassembles partial reads and splits pipelined frames
+(or through read_frame() for asyncio streams)
+"""
+
+import asyncio
+import struct
+
+# 4-byte unsigned big-endian payload length in front of every frame
+HEADER = struct.Struct("!I")
+
+# Frames larger than this are refused by default, so a corrupt or hostile length can't make the
+# reader allocate huge buffers
+DEFAULT_MAX_FRAME_SIZE = 64 * 1024
+
+# Number of bytes requested from the socket per recv() call
+RECV_SIZE = 64 * 1024
+
+
+class FrameError(Exception):
+    """Raised when a frame is larger than the allowed maximum frame size."""
+
+
+def pack_frame(payload, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+    """
+    Prefix a payload with its length.
+
+    Args:
+        payload (bytes): The payload of the frame. max_frame_size (int): The largest allowed payload
+        size.
+
+    Returns:
+        bytes: The length header followed by the payload.
+    """
+    if len(payload) > max_frame_size:
+        raise FrameError(
+            f"Frame of {len(payload)} bytes exceeds maximum of {max_frame_size} bytes"
+        )
+    return HEADER.pack(len(payload)) + payload
+
+
+def send_frame(sock, payload, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+    """
+    Send a single frame through a socket.
+
+    Args:
+        sock (socket): The socket to send the frame through. payload (bytes): The payload of the
+        frame. max_frame_size (int): The largest allowed payload size.
+    """
+    sock.sendall(pack_frame(payload, max_frame_size))
+
+
+def send_frames(sock, payloads, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+    """
+    Send several frames through a socket. The frames are joined up first so that many small frames
+    go out in a single send call rather than one call each.
+
+    Args:
+        sock (socket): The socket to send the frames through. payloads (iterable): The payloads of
+        the frames (bytes). max_frame_size (int): The largest allowed payload size.
+    """
+    sock.sendall(b"".join(pack_frame(p, max_frame_size) for p in payloads))
+
+
+class FrameReader:
+    """
+    The FrameReader class reads length-prefixed frames from a socket. Received bytes are kept in a
+    buffer, so a frame split across several recv() calls is reassembled and several frames received
+    in one recv() call are handed out one at a time.
+
+    Attributes:
+        sock (socket): The socket to read from (may be None if data is only fed in with feed()).
+        max_frame_size (int): The largest allowed payload size.
+
+    Example usage:
+        reader = FrameReader(sock) payload = reader.recv_frame()
+    """
+
+    def __init__(self, sock=None, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+        """Initialize a new FrameReader instance."""
+        self.sock = sock
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Add received bytes to the buffer.
+
+        Args:
+            data (bytes): The bytes received.
+        """
+        self._buffer += data
+
+    def next_frame(self):
+        """
+        Take the next complete frame out of the buffer.
+
+        Returns:
+            bytes: The payload of the next frame, or None if no complete frame has been buffered yet.
+        """
+        if len(self._buffer) < HEADER.size:
+            return None
+
+        (length,) = HEADER.unpack_from(self._buffer)
+        if length > self.max_frame_size:
+            raise FrameError(
+                f"Frame of {length} bytes exceeds maximum of {self.max_frame_size} bytes"
+            )
+
+        end = HEADER.size + length
+        if len(self._buffer) < end:
+            return None
+
+        payload = bytes(self._buffer[HEADER.size : end])
+        del self._buffer[:end]
+        return payload
+
+    def recv_frame(self):
+        """
+        Read the next complete frame from the socket, waiting for more data as needed.
+
+        Returns:
+            bytes: The payload of the frame, or None if the connection was closed.
+        """
+        while True:
+            payload = self.next_frame()
+            if payload is not None:
+                return payload
+
+            data = self.sock.recv(RECV_SIZE)
+
+            # If the other end has disconnected, there is no frame to return
+            if not data:
+                return None
+
+            self.feed(data)
+
+
+async def read_frame(stream, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+    """
+    Read the next complete frame from an asyncio stream.
+
+    Args:
+        stream (asyncio.StreamReader): The stream to read from. max_frame_size (int): The largest
+        allowed payload size.
+
+    Returns:
+        bytes: The payload of the frame, or None if the connection was closed.
+    """
+    try:
+        header = await stream.readexactly(HEADER.size)
+        (length,) = HEADER.unpack(header)
+        if length > max_frame_size:
+            raise FrameError(
+                f"Frame of {length} bytes exceeds maximum of {max_frame_size} bytes"
+            )
+        return await stream.readexactly(length)
+
+    except asyncio.IncompleteReadError:
+        return None
+
+
+def write_frame(writer, payload, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+    """
+    Queue a single frame on an asyncio stream writer. The caller drains the writer.
+
+    Args:
+        writer (asyncio.StreamWriter): The stream to write to. payload (bytes): The payload of the
+        frame. max_frame_size (int): The largest allowed payload size.
+    """
+    writer.write(pack_frame(payload, max_frame_size))
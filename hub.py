@@ -3,107 +3,141 @@ This module is the main HUB. It does the following: 1. It runs a server that lis
 connections from devices 2. When a device connects, it checks to see if it is registered; if not it
 registers it 3. It acts as a keypad / user interface with which the user can access functions on
 connected devices
+
+The device connections themselves are served by the asyncio engine in hub_server.py; the menu runs
+in its own thread and sends its commands through the engine's thread-safe API
 """
 
+import asyncio
 import json
-import socket
 import threading
+import time
 
+import hub_server
+import registry_store
+import rules
+import telemetry
+import timeseries
 import utils
+from device_registry import DeviceRegistry
+
+# Maximum number of rows of the reading history shown by the menu
+HISTORY_ROWS = 60
+
+# Number of seconds a device gets to answer the action of a rule that fired
+RULE_TIMEOUT = 5.0
+
+# "Get device readings" accepts readings received from the device up to this many seconds ago
+# (pushed or polled) instead of asking the device again
+READINGS_MAX_AGE = 2.0
 
 
-def handle_device(device_socket, device_address):
+def register_device(deviceid):
     """
-    Handles incoming connection requests from devices
+    Helper function called by the HUB server whenever a new device registers. Queues the device to
+    be saved to disk in encrypted format by the write-behind persister, so the device doesn't wait
+    for the disk.
 
     Args:
-        device_socket (Socket object): Socket object of the connecting device. device_address (str):
-        Address from which the device connected.
+        deviceid (str): The device id of the newly registered device.
+    """
+    persister.submit(deviceid, device_list.get(deviceid)["devtype"])
 
-    Returns:
-        Null
+
+def registry_saved(count, saved):
     """
+    Helper function called by the write-behind persister after it has saved registry changes.
 
-    # Read the incoming message from the connected device socket
-    request = device_socket.recv(1024)
-
-    # If the device has disconnected, break out
-    if not request:
-        return
-
-    # Decrypt the message using the utils.decrypt_message function
-    request_data = utils.decrypt_message(request, hub_private_key)
-
-    # If the message contains the 'action' field and the credentials sent through by the device are
-    # correct
-    if (
-        "action" in request_data
-        and request_data["user"] == SERVER_USER
-        and request_data["pass"] == SERVER_PASS
-    ):
-        # Get the 'devid' (device id) field in the message
-        deviceid = request_data["devid"]
-
-        # If the device id is not registered
-        if deviceid not in device_list:
-            print(
-                f"\nNew {request_data['devtype']} device connected with identifier {deviceid}"
-                + f" from {device_address}"
-            )
-
-            # Register the device info in the device_list dict Device info stored include the device
-            # id, device socket and device type
-            device_list[deviceid] = {
-                "socket": device_socket,
-                "devtype": request_data["devtype"],
-            }
-
-            print("Device registered")
-
-            # Call the save_device_list function to save the device_list dict to disk in encrypted
-            # format
-            if save_device_list():
-                # If the operation succeeds, inform user
-                print("Device list saved to disk")
-            else:
-                # If not successful, inform user
-                print("Unable to save device list to disk")
-
-        else:  # Otherwise (if the device id IS registered)
-            # Obtain the registered device's socket and device type and update these in the
-            # device_list dict
-            device_list[deviceid] = {
-                "socket": device_socket,
-                "devtype": request_data["devtype"],
-            }
-            print(
-                f"Registered {request_data['devtype']} device {deviceid} connected from "
-                + f"{device_address}."
-            )
-
-        # Send a (secure encrypted) message to the device through its socket informing it that
-        # connection was successful
-        msg = {"result": "success"}
-        utils.send_encrypted_message(device_socket, msg, dev_public_key)
-
-    # Otherwise (if the message DID NOT contain the 'action' field OR the credentials sent through
-    # by the device are incorrect
+    Args:
+        count (int): Number of devices saved. saved (bool): Whether saving worked.
+    """
+    if saved:
+        # If the operation succeeds, inform user
+        print(f"Device list saved to disk ({count} changes)")
     else:
-        print(
-            f"Connection request from {device_address} invalid (credentials invalid or didn't "
-            + "make connection request)"
-        )
-        # Send a (secure encrypted) message to the device through its socket informing it of failure
-        msg = {"result": "failure"}
-        utils.send_encrypted_message(device_socket, msg, dev_public_key)
+        # If not successful, inform user
+        print(f"Unable to save device list to disk ({count} changes)")
+
+
+def record_telemetry(deviceid, readings):
+    """
+    Helper function called by the HUB server whenever readings are received from a device. Writes
+    the readings to the device type's telemetry segment on disk.
+
+    Args:
+        deviceid (str): The device id. readings (dict): The readings.
+    """
+    entry = device_list.get(deviceid)
+    if entry is not None:
+        telemetry_store.record(deviceid, entry["devtype"], readings)
+
+
+def fire_rule(rule):
+    """
+    Helper function called by the rules engine (in the HUB server's event loop) whenever a rule
+    fires. Sends the rule's action to its target device without waiting for the response.
+
+    Args:
+        rule (Rule): The rule that fired.
+    """
+    asyncio.ensure_future(send_rule_action(rule))
 
-        # Reject the connection and just break out
-        return
+
+async def send_rule_action(rule):
+    """
+    Send the action of a rule that fired to its target device and display the result.
+
+    Args:
+        rule (Rule): The rule that fired.
+    """
+    try:
+        reply = await server.request(rule.target, rule.message(), RULE_TIMEOUT)
+        result = reply.get("result")
+    except asyncio.TimeoutError:
+        result = "timed out"
+    except ConnectionError:
+        result = "unable to connect to the device"
+    print(f"\nRule '{rule}' fired: {result}")
+
+
+def show_rules():
+    """
+    Helper function that displays the automation rules (and how many times each has fired), then
+    asks for a new rule to add. New rules are also appended to the rules file.
+
+    Returns:
+        str: Message to be displayed to the user.
+    """
+    print("Automation rules:")
+    listing = [f"{rule} (fired {rule.fired} times)" for rule in list(rule_engine.rules)]
+    print("\n".join(listing) if listing else "--None--")
+
+    text = input(
+        "\nNew rule (e.g. 'if Motion1.motion >= threshold then Light1 set_on', leave blank to"
+        " keep the rules as they are): "
+    ).strip()
+    if not text:
+        return "No rule added"
+
+    # Check the rule here, so that mistakes are reported to the user; the engine itself is only
+    # used from the HUB server's event loop
+    try:
+        rules.Rule(text)
+    except ValueError as e:
+        return str(e)
+    server.loop.call_soon_threadsafe(rule_engine.add, text)
+
+    try:
+        with open(rules.RULES_FILE, "a", encoding="utf-8") as rules_file:
+            rules_file.write(text + "\n")
+    except OSError as e:
+        return f"Rule added, but unable to save it to {rules.RULES_FILE}: {e}"
+    return "Rule added"
 
 
 def list_all_devices(connected=False):
     """
-    Helper function that returns a text list of (connected) devices in the device_list dict.
+    Helper function that returns a text list of (connected) devices in the device_list registry.
 
     Args:
         connected (bool): Whether or not to return connected devices only (or otherwise ALL
@@ -113,16 +147,9 @@ def list_all_devices(connected=False):
         str: Numbered list of devices in format "[num]: deviceid" OR "--None--".
     """
 
-    # If displaying connected devices only
-    if connected:
-        # Generate a list of keys of the devices that have actual sockets (as opposed to having
-        # None)
-        devlistkeys = [
-            k for k in device_list.keys() if device_list[k]["socket"] is not None
-        ]
-    else:
-        # Generate a list of keys of all the devices in the list
-        devlistkeys = list(device_list.keys())
+    # Get a snapshot of the keys of the (connected) devices. The registry keeps an index of the
+    # connected devices, so this doesn't scan every registered device
+    devlistkeys = device_list.ids(connected=connected)
 
     # Use the device keys list to generate a list of strings in the format num: deviceid
     devlist = [f"{ind}: {k}" for ind, k in enumerate(devlistkeys)]
@@ -138,9 +165,9 @@ def list_all_devices(connected=False):
 
 def list_devices_get_selection(displayall=False):
     """
-    Helper function that: 1. Displays a numbered list of connected devices in the device_list dict,
-    and optionally also a final option in the list "ALL" referring to all devices; 2. Get and return
-    the option selected
+    Helper function that: 1. Displays a numbered list of connected devices in the device_list
+    registry, and optionally also a final option in the list "ALL" referring to all devices; 2. Get
+    and return the option selected
 
     Args:
         displayall (bool): Whether or not to display an option "ALL" in the list referring to all
@@ -153,17 +180,16 @@ def list_devices_get_selection(displayall=False):
             encountered, to be displayed to user
     """
 
-    # Generate a list of the keys of all connected devices i.e. devices that have a valid socket
-    devlistkeysconn = [
-        k for k in device_list.keys() if device_list[k]["socket"] is not None
-    ]
+    # Get a list of the keys of all connected devices i.e. devices that have a connection. This is a
+    # snapshot, so it doesn't change while the user is picking a device
+    devlistkeysconn = list(device_list.ids(connected=True))
 
     # If there are no items in the connected devices keys list, bail out
     if not devlistkeysconn:
         return None, None, None, "No connected devices"
 
     # Using the connected device keys, generate a list of the actual devices
-    devlistconn = [device_list[k] for k in devlistkeysconn]
+    devlistconn = [device_list.get(k) for k in devlistkeysconn]
 
     # Display the devices list to the screen
     print("\nConnected Devices (please select one):")
@@ -213,6 +239,68 @@ def list_devices_get_selection(displayall=False):
     return devopt, devlistconn, devlistkeysconn, "Success"
 
 
+def show_history():
+    """
+    Helper function that asks for a device with recorded readings and a window of time, and returns
+    a table of the min/max/mean of each numeric reading of the device per time bucket (using the
+    finest rollup tier that covers the window with at most HISTORY_ROWS rows).
+
+    Returns:
+        str: The table, or a message explaining why there is nothing to show.
+    """
+    devids = sorted(history.devices())
+    if not devids:
+        return "No readings recorded yet"
+
+    print("\nDevices with readings (please select one):")
+    print("\n".join([f"{ind}: {k}" for ind, k in enumerate(devids)]))
+    try:
+        devid = devids[int(input("\nSelected device: ").strip())]
+        minutes = float(input("Window in minutes (leave blank for the last hour): ").strip() or 60)
+    except (ValueError, IndexError):
+        return "Invalid input"
+    if minutes <= 0:
+        return "Invalid input"
+
+    # Pick the finest resolution that fits the window in HISTORY_ROWS rows (or the coarsest one)
+    window = minutes * 60
+    resolutions = history.resolutions()
+    resolution = next((r for r in resolutions if window / r <= HISTORY_ROWS), resolutions[-1])
+
+    rollup = history.rollup(devid, resolution, start=time.time() - window)
+    fields = [field for field in rollup if field != "time"]
+    if not len(rollup["time"]):
+        return "No readings in this window"
+
+    lines = [f"{devid}, per {resolution // 60} minute(s) (min/max/mean):"]
+    for row, bucket in enumerate(rollup["time"]):
+        stats = []
+        for field in fields:
+            if rollup[field]["count"][row]:
+                low, high, mean = (rollup[field][stat][row] for stat in ("min", "max", "mean"))
+                stats.append(f"{field} {low:g}/{high:g}/{mean:.2f}")
+        lines.append(time.strftime("%H:%M", time.localtime(bucket)) + "  " + ", ".join(stats))
+    return "\n".join(lines)
+
+
+def yes_no_any(answer):
+    """
+    Helper function that turns a y/n answer into a query criterion.
+
+    Args:
+        answer (str): The user's answer.
+
+    Returns:
+        bool: True for yes, False for no, or None (any) for anything else.
+    """
+    answer = answer.lower().strip()
+    if answer in ("y", "yes"):
+        return True
+    if answer in ("n", "no"):
+        return False
+    return None
+
+
 def send_msg_get_response(msg, devopt, devlistconn, devlistkeysconn):
     """
     Helper function that sends a given message to a given device and retrieves its response.
@@ -229,33 +317,17 @@ def send_msg_get_response(msg, devopt, devlistconn, devlistkeysconn):
         Error message if encountered.
     """
 
-    # Use the utils.send_encrypted_message function to send the message msg to the device socket If
-    # that fails, bail out with error message
-    if not utils.send_encrypted_message(
-        devlistconn[devopt]["socket"], msg, dev_public_key
-    ):
-        return None, "Failed to send message to device"
-
     try:
-        # Attempt to read from the device
-        request = devlistconn[devopt]["socket"].recv(1024)
-
-        # If the read is not successful, set the device socket in the device_list to None i.e. not
-        # connected Also, bail out with error message
-        if not request:
-            device_list[devlistkeysconn[devopt]]["socket"] = None
-            return None, "Unable to connect to the device. Aborting..."
+        # Use the HUB server to send the message msg to the device and wait for its response
+        request_data = server.call(devlistkeysconn[devopt], msg)
 
     except:
-        # If anything goes wrong, bail out with error message
+        # If the device has disconnected or anything else goes wrong, bail out with error message
+        # (the server will already have marked the device as not connected)
         return None, "Unable to connect to the device. Aborting..."
 
-    # Ok great; message was received from the device successfully... Use utils.decrypt_message to
-    # decrypt incoming message
-    request_data = utils.decrypt_message(request, hub_private_key)
-
     # If the message for some reason doesn't contain a result field, bail out with error message
-    if not "result" in request_data:
+    if not request_data or not "result" in request_data:
         return None, "Message not understood..."
 
     # Otherwise (if all is well) return the result field of the response from the device
@@ -280,10 +352,17 @@ def menu_interface():
     menu["condev"] = "List connected devices"
     menu["devread"] = "Get device readings"
     menu["thres"] = "Set device threshold"
+    menu["conf"] = "Configure device (set threshold, activate and switch on)"
     menu["act"] = "Activate device"
     menu["deact"] = "Deactivate device"
     menu["on"] = "Switch on device"
     menu["off"] = "Switch off device"
+    menu["sub"] = "Subscribe to device telemetry"
+    menu["unsub"] = "Unsubscribe from device telemetry"
+    menu["live"] = "Show live device readings"
+    menu["find"] = "Find devices (by type, connection, status or threshold)"
+    menu["hist"] = "Show device reading history"
+    menu["rules"] = "Show / add automation rules"
     menu["disc"] = "Disconnect device from HUB"
     menu["quit"] = "Quit"
 
@@ -386,8 +465,97 @@ def menu_interface():
                 # Great; display the result of the operation received by the device
                 print("Result: " + result)
 
+            elif choicekey == "conf":
+                # Option to fully configure a specific device in one go
+
+                # Display connected devices and get user's selection of a device
+                (
+                    devopt,
+                    devlistconn,
+                    devlistkeysconn,
+                    resmsg,
+                ) = list_devices_get_selection()
+                if not devlistconn:
+                    print(resmsg)
+                    continue
+
+                # Read in the user's desired threshold value, or complain and bail out
+                thres = input("Specify threshold: ")
+                try:
+                    thres = int(thres.lower().strip())
+                except ValueError:
+                    print("Invalid input")
+                    continue
+
+                # Build a single batch message carrying all three actions, so that the device is
+                # configured in one round trip
+                msg = {
+                    "action": "batch",
+                    "actions": [
+                        {"action": "set_thres", "value": thres},
+                        {"action": "set_activate"},
+                        {"action": "set_on"},
+                    ],
+                }
+
+                result, errmsg = send_msg_get_response(
+                    msg, devopt, devlistconn, devlistkeysconn
+                )
+                if not result:
+                    print(errmsg)
+                    continue
+
+                # Display the result of each of the actions
+                print("Result: " + json.dumps(result))
+
             # Otherwise, if the chosen action is any of the ones in the list below
-            elif choicekey in ["devread", "act", "deact", "on", "off", "disc"]:
+            elif choicekey == "live":
+                # Display the latest readings received from each device, pushed or polled, along
+                # with how long ago they were received
+                print("Live readings:")
+                if not server.live_view:
+                    print("--None--")
+                now = time.time()
+                for devid, view in list(server.live_view.items()):
+                    age = now - view["time"]
+                    print(f"{devid} ({age:.1f}s ago): " + json.dumps(view["readings"]))
+
+            elif choicekey == "find":
+                # Ask for the criteria, leaving any of them blank to match all devices. The status
+                # and threshold criteria use the latest readings received from each device
+                devtype = input("Device type (e.g. Thermostat, blank for any): ").strip()
+                connected = input("Connected devices only (y/n, blank for any): ")
+                status = input("Status (active/inactive, blank for any): ").strip()
+                over = input("Readings at or over threshold (y/n, blank for any): ")
+
+                found = device_list.query(
+                    devtype=devtype or None,
+                    connected=yes_no_any(connected),
+                    status=status or None,
+                    over=yes_no_any(over),
+                )
+                print("Devices found:")
+                print("\n".join(found) if found else "--None--")
+
+            elif choicekey == "rules":
+                # Display the automation rules and optionally add a new one
+                print(show_rules())
+
+            elif choicekey == "hist":
+                # Display the min/max/mean of each numeric reading of a device over a time window,
+                # taken from the rollups of the time-series store
+                print(show_history())
+
+            elif choicekey in [
+                "devread",
+                "act",
+                "deact",
+                "on",
+                "off",
+                "sub",
+                "unsub",
+                "disc",
+            ]:
                 # So for all these actions, the sequence is the same:
                 # 1.  We'll build a message
                 # 2.  We'll display a list of connected devices and get the user's selection (which
@@ -397,16 +565,32 @@ def menu_interface():
 
                 # Build a dict of the specific messages for each action
                 msgs = {
-                    "devread": {"action": "get_readings"},
+                    "devread": {"action": "get_readings", "max_age": READINGS_MAX_AGE},
                     "act": {"action": "set_activate"},
                     "deact": {"action": "set_deactivate"},
                     "on": {"action": "set_on"},
                     "off": {"action": "set_off"},
+                    "sub": hub_server.subscribe_msg(),
+                    "unsub": {"action": "unsubscribe"},
                     "disc": {"action": "set_disconnect"},
                 }
                 # Get the message for this specific message
                 msg = msgs[choicekey]
 
+                # For subscriptions, read in how often the devices should push their readings. The
+                # message is the one HubServer.subscribe() sends, so the readings are pushed as
+                # deltas
+                if choicekey == "sub":
+                    interval = input(
+                        "Push interval in seconds (leave blank to push on every change): "
+                    )
+                    try:
+                        interval = float(interval) if interval.strip() else None
+                    except ValueError:
+                        print("Invalid input")
+                        continue
+                    msg = hub_server.subscribe_msg(interval)
+
                 # Display a list of connected devices and get the user's selection which can also be
                 # ALL
                 (
@@ -437,52 +621,40 @@ def menu_interface():
                     # Display the result from the device
                     print("Result: " + json.dumps(result))
 
-                    # If this was a disconnection operation then also set the associated device's
-                    # socket to None in the device_list, meaning disconnected
+                    # If this was a disconnection operation then also close the associated device's
+                    # connection, which marks it as disconnected in the device_list
                     if choicekey == "disc":
-                        device_list[devlistkeysconn[devopt]]["socket"] = None
+                        server.disconnect(devlistkeysconn[devopt])
 
                 else:
-                    # For every device in the connected devices list
-                    for ind in range(len(devlistconn)):
-                        # Use the send_msg_get_response function to send the secure message to this
-                        # device and get its response
-                        result, errmsg = send_msg_get_response(
-                            msg, ind, devlistconn, devlistkeysconn
-                        )
-
-                        # If nothing returned in the list (which could also mean that something went
-                        # wrong in the function) Display the returned error message
-                        if not result:
-                            print(errmsg)
+                    # Send the message to every device in the connected devices list at the same
+                    # time; each device's result is displayed as soon as it arrives
+                    results = []
+                    for res in server.broadcast_iter(devlistkeysconn, msg):
+                        results.append(res)
+
+                        # If the device didn't respond properly, display what went wrong
+                        if res.error or "result" not in res.reply:
+                            print(f"{res.deviceid}: {res.error or 'Message not understood...'}")
                             continue
 
                         # Display this device's result
-                        print(f"{devlistkeysconn[ind]} result: " + json.dumps(result))
+                        print(f"{res.deviceid} result: " + json.dumps(res.reply["result"]))
 
-                        # If this was a disconnection operation then also set the associated
-                        # device's socket to None in the device_list, meaning disconnected
+                        # If this was a disconnection operation then also close the associated
+                        # device's connection, which marks it as disconnected in the device_list
                         if choicekey == "disc":
-                            # device_list[devlistkeysconn[devopt]]["socket"].close()
-                            device_list[devlistkeysconn[ind]]["socket"] = None
+                            server.disconnect(res.deviceid)
+
+                    # Display the summary of the whole operation
+                    print("Summary: " + json.dumps(hub_server.summarize_broadcast(results)))
 
             # Quit option
             elif choicekey == "quit":
                 print("Quiting...")
 
-                # Code below: get a list of all devices that are connected i.e. socket is not None
-                # Then loop through them and close() them
-                devlistkeys = [
-                    k
-                    for k in device_list.keys()
-                    if device_list[k]["socket"] is not None
-                ]
-                devlist = [device_list[k] for k in devlistkeys]
-                for dev in devlist:
-                    dev["socket"].close()
-
-                # And finally, close the hub's connection as well
-                hub.close()
+                # Close the connections of all connected devices and the HUB server itself
+                server.shutdown()
                 # Break out of the while loop
                 break
         except:
@@ -491,52 +663,28 @@ def menu_interface():
 
 def load_device_list():
     """
-    Helper function that loads and decrypts the device_list from disk (which would contain the
-    device ids and device types), and builds and returns a dict of ALL registered devices where each
-    device's key is its device id, and each entry is itself a dict containing fields 'socket' which
-    is initially None, and devtype which is the device type. E.g. might be something like (so you
-    can visualize it): { 'smartlight1': {'socket':None, 'devtype':'SmartLight'}, 'motionsensor2':
-    {'socket':None, 'devtype':'MotionSensor'} }
+    Helper function that loads and decrypts the device registry from disk (which would contain the
+    device ids and device types), and builds and returns a DeviceRegistry of ALL registered devices
+    where each device's key is its device id, and each entry is itself a dict containing fields
+    'conn' which is initially None, and devtype which is the device type. E.g. might be something
+    like (so you can visualize it): { 'smartlight1': {'conn':None, 'devtype':'SmartLight'},
+    'motionsensor2': {'conn':None, 'devtype':'MotionSensor'} }
 
+    A device list saved by older versions of the HUB ('./stored_devices.bin') is migrated to the
+    registry log the first time.
 
     Args:
         None.
 
     Returns:
-        dict: Either dict of all registered devices or {}
+        DeviceRegistry: Registry of all registered devices (which may be empty)
     """
 
-    # Load and decrypt device list from disk.
-    devlist = utils.load_and_decrypt_fernet(fer_key, "./stored_devices.bin")
-
-    if not devlist:
-        # If the list is empty i.e. either file not found or list is empty, return empty dict
-        return {}
+    # Load and decrypt the device registry from disk.
+    devlist = store.load(registry_store.LEGACY_REGISTRY_FILE)
 
     # Build the list as specified above
-    return {k: {"socket": None, "devtype": devlist[k]["devtype"]} for k in devlist}
-
-
-def save_device_list():
-    """
-    Helper function that builds, encrypts and saves and a dict of ALL registered devices where each
-    device's key is its device id, and associated value is the devtype which is the device type.
-    E.g. might be something like (so you can visualize it): { 'smartlight1': 'SmartLight',
-    'motionsensor2': 'MotionSensor' }
-
-    Args:
-        Nothing.
-
-    Returns:
-        Result of the save operation.
-    """
-
-    # Build dict to save
-    devlist = {k: {"devtype": device_list[k]["devtype"]} for k in device_list.keys()}
-
-    # Call the utils.encrypt_and_save_fernet function to encrypt and save the dict to disk and
-    # return its value
-    return utils.encrypt_and_save_fernet(devlist, fer_key, "./stored_devices.bin")
+    return DeviceRegistry(devlist)
 
 
 if __name__ == "__main__":
@@ -562,12 +710,13 @@ if __name__ == "__main__":
     print(
         "They will be loaded from file by hub and devices and used for communications"
     )
-    # Load the HUB private key for decryption of communications
+    # Load the HUB private key for unwrapping the session keys sent by connecting devices
     _, hub_private_key = utils.load_keys(None, "./Secrets/hub_prv.key")
-    # Load the device public key for encryption of communications
-    dev_public_key, _ = utils.load_keys("./Secrets/dev_pub.key", None)
     # Load the fernet key for enc/decryption of the saved devices list
     fer_key = utils.load_fernet_key("./Secrets/dev_enc.key")
+    # Load the HUB's own fernet key for encrypting the telemetry segments at rest (if there isn't
+    # one, the segments are kept unencrypted)
+    hub_fer_key = utils.load_fernet_key("./Secrets/hub_enc.key")
 
     # Check to make sure that the keys are not None which means either they weren't found or
     # couldn't be loaded for whatever reason, meaning nothing can continue; no keys, no HUB
@@ -575,9 +724,6 @@ if __name__ == "__main__":
         assert (
             hub_private_key is not None
         ), "No HUB private key found. Please generate it by running './initialise.py'"
-        assert (
-            dev_public_key is not None
-        ), "No device public key found. Please generate it by running './initialise.py'"
         assert (
             fer_key is not None
         ), "No encryption key found. Please generate it by running './initialise.py'"
@@ -586,29 +732,51 @@ if __name__ == "__main__":
         print("Exiting...")
         exit(1)
 
-    # Load the device list
+    # Load the device list. Changes to it are saved in the background by the write-behind
+    # persister
+    store = registry_store.RegistryStore(registry_store.REGISTRY_FILE, fer_key)
     device_list = load_device_list()
+    persister = registry_store.WriteBehindPersister(store, on_flush=registry_saved)
+
+    # Set up the HUB server. All device connections are served by its event loop, and newly
+    # registered devices are saved to disk through the register_device function
+    hub_server.raise_open_files_limit()
+    server = hub_server.HubServer(
+        hub_private_key,
+        {"user": SERVER_USER, "pass": SERVER_PASS},
+        device_list,
+        on_register=register_device,
+    )
 
-    # Start the menu interface in a separate thread
-    menu_thread = threading.Thread(target=menu_interface)
-    menu_thread.daemon = True
-    menu_thread.start()
+    # Record every reading received (pushed or polled) in the time-series store, for the history
+    history = timeseries.TimeSeriesStore()
+    server.readings_listeners.append(history.record)
 
-    # Use socket to set up this HUB server
-    hub = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    hub.bind(("127.0.0.1", 8080))
-    hub.listen(5)
+    # Also write every reading to the on-disk telemetry segments, for the longer-term history
+    telemetry_store = telemetry.TelemetryStore(telemetry.TELEMETRY_DIR, hub_fer_key)
+    server.readings_listeners.append(record_telemetry)
 
-    # Continuously wait for client connection requests and handle them appropriately
-    while True:
-        try:
-            client_socket, client_address = hub.accept()
-
-            # Message received; create a new thread and handover this request to the handle_device
-            # function to handle it
-            device_thread = threading.Thread(
-                target=handle_device, args=(client_socket, client_address)
-            )
-            device_thread.start()
-        except:
-            break
+    # Evaluate the automation rules on every reading received; only the rules using the readings
+    # that changed are evaluated
+    rule_engine = rules.RuleEngine(on_fire=fire_rule)
+    rule_engine.load(rules.RULES_FILE)
+    server.readings_listeners.append(rule_engine.update)
+
+    async def run_hub():
+        """Start the HUB server, then the menu interface, and serve until the user quits."""
+        await server.start()
+
+        # Start the menu interface in a separate thread
+        menu_thread = threading.Thread(target=menu_interface)
+        menu_thread.daemon = True
+        menu_thread.start()
+
+        # Continuously wait for device connection requests and handle them appropriately
+        await server.serve_forever()
+
+    try:
+        asyncio.run(run_hub())
+    finally:
+        # Save whatever registry changes are still waiting, and seal the telemetry segments
+        persister.close()
+        telemetry_store.close()
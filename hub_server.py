@@ -0,0 +1,826 @@
+"""
+This module is the asyncio server engine of the HUB. Instead of one thread per connected device, all
+device connections are served by a single event loop: 1. Each device connection is a pair of asyncio
+streams wrapped in a DeviceConnection 2. The RSA handshake is run in a small thread pool so that it
+doesn't stall the event loop 3. Other threads (e.g. the HUB menu) send commands to devices through
+the thread-safe HubServer.call() function
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import math
+import queue
+import time
+
+import codec
+import framing
+import utils
+from delta import DeltaMerger
+
+# Set logging level to logging.ERROR to view error logs
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+# Default address the HUB listens on
+HUB_HOST = "127.0.0.1"
+HUB_PORT = 8080
+
+# Length of the queue of connections waiting to be accepted
+LISTEN_BACKLOG = 1024
+
+# Number of threads used for the RSA handshake and other blocking work
+CRYPTO_WORKERS = 2
+
+# Default number of seconds each device gets to answer a broadcast message
+BROADCAST_TIMEOUT = 5.0
+
+# Default number of seconds a device gets to answer any other request (and to send its connection
+# message once connected), so that a dead device never blocks the caller for good
+REQUEST_TIMEOUT = 10.0
+
+# Cached readings of a device (see HubServer.cached_readings()) are never served once they are older
+# than this many seconds, whatever max_age a get_readings request accepts
+STATE_TTL = 30.0
+
+# Result of sending a broadcast message to one device. reply is the decrypted response (or None),
+# error is None or a short description of what went wrong, latency is in seconds
+BroadcastResult = collections.namedtuple(
+    "BroadcastResult", ["deviceid", "reply", "error", "latency"]
+)
+
+
+def percentile(sorted_values, pct):
+    """
+    Nearest-rank percentile of a sorted list of values.
+
+    Args:
+        sorted_values (list): The values, sorted in ascending order. pct (float): The percentile
+        (0-100).
+
+    Returns:
+        float: The percentile value, or None if the list is empty.
+    """
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize_broadcast(results):
+    """
+    Build an aggregate summary of broadcast results.
+
+    Args:
+        results (list): List of BroadcastResult.
+
+    Returns:
+        dict: Number of devices, answered and failed devices, and the p50/p90/p99/max round trip
+        latency (in milliseconds) of the devices that answered.
+    """
+    latencies = sorted(r.latency * 1000 for r in results if r.error is None)
+    summary = {
+        "devices": len(results),
+        "answered": len(latencies),
+        "failed": len(results) - len(latencies),
+    }
+    for name, pct in (("p50_ms", 50), ("p90_ms", 90), ("p99_ms", 99), ("max_ms", 100)):
+        value = percentile(latencies, pct)
+        summary[name] = round(value, 2) if value is not None else None
+    return summary
+
+
+def subscribe_msg(interval=None, change=None):
+    """
+    Build the message subscribing to the telemetry of a device (see HubServer.subscribe()). The
+    readings are asked for as deltas, which the HUB server merges back into full readings.
+
+    Args:
+        interval (float): Push the readings at least every this many seconds (None for no periodic
+        push). change (float): Push as soon as a numeric reading moves by at least this much (None
+        to push on any change).
+
+    Returns:
+        dict: The message.
+    """
+    return {"action": "subscribe", "interval": interval, "change": change, "encoding": "delta"}
+
+
+def raise_open_files_limit():
+    """
+    Raise the soft limit of open files to the hard limit so that the HUB can hold many thousands of
+    device connections (every connection is a file descriptor). Does nothing on platforms without
+    the resource module.
+    """
+    try:
+        import resource  # pylint: disable=import-outside-toplevel
+
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError) as e:
+        logging.error(
+            "Unable to raise the open files limit: %s",
+            e,
+            exc_info=True,
+        )
+
+
+class DeviceConnection:
+    """
+    The DeviceConnection class represents the connection of one device to the HUB. It holds the
+    asyncio streams and the session cipher of the connection. Every request carries a message id
+    which the device echoes in its response; read_loop() matches responses to the requests waiting
+    in the pending table, so several requests can be outstanding on one connection at once.
+    Readings are asked for as deltas (see delta.py) and merged back into full readings as they are
+    read, so responses and pushed messages always carry the full readings in 'result'. Instances
+    are kept small (using __slots__) since the HUB may hold thousands of them.
+
+    Attributes:
+        devid (str): The identifier of the connected device. address (tuple): Address from which the
+        device connected. reader (asyncio.StreamReader): Stream the device's messages are read from.
+        writer (asyncio.StreamWriter): Stream messages to the device are written to. session
+        (SessionCipher): The session cipher of the connection. pending (dict): Futures of the
+        outstanding requests keyed by message id. next_id (int): The next message id to use.
+        merger (DeltaMerger): Rebuilds the full readings from the deltas the device sends.
+        last_seen (float): When (time.monotonic()) the last message from the device was read.
+        last_sent (float): When the last message to the device was written.
+    """
+
+    __slots__ = (
+        "devid",
+        "address",
+        "reader",
+        "writer",
+        "session",
+        "pending",
+        "next_id",
+        "merger",
+        "last_seen",
+        "last_sent",
+    )
+
+    def __init__(self, devid, address, reader, writer, session):
+        """Initialize a new DeviceConnection instance."""
+        self.devid = devid
+        self.address = address
+        self.reader = reader
+        self.writer = writer
+        self.session = session
+        self.pending = {}
+        self.next_id = 1
+        self.merger = DeltaMerger()
+        self.last_seen = self.last_sent = time.monotonic()
+
+    async def request(self, msg):
+        """
+        Send a message to the device and wait for its response.
+
+        Args:
+            msg (dict): The message to send.
+
+        Returns:
+            dict: The decrypted response.
+
+        Raises:
+            ConnectionError: If the device has disconnected.
+        """
+        msg = dict(msg)
+        if msg.get("action") == "get_readings":
+            msg["encoding"] = "delta"
+
+        reply = await self._request(msg)
+
+        # If the delta couldn't be merged, read_loop() has already asked the device to start over
+        # from a full snapshot, so asking once more gets the readings
+        if "encoding" in msg and "result" in reply and reply["result"] is None:
+            reply = await self._request(dict(msg, full=True))
+        return reply
+
+    async def _request(self, msg):
+        """
+        Send a message to the device tagged with a new message id and wait for its response.
+
+        Args:
+            msg (dict): The message to send.
+
+        Returns:
+            dict: The decrypted response.
+        """
+        msgid = self.next_id
+        self.next_id += 1
+
+        # Requests carry the acknowledgement of the merged readings, which saves sending it alone
+        msg["id"] = msgid
+        ack = self.merger.take_ack()
+        if ack is not None:
+            msg["ack"] = ack
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[msgid] = future
+        try:
+            await self.send(msg)
+            return await future
+        finally:
+            # Whether answered, failed or cancelled (e.g. timed out), the request is no longer
+            # outstanding; a late response is simply dropped by read_loop()
+            self.pending.pop(msgid, None)
+
+    async def send(self, msg):
+        """
+        Send a message to the device without waiting for a response.
+
+        Args:
+            msg (dict): The message to send.
+        """
+        self._write(msg)
+        await self.writer.drain()
+
+    def _write(self, msg):
+        """
+        Write a message to the device without waiting for the writer to drain.
+
+        Args:
+            msg (dict): The message to send.
+        """
+        framing.write_frame(self.writer, self.session.encrypt(msg))
+        self.last_sent = time.monotonic()
+
+    def ping(self):
+        """
+        Send a heartbeat to the device, which answers with a 'pong' event. It is written without
+        waiting for the writer to drain, so a device that stopped reading can't block the caller.
+        """
+        self._write({"action": "ping"})
+
+    async def read_loop(self, on_message=None):
+        """
+        Read messages from the device until it disconnects, handing each response to the request
+        waiting for it.
+
+        Args:
+            on_message (callable): Optional function called with this connection and the message for
+            every message that doesn't answer an outstanding request.
+        """
+        try:
+            while True:
+                frame = await framing.read_frame(self.reader)
+                if frame is None:
+                    break
+
+                self.last_seen = time.monotonic()
+                data = self.session.decrypt(frame)
+
+                # A frame that fails authentication means the session can't be trusted anymore
+                if data is None:
+                    break
+
+                if "delta" in data:
+                    self._merge(data)
+
+                future = self.pending.get(data.get("id"))
+                if future is not None:
+                    if not future.done():
+                        future.set_result(data)
+                elif on_message is not None:
+                    on_message(self, data)
+
+        except (OSError, framing.FrameError) as e:
+            logging.error(
+                "Error reading from device %s: %s",
+                self.devid,
+                e,
+                exc_info=True,
+            )
+
+        finally:
+            # Fail whatever is still waiting for a response
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(
+                        ConnectionError(f"Device {self.devid} disconnected")
+                    )
+
+    def _merge(self, data):
+        """
+        Replace the delta in a message from the device with the full readings it stands for.
+
+        Args:
+            data (dict): The message, with the delta in its 'delta' field. The full readings are
+            put in its 'result' field, or None if the delta couldn't be merged.
+        """
+        readings = self.merger.apply(data.pop("delta"))
+        data["result"] = readings
+
+        # The messages below are written without waiting for the writer to drain; they are tiny and
+        # the next request or the transport flushes them
+        if readings is None:
+            # The delta is based on readings this side doesn't have, so ask for a full snapshot
+            self._write({"action": "resync"})
+        elif self.merger.ack_due():
+            self._write({"action": "ack", "seq": self.merger.take_ack()})
+
+    def close(self, abort=False):
+        """
+        Close the connection.
+
+        Args:
+            abort (bool): Whether to drop the connection at once instead of first sending what is
+            still buffered (e.g. for a device that no longer answers).
+        """
+        if abort:
+            self.writer.transport.abort()
+        else:
+            self.writer.close()
+
+
+class HubServer:
+    """
+    The HubServer class accepts device connections, performs the connection handshake, keeps the
+    connections of registered devices in the device list and exposes an API for sending commands to
+    connected devices.
+
+    Attributes:
+        device_list (DeviceRegistry): The registered devices keyed by device id, where each entry is
+        a dict with the fields 'conn' (the DeviceConnection or None if not connected) and 'devtype'
+        (see device_registry.py). crypto (CryptoContext): The RSA context of the HUB key pair, set
+        up once for all handshakes. loop (asyncio.AbstractEventLoop): The event loop the server runs
+        in (once started). live_view (dict): The latest readings of each device keyed by device id,
+        as dicts with the fields 'readings' and 'time' (when they were received), kept up to date by
+        the readings devices push and the get_readings responses. readings_listeners (list):
+        Functions called (in the event loop) with the device id and readings whenever new readings
+        are received (the status and threshold indexes of the device registry are kept up to date
+        too). state_ttl (float): Maximum age in seconds of the cached readings served to
+        get_readings requests that accept cached values. heartbeat_interval (float): Number of
+        seconds between heartbeats (see utils.HEARTBEAT_INTERVAL), or None for no heartbeats.
+        heartbeat_misses (int): Connections not heard from for this many intervals are dropped.
+        request_timeout (float): Default number of seconds a device gets to answer a request.
+
+    Example usage:
+        server = HubServer(private_key, creds, device_list) asyncio.run(server.serve_forever())
+    """
+
+    def __init__(
+        self,
+        private_key,
+        credentials,
+        device_list,
+        on_register=None,
+        host=HUB_HOST,
+        port=HUB_PORT,
+        crypto_workers=CRYPTO_WORKERS,
+        state_ttl=STATE_TTL,
+        heartbeat_interval=utils.HEARTBEAT_INTERVAL,
+        heartbeat_misses=utils.HEARTBEAT_MISSES,
+        request_timeout=REQUEST_TIMEOUT,
+    ):
+        """
+        Initialize a new HubServer instance.
+
+        Args:
+            private_key (RSAPrivateKey): The HUB private key used to open handshakes. credentials
+            (dict): The 'user' and 'pass' that devices must present. device_list (DeviceRegistry):
+            The device registry to register devices in. on_register (callable): Optional function
+            called (in the event loop, so it must not block) with the device id whenever a new
+            device registers. host (str): Address to listen on. port (int): Port to listen on.
+            crypto_workers (int): Number of worker threads for blocking work. state_ttl (float):
+            Maximum age in seconds of the cached readings served to get_readings requests.
+            heartbeat_interval (float): Number of seconds between heartbeats, or None for no
+            heartbeats. heartbeat_misses (int): Drop connections not heard from for this many
+            intervals. request_timeout (float): Default number of seconds a device gets to answer
+            a request.
+        """
+        self.private_key = private_key
+        self.crypto = utils.CryptoContext(private_key=private_key)
+        self.credentials = credentials
+        self.device_list = device_list
+        self.on_register = on_register
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.live_view = {}
+        self.readings_listeners = []
+        self.state_ttl = state_ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_misses = heartbeat_misses
+        self.request_timeout = request_timeout
+        self._changed = {}
+        self._server = None
+        self._heartbeat_task = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=crypto_workers
+        )
+
+    async def start(self):
+        """Start listening for device connections."""
+        self.loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(
+            self._handle_device,
+            self.host,
+            self.port,
+            backlog=LISTEN_BACKLOG,
+            limit=framing.DEFAULT_MAX_FRAME_SIZE,
+        )
+        if self.heartbeat_interval:
+            self._heartbeat_task = asyncio.ensure_future(self._heartbeat())
+
+    async def _heartbeat(self):
+        """
+        Every heartbeat interval, drop the connections that haven't been heard from for
+        heartbeat_misses intervals (e.g. half-open connections of devices that went away without
+        closing them), and ping the connections the HUB hasn't written to for an interval. Devices
+        answer pings, so a live device is heard from at least every other interval, and devices hear
+        from the HUB just as often (see device_service.py).
+        """
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            self.sweep()
+
+    def sweep(self, now=None):
+        """
+        Run one round of heartbeats (see _heartbeat()).
+
+        Args:
+            now (float): The current time.monotonic(), or None to read the clock.
+
+        Returns:
+            list: The ids of the devices whose connections were dropped.
+        """
+        if now is None:
+            now = time.monotonic()
+        deadline = self.heartbeat_interval * self.heartbeat_misses
+
+        dropped = []
+        for deviceid in self.device_list.ids(connected=True):
+            conn = self.device_list.conn(deviceid)
+            if conn is None:
+                continue
+            if now - conn.last_seen > deadline:
+                print(f"\nDevice {deviceid} stopped answering heartbeats. Disconnecting...")
+                self._drop_connection(deviceid, conn, abort=True)
+                dropped.append(deviceid)
+            elif now - conn.last_sent >= self.heartbeat_interval:
+                # Ping whenever the HUB has been quiet for an interval, even if the device hasn't:
+                # a subscribed device keeps pushing readings, but gives up on a HUB it doesn't hear
+                # from
+                conn.ping()
+        return dropped
+
+    async def serve_forever(self):
+        """Start the server (if not started yet) and serve until shutdown() is called."""
+        if self._server is None:
+            await self.start()
+
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if self._heartbeat_task is not None:
+                self._heartbeat_task.cancel()
+            self._executor.shutdown(wait=False)
+
+    async def _handle_device(self, reader, writer):
+        """
+        Handles incoming connection requests from devices
+
+        Args:
+            reader (asyncio.StreamReader): Stream of the connecting device. writer
+            (asyncio.StreamWriter): Stream to the connecting device.
+        """
+        device_address = writer.get_extra_info("peername")
+
+        # Have the operating system probe idle connections, so that dead peers are noticed too
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            utils.set_keepalive(sock)
+
+        # Read the connection message, giving up on connections that never send it
+        try:
+            request = await asyncio.wait_for(framing.read_frame(reader), self.request_timeout)
+        except (OSError, framing.FrameError, asyncio.TimeoutError):
+            request = None
+
+        # If the device has disconnected (or sent garbage), break out
+        if not request:
+            writer.close()
+            return
+
+        # Unwrap the device's session key and decrypt the connection message. The RSA operation is
+        # run in the worker threads so that it doesn't block the other connections
+        session, request_data = await self.loop.run_in_executor(
+            self._executor, utils.open_handshake, request, self.crypto
+        )
+
+        # If the handshake can't be opened, there is no way to even answer the device, so break out
+        if session is None:
+            print(f"Connection request from {device_address} could not be decrypted")
+            writer.close()
+            return
+
+        # If the message DID NOT contain the 'action' field OR the credentials sent through by the
+        # device are incorrect, inform the device of failure and reject the connection
+        if (
+            "action" not in request_data
+            or request_data.get("user") != self.credentials["user"]
+            or request_data.get("pass") != self.credentials["pass"]
+        ):
+            print(
+                f"Connection request from {device_address} invalid (credentials invalid or didn't "
+                + "make connection request)"
+            )
+            framing.write_frame(writer, session.encrypt({"result": "failure"}))
+            await writer.drain()
+            writer.close()
+            return
+
+        deviceid = request_data["devid"]
+        devtype = request_data["devtype"]
+        conn = DeviceConnection(deviceid, device_address, reader, writer, session)
+
+        previous, is_new = self.device_list.connect(deviceid, devtype, conn)
+
+        # If an older connection of this device is still held, drop it; the most recent one wins
+        if previous is not None:
+            previous.close()
+
+        if is_new:
+            print(
+                f"\nNew {devtype} device connected with identifier {deviceid}"
+                + f" from {device_address}"
+            )
+            print("Device registered")
+
+            # Saving the device is left to on_register, which only queues it (see registry_store.py)
+            # so that the device doesn't wait for the disk before getting its response
+            if self.on_register is not None:
+                self.on_register(deviceid)
+        else:
+            print(f"Registered {devtype} device {deviceid} connected from {device_address}.")
+
+        # Inform the device that connection was successful, naming the codec picked from the ones it
+        # offered. The response itself is still JSON; everything after it uses the agreed codec.
+        # The codec is switched as soon as the response is written, before waiting for it to drain,
+        # as requests to the device (now registered) may be sent in the meantime
+        msg_codec = codec.negotiate(request_data.get("codecs"))
+        reply = {"result": "success"}
+        if "codecs" in request_data:
+            reply["codec"] = msg_codec.name
+        conn._write(reply)
+        session.codec = msg_codec
+        await conn.writer.drain()
+
+        # Serve the connection's responses and pushed messages until the device disconnects
+        await conn.read_loop(self._on_message)
+        self._drop_connection(deviceid, conn)
+
+    def _record_readings(self, deviceid, readings):
+        """
+        Record newly received readings of a device in the live view and inform the listeners.
+
+        Args:
+            deviceid (str): The device id. readings (dict): The readings.
+        """
+        self.live_view[deviceid] = {"readings": readings, "time": time.time()}
+        self.device_list.update_readings(deviceid, readings)
+        # A failing listener mustn't keep the others from the readings (or break the connection)
+        for listener in self.readings_listeners:
+            try:
+                listener(deviceid, readings)
+            except Exception as e:  # pylint: disable=broad-except
+                logging.error(
+                    "Error in readings listener: %s",
+                    e,
+                    exc_info=True,
+                )
+
+    def _on_message(self, conn, data):
+        """
+        Handle a message the device sent on its own (i.e. not a response to a request).
+
+        Args:
+            conn (DeviceConnection): The connection of the device. data (dict): The message.
+        """
+        if data.get("event") == "pong":
+            # Answer to a heartbeat; read_loop() has already noted that the device is alive
+            return
+
+        if data.get("event") == "readings":
+            # Readings of a delta that couldn't be merged are None; the device has already been
+            # asked for a full snapshot, which comes with its next push
+            if data.get("result") is not None:
+                self._record_readings(conn.devid, data["result"])
+        else:
+            logging.error("Unexpected message from device %s: %s", conn.devid, data)
+
+    def _drop_connection(self, deviceid, conn, abort=False):
+        """
+        Close a device connection and mark the device as not connected (unless it has reconnected
+        in the meantime).
+
+        Args:
+            deviceid (str): The device id. conn (DeviceConnection): The connection to drop. abort
+            (bool): Whether to drop the connection without sending what is still buffered.
+        """
+        conn.close(abort)
+        self.device_list.disconnect(deviceid, conn)
+
+    def cached_readings(self, deviceid, max_age=None):
+        """
+        Get the latest readings received from a connected device (pushed or polled), if they are
+        recent enough and no other action has been sent to the device since they were received.
+
+        Args:
+            deviceid (str): The device id. max_age (float): Maximum age in seconds of the readings
+            (never more than state_ttl), or None for state_ttl.
+
+        Returns:
+            tuple: A copy of the readings and their age in seconds, or None if there are no such
+            readings.
+        """
+        view = self.live_view.get(deviceid)
+        if view is None or self.device_list.conn(deviceid) is None:
+            return None
+
+        limit = self.state_ttl if max_age is None else min(max_age, self.state_ttl)
+        age = time.time() - view["time"]
+        if age > limit or view["time"] < self._changed.get(deviceid, 0):
+            return None
+        return dict(view["readings"]), age
+
+    async def request(self, deviceid, msg, timeout=None):
+        """
+        Send a message to a connected device and wait for its response. A get_readings message
+        with a 'max_age' field (in seconds) accepts cached readings: if the device's readings were
+        received recently enough (see cached_readings()), they are returned without a round trip
+        to the device, in a response with the fields 'result', 'cached' (True) and 'age'.
+
+        Args:
+            deviceid (str): The device id. msg (dict): The message to send. timeout (float):
+            Number of seconds to wait for the response, or None for request_timeout.
+
+        Returns:
+            dict: The decrypted response (or the response made from the cached readings).
+
+        Raises:
+            ConnectionError: If the device is not connected or disconnects. asyncio.TimeoutError: If
+            the device doesn't respond in time.
+        """
+        if "max_age" in msg:
+            if msg.get("action") == "get_readings":
+                cached = self.cached_readings(deviceid, msg["max_age"])
+                if cached is not None:
+                    return {"result": cached[0], "cached": True, "age": cached[1]}
+            msg = {key: value for key, value in msg.items() if key != "max_age"}
+
+        conn = self.device_list.conn(deviceid)
+        if conn is None:
+            raise ConnectionError(f"Device {deviceid} is not connected")
+
+        if timeout is None:
+            timeout = self.request_timeout
+
+        try:
+            reply = await asyncio.wait_for(conn.request(msg), timeout)
+        except asyncio.TimeoutError:
+            # A slow answer doesn't mean the connection is gone (since Python 3.11 the timeout is an
+            # OSError, so it must be let through before the clause below); dead connections are
+            # dropped by the heartbeats
+            raise
+        except (ConnectionError, OSError) as e:
+            self._drop_connection(deviceid, conn)
+            raise ConnectionError(f"Device {deviceid} disconnected") from e
+
+        # Readings received in a response keep the live view up to date as well. Other actions
+        # (apart from subscriptions) may have changed the device's state, so the readings received
+        # so far are no longer served from the cache
+        action = msg.get("action")
+        if action == "get_readings":
+            if isinstance(reply.get("result"), dict):
+                self._record_readings(deviceid, reply["result"])
+        elif action not in ("subscribe", "unsubscribe"):
+            self._changed[deviceid] = time.time()
+
+        return reply
+
+    async def subscribe(self, deviceid, interval=None, change=None, timeout=None):
+        """
+        Subscribe to the telemetry of a device, so that it pushes its readings as they are sensed.
+
+        Args:
+            deviceid (str): The device id. interval (float): Push the readings at least every this
+            many seconds (None for no periodic push). change (float): Push as soon as a numeric
+            reading moves by at least this much (None to push on any change). timeout (float):
+            Optional number of seconds to wait for the response.
+
+        Returns:
+            dict: The decrypted response.
+        """
+        return await self.request(deviceid, subscribe_msg(interval, change), timeout)
+
+    async def _timed_request(self, deviceid, msg, timeout):
+        """
+        Send a message to a device as part of a broadcast, timing the round trip.
+
+        Args:
+            deviceid (str): The device id. msg (dict): The message to send. timeout (float): Number
+            of seconds to wait for the response.
+
+        Returns:
+            BroadcastResult: The result for this device.
+        """
+        start = time.perf_counter()
+        try:
+            reply, error = await self.request(deviceid, msg, timeout), None
+        except asyncio.TimeoutError:
+            reply, error = None, "timed out"
+        except ConnectionError:
+            reply, error = None, "unable to connect to the device"
+        return BroadcastResult(deviceid, reply, error, time.perf_counter() - start)
+
+    async def broadcast(self, deviceids, msg, timeout=BROADCAST_TIMEOUT):
+        """
+        Send a message to several devices in parallel and yield each device's result as it arrives,
+        so a slow device doesn't hold up the others.
+
+        Args:
+            deviceids (list): The device ids. msg (dict): The message to send. timeout (float):
+            Number of seconds each device gets to respond.
+
+        Yields:
+            BroadcastResult: The result of each device, in order of arrival.
+        """
+        tasks = [
+            asyncio.ensure_future(self._timed_request(deviceid, msg, timeout))
+            for deviceid in deviceids
+        ]
+        for task in asyncio.as_completed(tasks):
+            yield await task
+
+    def broadcast_iter(self, deviceids, msg, timeout=BROADCAST_TIMEOUT):
+        """
+        Thread-safe version of broadcast() for use outside the event loop (e.g. the menu).
+
+        Args:
+            deviceids (list): The device ids. msg (dict): The message to send. timeout (float):
+            Number of seconds each device gets to respond.
+
+        Yields:
+            BroadcastResult: The result of each device, in order of arrival.
+        """
+        results = queue.Queue()
+
+        async def _collect():
+            try:
+                async for result in self.broadcast(deviceids, msg, timeout):
+                    results.put(result)
+            finally:
+                results.put(None)
+
+        asyncio.run_coroutine_threadsafe(_collect(), self.loop)
+
+        while True:
+            result = results.get()
+            if result is None:
+                return
+            yield result
+
+    def call(self, deviceid, msg, timeout=None):
+        """
+        Thread-safe, blocking version of request() for use outside the event loop (e.g. the menu).
+
+        Args:
+            deviceid (str): The device id. msg (dict): The message to send. timeout (float):
+            Number of seconds to wait for the response, or None for request_timeout.
+
+        Returns:
+            dict: The decrypted response.
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self.request(deviceid, msg, timeout), self.loop
+        )
+        return future.result()
+
+    def disconnect(self, deviceid):
+        """
+        Thread-safe function to close a device's connection.
+
+        Args:
+            deviceid (str): The device id.
+        """
+        conn = self.device_list.conn(deviceid)
+        if conn is not None:
+            self.loop.call_soon_threadsafe(self._drop_connection, deviceid, conn)
+
+    def shutdown(self):
+        """Thread-safe function to close all device connections and stop the server."""
+
+        def _shutdown():
+            for deviceid in self.device_list.ids(connected=True):
+                self._drop_connection(deviceid, self.device_list.conn(deviceid))
+            # Closing the server makes serve_forever() return
+            self._server.close()
+            if self._heartbeat_task is not None:
+                self._heartbeat_task.cancel()
+
+        self.loop.call_soon_threadsafe(_shutdown)
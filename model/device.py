@@ -2,11 +2,56 @@
 This module contains the classes for the IoT devices (currently Device, from which MotionSensor,
 SmartLight, SmartLock and Thermostat inherit). Possible to seamlessly create other devices by
 inherting from Device and keeping to the similar structure
+
+Each class also handles the actions requested by the HUB in its methods marked with @handles(...);
+these are registered in the action registry (model.dispatch.actions) when the class is defined
+
+Devices are kept compact so that large simulations (and mirrors of many devices' state) stay small:
+the classes use __slots__ instead of a per-instance __dict__, the threshold bounds are class-level
+constants, and status and switch are stored as a bool and read back as the shared strings below
 """
 
 import json
 import random
 
+from model.dispatch import actions, handles
+
+# The values of the status and switch attributes (and readings), indexed by their stored bool
+INACTIVE = "inactive"
+ACTIVE = "active"
+STATUSES = (INACTIVE, ACTIVE)
+
+OFF = "off"
+ON = "on"
+SWITCHES = (OFF, ON)
+
+
+def _coded(slot, values):
+    """
+    Build a property storing one of two strings as a bool in a slot, e.g. the status of a device
+    ('inactive' or 'active') as False or True.
+
+    Args:
+        slot (str): The name of the slot holding the bool. values (tuple): The strings stored as
+        False and True.
+
+    Returns:
+        property: The property; setting it to any other string raises a ValueError.
+    """
+
+    def getter(self):
+        return values[getattr(self, slot)]
+
+    def setter(self, value):
+        if value == values[1]:
+            setattr(self, slot, True)
+        elif value == values[0]:
+            setattr(self, slot, False)
+        else:
+            raise ValueError(f"Invalid value {value!r}, must be one of {values}")
+
+    return property(getter, setter)
+
 
 class Device:
     """
@@ -20,7 +65,7 @@ class Device:
 
     Constants:
         thres_min (int): The minimum threshold value allowed. thres_max (int): The maximum threshold
-        value allowed.
+        value allowed. (Class-level constants, overridden by each device class.)
 
     Methods:
         __init__(self, identifier, threshold=50):
@@ -45,26 +90,40 @@ class Device:
             Returns a string representation of the Device, including its class name and device
             readings in JSON format.
 
+        handle_<action>(self, request_data):
+            Handle the HUB's requests for the get_readings, set_thres, set_activate and
+            set_deactivate actions (subclasses add their own, e.g. set_on and set_off).
+
     Example usage:
         device = Device("device001", 60) print(device.get_readings())  # {'identifier':
         'example_device', 'status': 'active', 'threshold': 60}
     """
 
+    __slots__ = ("identifier", "_active", "threshold")
+
+    thres_min = 0
+    thres_max = 100
+
+    status = _coded("_active", STATUSES)
+
+    def __init_subclass__(cls, **kwargs):
+        """Register the action handlers of every device class in the action registry."""
+        super().__init_subclass__(**kwargs)
+        actions.register_class(cls)
+
     def __init__(self, identifier, threshold=50):
         """Initialize a new Device instance."""
         self.identifier = identifier
-        self.status = "active"  # Or inactive
-        self.thres_max = 100
-        self.thres_min = 0
+        self.status = ACTIVE  # Or INACTIVE
         self.set_threshold(threshold)
 
     def activate(self):
         """Activate the device, setting its status to 'active'."""
-        self.status = "active"
+        self.status = ACTIVE
 
     def deactivate(self):
         """Deactivate the device, setting its status to 'inactive'."""
-        self.status = "inactive"
+        self.status = INACTIVE
 
     def set_threshold(self, value):
         """
@@ -104,6 +163,47 @@ class Device:
         """
         return str(self.__class__.__name__) + "| " + json.dumps(self.get_readings())
 
+    @handles("get_readings")
+    def handle_get_readings(self, request_data):
+        """Handle the HUB's request for the device readings."""
+        return self.get_readings()
+
+    @handles("set_thres")
+    def handle_set_thres(self, request_data):
+        """Handle the HUB's request to set the device threshold to request_data['value']."""
+        self.set_threshold(request_data["value"])
+        return "success"
+
+    @handles("set_activate")
+    def handle_set_activate(self, request_data):
+        """
+        Handle the HUB's request to activate the device. Note that activation has different effects
+        on the different devices in this simulation: for SmartLight, it activates the automatic
+        light sensor, so it will start using the threshold to turn on/off the light; for
+        MotionSensor and Thermostat it will start the device using the given threshold to issue
+        alerts / adjust temperature; for SmartLock this enables the lock and unlock functions
+        """
+        if self.status == "active":
+            return "already active"
+        self.activate()
+        return "success"
+
+    @handles("set_deactivate")
+    def handle_set_deactivate(self, request_data):
+        """
+        Handle the HUB's request to deactivate the device. For SmartLight, it deactivates the
+        automatic light sensor, so it will just remain either on or off depending on what it was;
+        for MotionSensor and Thermostat it will stop the device from using the given threshold; for
+        SmartLock this disables the lock and unlock functions
+        """
+        if self.status == "inactive":
+            return "already inactive"
+        self.deactivate()
+        return "success"
+
+
+actions.register_class(Device)
+
 
 class SmartLight(Device):
     """
@@ -148,21 +248,26 @@ class SmartLight(Device):
         light = SmartLight("SmartLight001", 60) light.sense()
     """
 
+    __slots__ = ("brightness", "_on")
+
+    thres_min = 0
+    thres_max = 100
+
+    switch = _coded("_on", SWITCHES)
+
     def __init__(self, identifier, threshold=50):
         """Initialize a new SmartLight instance."""
-        self.thres_max = 100
-        self.thres_min = 0
         super().__init__(identifier, threshold)
         self.brightness = 90  # Day time default
-        self.switch = "on"
+        self.switch = ON
 
     def switch_on(self):
         """Switch device on"""
-        self.switch = "on"
+        self.switch = ON
 
     def switch_off(self):
         """Switch device off"""
-        self.switch = "off"
+        self.switch = OFF
 
     def get_value(self):
         """Returns the brightness"""
@@ -224,6 +329,20 @@ class SmartLight(Device):
             print("Threshold subceeded. Switching light on")
             self.switch_on()
 
+    @handles("set_on")
+    def handle_set_on(self, request_data):
+        """Handle the HUB's request to turn on: deactivate the light sensor and switch on."""
+        self.deactivate()
+        self.switch_on()
+        return "Manual override (threshold deactivated); lighted switched on"
+
+    @handles("set_off")
+    def handle_set_off(self, request_data):
+        """Handle the HUB's request to turn off: deactivate the light sensor and switch off."""
+        self.deactivate()
+        self.switch_off()
+        return "Manual override (threshold deactivated); lighted switched off"
+
 
 class MotionSensor(Device):
     """
@@ -265,21 +384,26 @@ class MotionSensor(Device):
         Example usage: sensor = MotionSensor("motion005", 7) sensor.sense()
     """
 
+    __slots__ = ("motion", "_on")
+
+    thres_min = 0
+    thres_max = 10
+
+    switch = _coded("_on", SWITCHES)
+
     def __init__(self, identifier, threshold=5):
         """Initialize a new MotionSensor instance."""
-        self.thres_max = 10
-        self.thres_min = 0
         super().__init__(identifier, threshold)
         self.motion = 0
-        self.switch = "on"
+        self.switch = ON
 
     def switch_on(self):
         """Switch device on"""
-        self.switch = "on"
+        self.switch = ON
 
     def switch_off(self):
         """Switch device off"""
-        self.switch = "off"
+        self.switch = OFF
 
     def set_value(self, value):
         """
@@ -333,6 +457,22 @@ class MotionSensor(Device):
         if self.status == "active" and self.motion >= self.threshold:
             print("Motion detected!")
 
+    @handles("set_on")
+    def handle_set_on(self, request_data):
+        """Handle the HUB's request to turn on: start sensing motion."""
+        if self.switch == "on":
+            return "already on"
+        self.switch_on()
+        return "success - motion sensor engaged"
+
+    @handles("set_off")
+    def handle_set_off(self, request_data):
+        """Handle the HUB's request to turn off: stop sensing motion."""
+        if self.switch == "off":
+            return "already off"
+        self.switch_off()
+        return "success - motion sensor disengaged"
+
 
 class SmartLock(Device):
     """
@@ -362,28 +502,33 @@ class SmartLock(Device):
         Example usage: lock = SmartLock("lock05") lock.lock()
     """
 
+    __slots__ = ("_on",)
+
+    thres_min = 0
+    thres_max = 0
+
+    switch = _coded("_on", SWITCHES)
+
     def __init__(self, identifier):
         """Initialize a new SmartLock instance."""
-        self.thres_max = 0
-        self.thres_min = 0
         super().__init__(identifier)
-        self.switch = "on"
+        self.switch = ON
 
     def lock(self):
         """
         Lock the smart lock by setting the switch status to 'on' if the device is active.
         """
-        if self.status == "inactive":
+        if self.status == INACTIVE:
             return
-        self.switch = "on"
+        self.switch = ON
 
     def unlock(self):
         """
         Unlock the smart lock by setting the switch status to 'off' if the device is active.
         """
-        if self.status == "inactive":
+        if self.status == INACTIVE:
             return
-        self.switch = "off"
+        self.switch = OFF
 
     def get_readings(self):
         """
@@ -396,6 +541,26 @@ class SmartLock(Device):
         pareadings.update({"switch": self.switch})
         return pareadings
 
+    @handles("set_on")
+    def handle_set_on(self, request_data):
+        """Handle the HUB's request to turn on: lock, but only if the lock is active."""
+        if self.status == "inactive":
+            return "failure - lock is inactive"
+        if self.switch == "on":
+            return "already locked"
+        self.lock()
+        return "success - lock engaged"
+
+    @handles("set_off")
+    def handle_set_off(self, request_data):
+        """Handle the HUB's request to turn off: unlock, but only if the lock is active."""
+        if self.status == "inactive":
+            return "failure - lock is inactive"
+        if self.switch == "off":
+            return "already unlocked"
+        self.unlock()
+        return "success - lock disengaged"
+
 
 class Thermostat(Device):
     """
@@ -435,21 +600,26 @@ class Thermostat(Device):
         Example usage: thermostat = Thermostat("therm22", 25) thermostat.sense()
     """
 
+    __slots__ = ("temp", "_on")
+
+    thres_min = 0
+    thres_max = 40
+
+    switch = _coded("_on", SWITCHES)
+
     def __init__(self, identifier, threshold=23):
         """Initialize a new Thermostat instance."""
-        self.thres_max = 40
-        self.thres_min = 0
         super().__init__(identifier, threshold)
         self.temp = 15.0
-        self.switch = "on"
+        self.switch = ON
 
     def switch_on(self):
         "Switch device on"
-        self.switch = "on"
+        self.switch = ON
 
     def switch_off(self):
         "Switch device off"
-        self.switch = "off"
+        self.switch = OFF
 
     def set_value(self, value):
         """
@@ -500,3 +670,19 @@ class Thermostat(Device):
         if self.status == "active" and self.temp >= self.threshold:
             print("Temperature threshold exceeded. Capping temperature at threshold")
             self.temp = self.threshold
+
+    @handles("set_on")
+    def handle_set_on(self, request_data):
+        """Handle the HUB's request to turn on: start sensing temperature."""
+        if self.switch == "on":
+            return "already on"
+        self.switch_on()
+        return "success - thermostat engaged"
+
+    @handles("set_off")
+    def handle_set_off(self, request_data):
+        """Handle the HUB's request to turn off: stop sensing temperature."""
+        if self.switch == "off":
+            return "already off"
+        self.switch_off()
+        return "success - thermostat disengaged"
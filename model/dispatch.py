@@ -0,0 +1,127 @@
+"""
+This module contains the registry used to dispatch actions requested by the HUB to the device
+classes. Device classes mark their action handlers with the handles() decorator; the registry then
+maps each (action, device class) pair to its handler, so an incoming action is dispatched with a
+single dict lookup instead of a chain of if/elif and isinstance checks
+"""
+
+import time
+
+
+def handles(action):
+    """
+    Decorator marking a device method as the handler of an action. The method is called with the
+    device and the decrypted request, and returns the result to send back to the HUB.
+
+    Args:
+        action (str): The action handled, e.g. 'set_on'.
+
+    Example usage:
+        @handles("set_on") def handle_set_on(self, request_data): ...
+    """
+
+    def decorator(func):
+        func.handled_action = action
+        return func
+
+    return decorator
+
+
+class ActionRegistry:
+    """
+    The ActionRegistry class maps (action, device class) pairs to handler functions. A device class
+    without its own handler for an action uses the handler of its nearest base class; the result of
+    that lookup is cached so that it is only worked out once per pair.
+
+    Attributes:
+        on_dispatch (callable): Optional function called with the action, the device class and the
+        time taken (in seconds) after every dispatched action, e.g. to time actions.
+
+    Example usage:
+        registry = ActionRegistry() registry.register_class(SmartLight) registry.dispatch(light,
+        {"action": "set_on"})
+    """
+
+    def __init__(self):
+        """Initialize a new ActionRegistry instance."""
+        self.on_dispatch = None
+        self._handlers = {}
+        self._cache = {}
+
+    def register(self, action, device_cls, handler):
+        """
+        Register the handler of an action for a device class.
+
+        Args:
+            action (str): The action. device_cls (type): The device class. handler (callable): The
+            handler, called with the device and the request.
+        """
+        self._handlers[(action, device_cls)] = handler
+
+        # Subclasses may have cached their base class' handler, so work them out again
+        self._cache.clear()
+
+    def register_class(self, device_cls):
+        """
+        Register all methods of a device class marked with the handles() decorator.
+
+        Args:
+            device_cls (type): The device class.
+        """
+        for attr in vars(device_cls).values():
+            action = getattr(attr, "handled_action", None)
+            if action is not None:
+                self.register(action, device_cls, attr)
+
+    def lookup(self, action, device_cls):
+        """
+        Find the handler of an action for a device class.
+
+        Args:
+            action (str): The action. device_cls (type): The device class.
+
+        Returns:
+            callable: The handler, or None if the device class doesn't handle the action.
+        """
+        key = (action, device_cls)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        handler = None
+        for cls in device_cls.__mro__:
+            handler = self._handlers.get((action, cls))
+            if handler is not None:
+                break
+
+        self._cache[key] = handler
+        return handler
+
+    def dispatch(self, device, request_data):
+        """
+        Carry out the action of a request on a device.
+
+        Args:
+            device (Device): The device. request_data (dict): The decrypted request, containing the
+            'action' field and any action parameters.
+
+        Returns:
+            The result of the action, or a failure message if the device doesn't handle it.
+        """
+        action = request_data.get("action")
+        handler = self.lookup(action, type(device))
+        if handler is None:
+            return "failure - unknown action"
+
+        if self.on_dispatch is None:
+            return handler(device, request_data)
+
+        start = time.perf_counter()
+        result = handler(device, request_data)
+        self.on_dispatch(action, type(device), time.perf_counter() - start)
+        return result
+
+
+# The registry all device classes register their handlers in
+actions = ActionRegistry()
@@ -0,0 +1,359 @@
+"""
+This module contains the DeviceFleet class, which simulates the sensors of many devices at once.
+Instead of every device object drawing its own random number and checking its own threshold in
+sense(), the fleet keeps the state of all its devices (reading, threshold, status and switch) in
+NumPy arrays and runs the same random walk and threshold rules as the device classes (lights
+switching on/off, motion detection, thermostats capping the temperature) as a handful of array
+operations per tick, so that a tick of 100k sensors takes milliseconds
+
+Each device of the fleet is still available as an object: DeviceFleet.add() returns a view of the
+device (a subclass of its device class, e.g. FleetSmartLight) whose attributes read and write the
+fleet's arrays. Views work anywhere a device does (get_readings(), the HUB's actions, even sense())
+"""
+
+import json
+
+import numpy as np
+
+from model.device import STATUSES, SWITCHES, MotionSensor, SmartLight, SmartLock, Thermostat
+
+# Kind of each device in the fleet's arrays
+LIGHT = 0
+MOTION = 1
+LOCK = 2
+THERM = 3
+
+# Number of devices the arrays have room for at first; they double in size when full
+INITIAL_CAPACITY = 1024
+
+
+def _number(value):
+    """
+    Turn an array element back into the Python number the device classes use.
+
+    Args:
+        value (numpy.float64): The array element.
+
+    Returns:
+        int or float: An int for whole numbers, a float otherwise.
+    """
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def device_type(device):
+    """
+    Get the device type the HUB knows a device by: the name of its device class or, for a view,
+    the name of the device class it stands for (e.g. 'SmartLight' for a FleetSmartLight).
+
+    Args:
+        device (Device): The device or view.
+
+    Returns:
+        str: The device type.
+    """
+    if isinstance(device, FleetView):
+        return device.device_class.__name__
+    return device.__class__.__name__
+
+
+class FleetView:
+    """
+    The FleetView class is the base of the device views handed out by DeviceFleet. The attributes
+    status, switch and threshold (and the reading of each kind of device) are properties over the
+    fleet's arrays, so changes made through the view (e.g. by the HUB's actions) are seen by the
+    next tick and the other way round.
+
+    Attributes:
+        fleet (DeviceFleet): The fleet the device belongs to. index (int): The device's position in
+        the fleet's arrays. identifier (str): A unique identifier for the device. device_class
+        (type): The device class the view stands for.
+    """
+
+    # The slots of the views (fleet and index) are declared by each view class, as a class can't
+    # inherit non-empty __slots__ from both FleetView and a device class
+    __slots__ = ()
+
+    device_class = None
+
+    def __init__(self, fleet, index, identifier):
+        """Initialize a new view; the device state itself is already in the fleet's arrays."""
+        self.fleet = fleet
+        self.index = index
+        self.identifier = identifier
+
+    @property
+    def status(self):
+        """str: The status of the device, 'active' or 'inactive'."""
+        return STATUSES[bool(self.fleet.active[self.index])]
+
+    @status.setter
+    def status(self, value):
+        self.fleet.active[self.index] = STATUSES.index(value)
+
+    @property
+    def switch(self):
+        """str: The switch status, 'on' or 'off'."""
+        return SWITCHES[bool(self.fleet.switch_on[self.index])]
+
+    @switch.setter
+    def switch(self, value):
+        self.fleet.switch_on[self.index] = SWITCHES.index(value)
+
+    @property
+    def threshold(self):
+        """int or float: The threshold value of the device."""
+        return _number(self.fleet.threshold[self.index])
+
+    @threshold.setter
+    def threshold(self, value):
+        self.fleet.threshold[self.index] = value
+
+    def __str__(self):
+        """Get a string representation of the device, named after the class the view stands for."""
+        return self.device_class.__name__ + "| " + json.dumps(self.get_readings())
+
+
+def _reading(cast):
+    """
+    Build the property of a view's reading (e.g. brightness), stored in the fleet's value array.
+
+    Args:
+        cast (type): The type the device class uses for the reading (int or float).
+
+    Returns:
+        property: The property.
+    """
+
+    def getter(self):
+        return cast(self.fleet.value[self.index])
+
+    def setter(self, value):
+        self.fleet.value[self.index] = value
+
+    return property(getter, setter)
+
+
+class FleetSmartLight(FleetView, SmartLight):
+    """A SmartLight whose state is kept in a DeviceFleet."""
+
+    __slots__ = ("fleet", "index")
+
+    device_class = SmartLight
+    brightness = _reading(int)
+
+
+class FleetMotionSensor(FleetView, MotionSensor):
+    """A MotionSensor whose state is kept in a DeviceFleet."""
+
+    __slots__ = ("fleet", "index")
+
+    device_class = MotionSensor
+    motion = _reading(int)
+
+
+class FleetSmartLock(FleetView, SmartLock):
+    """A SmartLock whose state is kept in a DeviceFleet."""
+
+    __slots__ = ("fleet", "index")
+
+    device_class = SmartLock
+
+
+class FleetThermostat(FleetView, Thermostat):
+    """A Thermostat whose state is kept in a DeviceFleet."""
+
+    __slots__ = ("fleet", "index")
+
+    device_class = Thermostat
+    temp = _reading(float)
+
+
+# The kind, view class and name of the reading of each device class the fleet can hold
+KINDS = (
+    (SmartLight, LIGHT, FleetSmartLight, "brightness"),
+    (MotionSensor, MOTION, FleetMotionSensor, "motion"),
+    (SmartLock, LOCK, FleetSmartLock, None),
+    (Thermostat, THERM, FleetThermostat, "temp"),
+)
+
+
+class DeviceFleet:
+    """
+    The DeviceFleet class keeps the state of many devices in NumPy arrays (one element per device)
+    and simulates their sensors for all of them at once.
+
+    Attributes:
+        kind (numpy.ndarray): The kind of each device (LIGHT, MOTION, LOCK or THERM). value
+        (numpy.ndarray): The reading of each device (brightness, motion or temperature; unused for
+        locks). threshold (numpy.ndarray): The threshold of each device. active (numpy.ndarray):
+        Whether each device is active. switch_on (numpy.ndarray): Whether each device is switched
+        on. views (list): The view of each device, in the order they were added.
+
+    Example usage:
+        fleet = DeviceFleet() lights = fleet.extend(SmartLight(f"Light{i}") for i in range(100000))
+        fleet.tick() print(lights[0].get_readings())
+    """
+
+    def __init__(self, capacity=INITIAL_CAPACITY, seed=None):
+        """
+        Initialize a new (empty) DeviceFleet instance.
+
+        Args:
+            capacity (int): Number of devices the arrays have room for at first. seed (int):
+            Optional seed of the random number generator, to repeat a simulation.
+        """
+        self.views = []
+        self._index = {}
+        self._rng = np.random.default_rng(seed)
+        self._allocate(max(capacity, 1))
+
+    def _allocate(self, capacity):
+        """
+        (Re)allocate the arrays with room for a number of devices, keeping the current state.
+
+        Args:
+            capacity (int): The number of devices.
+        """
+        count = len(self.views)
+        for name, dtype in (
+            ("kind", np.int8),
+            ("value", np.float64),
+            ("threshold", np.float64),
+            ("active", np.bool_),
+            ("switch_on", np.bool_),
+        ):
+            array = np.zeros(capacity, dtype=dtype)
+            if count:
+                array[:count] = getattr(self, name)[:count]
+            setattr(self, name, array)
+
+    def add(self, device):
+        """
+        Add a device to the fleet, copying its current state into the arrays.
+
+        Args:
+            device (Device): The device, a SmartLight, MotionSensor, SmartLock or Thermostat.
+
+        Returns:
+            FleetView: The view of the device in the fleet (to be used instead of the device).
+
+        Raises:
+            TypeError: If the fleet can't simulate devices of this class. ValueError: If a device
+            with the same identifier is already in the fleet.
+        """
+        for device_cls, kind, view_cls, reading in KINDS:
+            if isinstance(device, device_cls):
+                break
+        else:
+            raise TypeError(f"Can't simulate {device.__class__.__name__} devices in a fleet")
+
+        if device.identifier in self._index:
+            raise ValueError(f"Device {device.identifier} is already in the fleet")
+
+        index = len(self.views)
+        if index == len(self.kind):
+            self._allocate(2 * len(self.kind))
+
+        self.kind[index] = kind
+        self.value[index] = getattr(device, reading) if reading is not None else 0
+        self.threshold[index] = device.threshold
+        self.active[index] = device.status == "active"
+        self.switch_on[index] = device.switch == "on"
+
+        view = view_cls(self, index, device.identifier)
+        self.views.append(view)
+        self._index[device.identifier] = view
+        return view
+
+    def extend(self, devices):
+        """
+        Add several devices to the fleet (see add()).
+
+        Args:
+            devices (iterable): The devices.
+
+        Returns:
+            list: The views of the devices.
+        """
+        return [self.add(device) for device in devices]
+
+    def get(self, identifier, default=None):
+        """
+        Get the view of a device.
+
+        Args:
+            identifier (str): The device identifier. default: Returned if the device isn't in the
+            fleet.
+
+        Returns:
+            FleetView: The view, or the default.
+        """
+        return self._index.get(identifier, default)
+
+    def __len__(self):
+        return len(self.views)
+
+    def __iter__(self):
+        return iter(self.views)
+
+    def tick(self, values=None):
+        """
+        Simulate one sensor update of every device, with the same rules as the sense() functions of
+        the device classes: lights take a random step of -2..2 and then switch off (or on) if
+        active and their brightness is at or over (or under) the threshold; motion sensors that are
+        switched on take a step of -1..1 and detect motion if active and at or over the threshold;
+        thermostats that are switched on take a step of -0.1..0.1 and cap the temperature at the
+        threshold if active; locks don't have a sensor.
+
+        Args:
+            values (array-like): Optional simulated reading of every device (like the simval of
+            sense()); if not provided, random steps are generated.
+
+        Returns:
+            dict: The indexes (numpy arrays) of the devices that switched 'off' and switched 'on'
+            (lights), detected 'motion' and 'capped' their temperature in this tick.
+        """
+        count = len(self.views)
+        kind = self.kind[:count]
+        value = self.value[:count]
+        threshold = self.threshold[:count]
+        active = self.active[:count]
+        switch_on = self.switch_on[:count]
+
+        light = kind == LIGHT
+        motion = (kind == MOTION) & switch_on
+        therm = (kind == THERM) & switch_on
+        sensing = light | motion | therm
+
+        # Take the step (or the simulated value) of every sensing device
+        if values is None:
+            steps = self._rng.integers(-2, 3, count).astype(np.float64)
+            small_steps = self._rng.integers(-1, 2, count).astype(np.float64)
+            steps[motion] = small_steps[motion]
+            steps[therm] = np.round(small_steps[therm] / 10, 1)
+            new_value = value + steps
+        else:
+            new_value = np.asarray(values, dtype=np.float64)[:count]
+        value[sensing] = new_value[sensing]
+
+        value[light] = np.clip(value[light], 0, 100)
+        value[motion] = np.clip(value[motion], 0, 10)
+
+        # Lights switch off at or over the threshold and back on under it
+        over = active & (value >= threshold)
+        switched_off = light & switch_on & over
+        switch_on[switched_off] = False
+        switched_on = light & ~switch_on & active & (value < threshold)
+        switch_on[switched_on] = True
+
+        # Thermostats cap the temperature at the threshold
+        capped = therm & over
+        value[capped] = threshold[capped]
+
+        return {
+            "off": np.flatnonzero(switched_off),
+            "on": np.flatnonzero(switched_on),
+            "motion": np.flatnonzero(motion & over),
+            "capped": np.flatnonzero(capped),
+        }
@@ -0,0 +1,478 @@
+"""
+Module with the encrypted store of the HUB's device registry. Instead of re-encrypting and rewriting
+the whole device list every time a device registers, every change is appended to a log as a single
+record: one Fernet token (which is plain base64, so it never contains a newline) per line. Loading
+reads the log line by line and replays the records. Since a device registering again (or changing
+type) only adds records, the log is compacted every so often by writing the current registry to a
+new file and atomically replacing the log with it, so a crash never leaves a half-written log behind
+
+Records look like: {"op": "put", "devid": "Light1", "devtype": "SmartLight"} or {"op": "del",
+"devid": "Light1"}
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from cryptography.fernet import InvalidToken
+
+import utils
+
+# Set logging level to logging.ERROR to view error logs
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+# Default path of the registry log
+REGISTRY_FILE = "./stored_devices.log"
+
+# The device list file written by older versions of the HUB (the whole list in one Fernet token);
+# it is migrated into the log the first time the log is loaded
+LEGACY_REGISTRY_FILE = "./stored_devices.bin"
+
+# The log is compacted once it holds this many times more records than there are devices...
+COMPACT_RATIO = 4
+
+# ...and at least this many records, so that small logs aren't compacted over and over
+COMPACT_MIN_RECORDS = 256
+
+# The write-behind persister saves registry changes at most this many seconds after they are made...
+FLUSH_WINDOW = 0.5
+
+# ...or as soon as this many changes are waiting
+FLUSH_MAX_CHANGES = 256
+
+
+class RegistryStore:
+    """
+    The RegistryStore class keeps the device registry (device id -> device type) in an encrypted
+    append-only log. The store keeps a copy of the registry so that it can compact the log on its
+    own. It is safe to use from several threads.
+
+    Attributes:
+        path (str): Path of the log file. devices (dict): The device type of each registered device
+        keyed by device id, as in the log. records (int): Number of records in the log.
+
+    Example usage:
+        store = RegistryStore("./stored_devices.log", fer_key) devices = store.load()
+        store.put("Light1", "SmartLight")
+    """
+
+    def __init__(
+        self,
+        path,
+        fer_key,
+        compact_ratio=COMPACT_RATIO,
+        compact_min_records=COMPACT_MIN_RECORDS,
+    ):
+        """
+        Initialize a new RegistryStore instance.
+
+        Args:
+            path (str): Path of the log file. fer_key (bytes): Fernet key used to encrypt the
+            records. compact_ratio (int): Compact once the log holds this many records per device.
+            compact_min_records (int): Don't compact logs with fewer records than this.
+        """
+        self.path = path
+        self.devices = {}
+        self.records = 0
+        self.compact_ratio = compact_ratio
+        self.compact_min_records = compact_min_records
+        self._cipher = utils.KEYRING.fernet(fer_key)
+        self._fer_key = fer_key
+        self._lock = threading.Lock()
+        self._file = None
+
+    def load(self, legacy_path=None):
+        """
+        Load the registry by replaying the log. A record that can't be decrypted (e.g. the last one,
+        if the HUB crashed while appending it) is skipped, and the log is compacted right away so
+        that the next record isn't appended to the broken one.
+
+        Args:
+            legacy_path (str): Optional path of a device list written by older versions of the HUB,
+            migrated into the log if there is no log yet.
+
+        Returns:
+            dict: The device type of each registered device keyed by device id.
+        """
+        with self._lock:
+            self.devices = {}
+            self.records = 0
+
+            if not os.path.exists(self.path):
+                if legacy_path is not None and os.path.exists(legacy_path):
+                    self._migrate(legacy_path)
+                return dict(self.devices)
+
+            unreadable = 0
+            try:
+                with open(self.path, "rb") as log:
+                    for line in log:
+                        line = line.strip()
+                        if line and not self._replay(line):
+                            unreadable += 1
+            except OSError as e:
+                logging.error(
+                    "Error loading device registry: %s",
+                    e,
+                    exc_info=True,
+                )
+
+            if unreadable:
+                self._compact()
+
+            return dict(self.devices)
+
+    def _replay(self, line):
+        """
+        Apply a single record of the log to the registry.
+
+        Args:
+            line (bytes): The Fernet token of the record.
+
+        Returns:
+            bool: True if the record could be read, False otherwise.
+        """
+        self.records += 1
+        try:
+            record = json.loads(self._cipher.decrypt(line).decode("utf-8"))
+        except (InvalidToken, ValueError) as e:
+            logging.error("Skipping unreadable device registry record: %s", e)
+            return False
+
+        if record.get("op") == "put":
+            self.devices[record["devid"]] = record["devtype"]
+        elif record.get("op") == "del":
+            self.devices.pop(record["devid"], None)
+        return True
+
+    def _migrate(self, legacy_path):
+        """
+        Migrate a device list written by older versions of the HUB into a new log.
+
+        Args:
+            legacy_path (str): Path of the old device list.
+        """
+        devlist = utils.load_and_decrypt_fernet(self._fer_key, legacy_path)
+        if not devlist:
+            return
+
+        self.devices = {k: devlist[k]["devtype"] for k in devlist}
+        if self._compact():
+            print(f"Migrated {len(self.devices)} devices from {legacy_path} to {self.path}")
+
+    def _encrypt_record(self, record):
+        """
+        Encrypt a record into a line of the log.
+
+        Args:
+            record (dict): The record.
+
+        Returns:
+            bytes: The Fernet token of the record followed by a newline.
+        """
+        return self._cipher.encrypt(json.dumps(record).encode("utf-8")) + b"\n"
+
+    def _append(self, *records):
+        """
+        Append records to the log, making sure they have reached the disk before returning. All the
+        records go out in a single write (and a single fsync).
+
+        Args:
+            records (dict): The records.
+
+        Returns:
+            bool: True if the records were appended, False otherwise.
+        """
+        try:
+            if self._file is None:
+                self._file = open(self.path, "ab")
+            self._file.write(b"".join(self._encrypt_record(record) for record in records))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.records += len(records)
+            return True
+
+        except OSError as e:
+            logging.error(
+                "Error appending to device registry: %s",
+                e,
+                exc_info=True,
+            )
+            return False
+
+    def put(self, deviceid, devtype):
+        """
+        Record a registered device (or a change of its device type).
+
+        Args:
+            deviceid (str): The device id. devtype (str): The device type.
+
+        Returns:
+            bool: True if the record was saved, False otherwise.
+        """
+        with self._lock:
+            if self.devices.get(deviceid) == devtype:
+                return True
+            if not self._append({"op": "put", "devid": deviceid, "devtype": devtype}):
+                return False
+            self.devices[deviceid] = devtype
+            self._maybe_compact()
+            return True
+
+    def delete(self, deviceid):
+        """
+        Remove a device from the registry.
+
+        Args:
+            deviceid (str): The device id.
+
+        Returns:
+            bool: True if the record was saved, False otherwise.
+        """
+        with self._lock:
+            if deviceid not in self.devices:
+                return True
+            if not self._append({"op": "del", "devid": deviceid}):
+                return False
+            del self.devices[deviceid]
+            self._maybe_compact()
+            return True
+
+    def apply(self, changes):
+        """
+        Record several changes to the registry at once.
+
+        Args:
+            changes (dict): The new device type of each changed device keyed by device id, or None
+            for a device to remove.
+
+        Returns:
+            bool: True if the records were saved, False otherwise.
+        """
+        with self._lock:
+            records = []
+            for deviceid, devtype in changes.items():
+                if devtype is None and deviceid in self.devices:
+                    records.append({"op": "del", "devid": deviceid})
+                elif devtype is not None and self.devices.get(deviceid) != devtype:
+                    records.append({"op": "put", "devid": deviceid, "devtype": devtype})
+
+            if not records:
+                return True
+            if not self._append(*records):
+                return False
+
+            for deviceid, devtype in changes.items():
+                if devtype is None:
+                    self.devices.pop(deviceid, None)
+                else:
+                    self.devices[deviceid] = devtype
+            self._maybe_compact()
+            return True
+
+    def _maybe_compact(self):
+        """Compact the log if it has grown too far beyond the size of the registry."""
+        if self.records >= max(self.compact_min_records, self.compact_ratio * len(self.devices)):
+            self._compact()
+
+    def compact(self):
+        """
+        Rewrite the log with one record per registered device.
+
+        Returns:
+            bool: True if the log was compacted, False otherwise.
+        """
+        with self._lock:
+            return self._compact()
+
+    def _compact(self):
+        """
+        Rewrite the log with one record per registered device. The new log is written to a
+        temporary file first and then moved over the old one, which is atomic, so the log on disk
+        is always either the old or the new one.
+
+        Returns:
+            bool: True if the log was compacted, False otherwise.
+        """
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as log:
+                log.writelines(
+                    self._encrypt_record({"op": "put", "devid": k, "devtype": v})
+                    for k, v in self.devices.items()
+                )
+                log.flush()
+                os.fsync(log.fileno())
+
+            self._close_log()
+            os.replace(tmp_path, self.path)
+            self.records = len(self.devices)
+            return True
+
+        except OSError as e:
+            logging.error(
+                "Error compacting device registry: %s",
+                e,
+                exc_info=True,
+            )
+            return False
+
+    def close(self):
+        """Close the log file; it is opened again by the next append."""
+        with self._lock:
+            self._close_log()
+
+    def _close_log(self):
+        """Close the log file (the caller holds the lock)."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class WriteBehindPersister:
+    """
+    The WriteBehindPersister class saves registry changes in the background, so that registering a
+    device never waits for encryption or disk I/O. Changes are collected for up to a time window
+    (or until enough of them are waiting) and then written to the store in one go; several changes
+    of the same device within the window only write its latest state.
+
+    Attributes:
+        store (RegistryStore): The store changes are written to. window (float): Number of seconds
+        changes are collected for before they are written. max_changes (int): Number of waiting
+        changes that triggers a write straight away. on_flush (callable): Optional function called
+        (in the writing thread) with the number of changes written and whether writing worked.
+
+    Example usage:
+        persister = WriteBehindPersister(store) persister.submit("Light1", "SmartLight") ...
+        persister.close()
+    """
+
+    def __init__(
+        self, store, window=FLUSH_WINDOW, max_changes=FLUSH_MAX_CHANGES, on_flush=None
+    ):
+        """Initialize a new WriteBehindPersister instance and start its writing thread."""
+        self.store = store
+        self.window = window
+        self.max_changes = max_changes
+        self.on_flush = on_flush
+        self._pending = {}
+        self._first_change = None
+        self._closing = False
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, deviceid, devtype):
+        """
+        Queue a registered device (or a change of its device type) to be saved. Doesn't block.
+
+        Args:
+            deviceid (str): The device id. devtype (str): The device type, or None to remove the
+            device.
+        """
+        with self._cond:
+            if self._closing:
+                raise RuntimeError("Persister is closed")
+            if not self._pending:
+                self._first_change = time.monotonic()
+            self._pending[deviceid] = devtype
+
+            # Wake the writing thread up to start timing the window, or to write straight away
+            if len(self._pending) == 1 or len(self._pending) >= self.max_changes:
+                self._cond.notify()
+
+    def remove(self, deviceid):
+        """
+        Queue a device to be removed from the registry. Doesn't block.
+
+        Args:
+            deviceid (str): The device id.
+        """
+        self.submit(deviceid, None)
+
+    def _write_pending(self):
+        """
+        Write all waiting changes to the store. If writing fails, the changes are put back to be
+        written again after another window (unless the same device has changed again since).
+
+        Returns:
+            bool: True if writing worked (or there was nothing to write), False otherwise.
+        """
+        # Holding the write lock while taking the changes makes sure batches reach the store in the
+        # order they were taken, whichever thread writes them
+        with self._write_lock:
+            with self._cond:
+                changes, self._pending = self._pending, {}
+                self._first_change = None
+
+            if not changes:
+                return True
+
+            try:
+                saved = self.store.apply(changes)
+            except Exception as e:  # pylint: disable=broad-except
+                logging.error(
+                    "Error saving device registry changes: %s",
+                    e,
+                    exc_info=True,
+                )
+                saved = False
+
+            if not saved:
+                with self._cond:
+                    for deviceid, devtype in changes.items():
+                        # A newer change of the same device replaces the one that failed
+                        self._pending.setdefault(deviceid, devtype)
+                    if self._first_change is None:
+                        self._first_change = time.monotonic()
+                    self._cond.notify()
+
+            if self.on_flush is not None:
+                self.on_flush(len(changes), saved)
+            return saved
+
+    def _run(self):
+        """Body of the writing thread."""
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    self._cond.wait()
+
+                # Wait for the window to pass or enough changes to pile up. flush() may write the
+                # changes in the meantime, so check that there still are some after every wait
+                while (
+                    self._pending
+                    and not self._closing
+                    and len(self._pending) < self.max_changes
+                ):
+                    remaining = self._first_change + self.window - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                closing = self._closing
+
+            self._write_pending()
+            if closing:
+                return
+
+    def flush(self):
+        """
+        Write all waiting changes now, returning once they are on disk.
+
+        Returns:
+            bool: True if writing worked, False otherwise.
+        """
+        return self._write_pending()
+
+    def close(self):
+        """Write all waiting changes and stop the writing thread."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._thread.join()
+        self._write_pending()
+        self.store.close()
@@ -0,0 +1,299 @@
+"""
+Module with the HUB's rules (automation) engine. Rules are written as e.g.
+
+    if Motion1.motion >= threshold then Light1 set_on
+    if Therm1.temp > Therm2.temp then Therm2 set_thres 25
+    if Light1.switch == off then Motion1 set_off
+
+i.e. a condition comparing a reading of a device with a number, a status or switch value (active,
+inactive, on, off), another reading of the same device (e.g. threshold) or a reading of another
+device (Device.field), and an action (with an optional value) to send to a device when the
+condition becomes true
+
+Rules are compiled into an index keyed by (device id, field), so that each new reading only
+evaluates the rules that use it, however many rules there are. Rules are edge-triggered: the action
+is sent when the condition goes from false (or unknown) to true, not on every reading for which it
+holds, so a rule doesn't keep firing while e.g. the motion stays over the threshold
+"""
+
+import logging
+import operator
+
+from model.device import STATUSES, SWITCHES
+
+# Set logging level to logging.ERROR to view error logs
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+# Default path of the rules file: one rule per line, lines starting with '#' are comments
+RULES_FILE = "./rules.txt"
+
+# The comparison operators rules can use
+OPERATORS = {
+    ">=": operator.ge,
+    ">": operator.gt,
+    "<=": operator.le,
+    "<": operator.lt,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+
+def _operand(text, deviceid):
+    """
+    Parse the right-hand side of a condition.
+
+    Args:
+        text (str): The operand. deviceid (str): The device of the left-hand side, for operands
+        naming a field only.
+
+    Returns:
+        tuple: ('const', value) for a constant, or ('field', (device id, field)) for a reading.
+    """
+    try:
+        return "const", float(text)
+    except ValueError:
+        pass
+    if text in STATUSES or text in SWITCHES:
+        return "const", text
+    if "." in text:
+        return "field", tuple(text.split(".", 1))
+    return "field", (deviceid, text)
+
+
+class Rule:
+    """
+    The Rule class is one compiled rule (see the module docstring).
+
+    Attributes:
+        text (str): The rule as written. left (tuple): The (device id, field) of the left-hand side.
+        op (str): The comparison operator. right (tuple): The right-hand side, see _operand().
+        target (str): The device to send the action to. action (str): The action. value (float):
+        Optional value sent with the action (e.g. for set_thres). active (bool): Whether the
+        condition held at the last evaluation. fired (int): Number of times the rule has fired.
+    """
+
+    __slots__ = (
+        "text",
+        "left",
+        "op",
+        "right",
+        "target",
+        "action",
+        "value",
+        "active",
+        "fired",
+        "_compare",
+    )
+
+    def __init__(self, text):
+        """
+        Compile a rule.
+
+        Args:
+            text (str): The rule, e.g. 'if Motion1.motion >= threshold then Light1 set_on'.
+
+        Raises:
+            ValueError: If the rule can't be parsed.
+        """
+        words = text.split()
+        if len(words) not in (7, 8) or words[0] != "if" or words[4] != "then":
+            raise ValueError(
+                f"Invalid rule '{text}' (expected 'if Device.field op operand then Device action"
+                " [value]')"
+            )
+        if "." not in words[1] or words[2] not in OPERATORS:
+            raise ValueError(f"Invalid condition in rule '{text}'")
+
+        self.text = " ".join(words)
+        self.left = tuple(words[1].split(".", 1))
+        self.op = words[2]
+        self.right = _operand(words[3], self.left[0])
+        self.target = words[5]
+        self.action = words[6]
+        self.value = None
+        if len(words) == 8:
+            try:
+                self.value = float(words[7])
+            except ValueError:
+                raise ValueError(f"Invalid action value in rule '{text}'") from None
+        self.active = False
+        self.fired = 0
+        self._compare = OPERATORS[self.op]
+
+    def keys(self):
+        """
+        Get the readings the condition uses.
+
+        Returns:
+            list: The (device id, field) of each reading.
+        """
+        return [self.left] + ([self.right[1]] if self.right[0] == "field" else [])
+
+    def evaluate(self, values):
+        """
+        Evaluate the condition.
+
+        Args:
+            values (dict): The latest value of each reading keyed by (device id, field).
+
+        Returns:
+            bool: Whether the condition holds (False if a reading is missing or the values can't be
+            compared).
+        """
+        left = values.get(self.left)
+        kind, right = self.right
+        if kind == "field":
+            right = values.get(right)
+        if left is None or right is None:
+            return False
+        try:
+            return bool(self._compare(left, right))
+        except TypeError:
+            return False
+
+    def message(self):
+        """
+        Build the message sent to the target device when the rule fires.
+
+        Returns:
+            dict: The message.
+        """
+        msg = {"action": self.action}
+        if self.value is not None:
+            msg["value"] = int(self.value) if self.value.is_integer() else self.value
+        return msg
+
+    def __str__(self):
+        return self.text
+
+
+class RuleEngine:
+    """
+    The RuleEngine class keeps the rules, indexed by the readings they use, and the latest value
+    of each of those readings. It is meant to be fed from the HUB server's readings listeners, so
+    it is used from the event loop only (rules added from another thread should go through
+    loop.call_soon_threadsafe()).
+
+    Attributes:
+        rules (list): The rules, in the order they were added. on_fire (callable): Function called
+        with the rule whenever a rule fires.
+
+    Example usage:
+        engine = RuleEngine(on_fire=send_action) engine.add("if Motion1.motion >= threshold then
+        Light1 set_on") server.readings_listeners.append(engine.update)
+    """
+
+    def __init__(self, on_fire=None):
+        """Initialize a new (empty) RuleEngine instance."""
+        self.rules = []
+        self.on_fire = on_fire
+        self._index = {}
+        self._values = {}
+
+    def add(self, text):
+        """
+        Compile a rule and add it to the index.
+
+        Args:
+            text (str): The rule.
+
+        Returns:
+            Rule: The compiled rule.
+
+        Raises:
+            ValueError: If the rule can't be parsed.
+        """
+        rule = Rule(text)
+        self.rules.append(rule)
+        for key in rule.keys():
+            self._index.setdefault(key, []).append(rule)
+        rule.active = rule.evaluate(self._values)
+        return rule
+
+    def remove(self, rule):
+        """
+        Remove a rule.
+
+        Args:
+            rule (Rule): The rule.
+        """
+        self.rules.remove(rule)
+        for key in rule.keys():
+            rules = self._index[key]
+            rules.remove(rule)
+            if not rules:
+                del self._index[key]
+
+    def load(self, path=RULES_FILE):
+        """
+        Add the rules of a rules file, skipping (and logging) the rules that can't be parsed.
+
+        Args:
+            path (str): Path of the rules file.
+
+        Returns:
+            int: Number of rules added.
+        """
+        count = 0
+        try:
+            with open(path, "r", encoding="utf-8") as rules_file:
+                for line in rules_file:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    try:
+                        self.add(line)
+                        count += 1
+                    except ValueError as e:
+                        logging.error("Error loading rule: %s", e)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error(
+                "Error loading rules: %s",
+                e,
+                exc_info=True,
+            )
+        return count
+
+    def update(self, deviceid, readings):
+        """
+        Take in new readings of a device and fire the rules whose conditions they make true. The
+        signature matches the HUB server's readings listeners.
+
+        Args:
+            deviceid (str): The device id. readings (dict): The readings.
+
+        Returns:
+            list: The rules fired.
+        """
+        # Find the rules using the readings that changed, without duplicates
+        affected = {}
+        for field, value in readings.items():
+            key = (deviceid, field)
+            rules = self._index.get(key)
+            if rules is None or self._values.get(key) == value:
+                continue
+            self._values[key] = value
+            for rule in rules:
+                affected[id(rule)] = rule
+
+        fired = []
+        for rule in affected.values():
+            active = rule.evaluate(self._values)
+            if active and not rule.active:
+                rule.fired += 1
+                fired.append(rule)
+            rule.active = active
+
+        for rule in fired:
+            if self.on_fire is not None:
+                try:
+                    self.on_fire(rule)
+                except Exception as e:  # pylint: disable=broad-except
+                    logging.error(
+                        "Error firing rule: %s",
+                        e,
+                        exc_info=True,
+                    )
+        return fired
@@ -0,0 +1,322 @@
+"""
+Module with the tick scheduler used to drive the simulated devices' sensors. Instead of one thread
+per device sleeping between updates, every periodic job (e.g. one device's sense()) sits in a single
+heap ordered by when it is next due, and one scheduler thread sleeps until the earliest job, runs it
+and puts it back for its next tick. This way many simulated devices cost one thread
+
+Ticks are kept on a fixed-rate grid: each job's next tick is worked out from when it was due rather
+than from when it actually ran, so slow callbacks or a late wake-up don't make the job drift. Ticks
+that are missed entirely (e.g. the machine was suspended) are skipped rather than run in a burst.
+Each tick can be moved by a random jitter, and jobs start at a random point of their first interval,
+so that many devices with the same rate don't all fire at the same moment
+"""
+
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+# Set logging level to logging.ERROR to view error logs
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+class Job:
+    """
+    The Job class is a periodic job of a TickScheduler. Instances are kept small (using __slots__)
+    since a scheduler may hold thousands of them.
+
+    Attributes:
+        callback (callable): Function called (with no arguments) on every tick. interval (float):
+        Number of seconds between ticks. jitter (float): Each tick runs up to this many seconds
+        before or after it is due. due (float): When the next tick is due (on the fixed-rate grid).
+        when (float): When the next tick runs (due moved by the jitter). runs (int): Number of ticks
+        run so far. missed (int): Number of ticks skipped because the scheduler fell behind.
+        cancelled (bool): Whether the job has been cancelled.
+    """
+
+    __slots__ = (
+        "callback",
+        "interval",
+        "jitter",
+        "due",
+        "when",
+        "runs",
+        "missed",
+        "cancelled",
+    )
+
+    def __init__(self, callback, interval, jitter, due):
+        """Initialize a new Job instance."""
+        self.callback = callback
+        self.interval = interval
+        self.jitter = jitter
+        self.due = due
+        self.when = due
+        self.runs = 0
+        self.missed = 0
+        self.cancelled = False
+
+
+class TickScheduler:
+    """
+    The TickScheduler class runs periodic jobs at fixed rates from a single thread (see the module
+    docstring). Jobs can be added, changed and cancelled from any thread, including from within a
+    callback.
+
+    Attributes:
+        clock (callable): Function returning the current time in seconds (time.monotonic by
+        default).
+
+    Example usage:
+        scheduler = TickScheduler() scheduler.start() job = scheduler.schedule(device.sense, 5,
+        jitter=0.5) ... scheduler.stop()
+    """
+
+    def __init__(self, clock=time.monotonic, seed=None):
+        """
+        Initialize a new TickScheduler instance.
+
+        Args:
+            clock (callable): Function returning the current time in seconds. seed (int): Optional
+            seed of the random jitter and start offsets, to repeat a simulation.
+        """
+        self.clock = clock
+        self._heap = []
+        self._cancelled = 0
+        self._counter = itertools.count()
+        self._random = random.Random(seed)
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    def schedule(self, callback, interval, jitter=0.0, delay=None):
+        """
+        Add a periodic job.
+
+        Args:
+            callback (callable): Function called (with no arguments) on every tick. interval
+            (float): Number of seconds between ticks. jitter (float): Each tick runs up to this
+            many seconds before or after it is due. delay (float): Number of seconds until the
+            first tick, or None for a random point of the first interval.
+
+        Returns:
+            Job: The job, to change or cancel it later.
+
+        Raises:
+            ValueError: If the interval isn't positive or the jitter is negative.
+        """
+        if interval <= 0:
+            raise ValueError("The interval must be positive")
+        if jitter < 0:
+            raise ValueError("The jitter can't be negative")
+
+        if delay is None:
+            delay = self._random.uniform(0, interval)
+
+        with self._cond:
+            job = Job(callback, interval, jitter, self.clock() + delay)
+            self._push(job)
+            return job
+
+    def _push(self, job):
+        """
+        Put a job on the heap for its next tick (the caller holds the lock).
+
+        Args:
+            job (Job): The job.
+        """
+        job.when = job.due
+        if job.jitter:
+            job.when += self._random.uniform(-job.jitter, job.jitter)
+
+        heapq.heappush(self._heap, (job.when, next(self._counter), job))
+
+        # Wake the scheduler thread up if this job is now the earliest one
+        if self._heap[0][2] is job:
+            self._cond.notify()
+
+    def reschedule(self, job, interval, jitter=None):
+        """
+        Change the rate of a job. The next tick is moved to one new interval after the last tick
+        (or right away, if that is already past), rather than waiting for the tick that was due at
+        the old rate.
+
+        Args:
+            job (Job): The job. interval (float): The new number of seconds between ticks. jitter
+            (float): The new jitter, or None to keep it.
+
+        Raises:
+            ValueError: If the interval isn't positive or the jitter is negative.
+        """
+        if interval <= 0:
+            raise ValueError("The interval must be positive")
+        if jitter is not None and jitter < 0:
+            raise ValueError("The jitter can't be negative")
+
+        with self._cond:
+            if jitter is not None:
+                job.jitter = jitter
+            if job.cancelled:
+                job.interval = interval
+                return
+
+            # The queued entry is at the old rate: drop it from the heap and queue the job again,
+            # due one new interval after the last tick (due - interval) but not before now
+            self._heap = [entry for entry in self._heap if entry[2] is not job]
+            heapq.heapify(self._heap)
+            job.due = max(job.due - job.interval + interval, self.clock())
+            job.interval = interval
+            self._push(job)
+
+    def cancel(self, job):
+        """
+        Cancel a job. A tick that is already running finishes, but no more ticks are run.
+
+        Args:
+            job (Job): The job.
+        """
+        with self._cond:
+            if job.cancelled:
+                return
+            job.cancelled = True
+            self._cancelled += 1
+
+            # Cancelled jobs are dropped as they reach the top of the heap; once they make up most
+            # of it, rebuild the heap without them so that it doesn't keep growing
+            if self._cancelled > len(self._heap) // 2:
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap) - self._cancelled
+
+    def next_time(self):
+        """
+        Get when the next tick runs.
+
+        Returns:
+            float: The time of the earliest tick, or None if there are no jobs.
+        """
+        with self._cond:
+            self._drop_cancelled()
+            return self._heap[0][0] if self._heap else None
+
+    def _drop_cancelled(self):
+        """Drop cancelled jobs from the top of the heap (the caller holds the lock)."""
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+            self._cancelled -= 1
+
+    def _take_due(self, now):
+        """
+        Take the next job that is due out of the heap and schedule its next tick (the caller holds
+        the lock).
+
+        Args:
+            now (float): The current time.
+
+        Returns:
+            Job: The job to run, or None if no job is due.
+        """
+        self._drop_cancelled()
+        if not self._heap or self._heap[0][0] > now:
+            return None
+
+        _, _, job = heapq.heappop(self._heap)
+
+        # Next tick on the fixed-rate grid; if the scheduler has fallen more than a whole interval
+        # behind, skip the ticks that were missed instead of running them all at once
+        job.due += job.interval
+        if job.due <= now:
+            missed = int((now - job.due) // job.interval) + 1
+            job.missed += missed
+            job.due += missed * job.interval
+
+        job.runs += 1
+        self._push(job)
+        return job
+
+    def run_pending(self, now=None):
+        """
+        Run every tick that is due, in the calling thread.
+
+        Args:
+            now (float): The current time, or None to read the clock.
+
+        Returns:
+            int: The number of ticks run.
+        """
+        if now is None:
+            now = self.clock()
+
+        count = 0
+        while True:
+            with self._cond:
+                job = self._take_due(now)
+            if job is None:
+                return count
+            self._run(job)
+            count += 1
+
+    def _run(self, job):
+        """
+        Run one tick of a job, logging any error so that one failing job doesn't stop the others.
+
+        Args:
+            job (Job): The job.
+        """
+        try:
+            job.callback()
+        except Exception as e:  # pylint: disable=broad-except
+            logging.error(
+                "Error running scheduled job: %s",
+                e,
+                exc_info=True,
+            )
+
+    def _loop(self):
+        """Body of the scheduler thread."""
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    now = self.clock()
+                    job = self._take_due(now)
+                    if job is not None:
+                        break
+
+                    # Sleep until the earliest tick (or until a new job or stop() wakes us up)
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+            self._run(job)
+
+    def start(self):
+        """Start the scheduler thread."""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the scheduler thread, waiting for a tick that is running to finish. The jobs are kept,
+        so the scheduler can be started again.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait for the thread, or None to wait
+            until it has stopped.
+        """
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+            self._cond.notify_all()
+
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
@@ -0,0 +1,453 @@
+"""
+Module with the HUB's on-disk telemetry store, which keeps the reading history of the devices for
+longer than the in-memory time-series store (see timeseries.py) can. The readings are written as
+fixed-size records into segment files, one series of segments per device type, each record laid
+out from the get_readings() of the device class (e.g. a SmartLight record holds the time, the
+identifier, the status, the threshold, the switch and the brightness). Segment files are
+memory-mapped, so writing a record is a memory write, and reading a segment back is a NumPy view of
+the mapped file: scanning weeks of history costs reading the files, not parsing JSON
+
+A segment file is a small header (magic, number of records, capacity and record size) followed by
+the records. Once a segment is full it is sealed and a new one is started. If the store is given a
+Fernet key, sealed segments are encrypted at rest: the segment is replaced by a single Fernet token
+of its contents (a '.seg.enc' file), which is decrypted into memory when read. The segment being
+written to is not encrypted until it is sealed (when full, or when the store is closed). Full
+segments are sealed by a background thread, so that recording readings (on the HUB server's event
+loop) never waits for a segment to be flushed and encrypted
+
+Files are named after the device type and a sequence number, e.g. 'SmartLight-000003.seg'
+"""
+
+import glob
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import utils
+from model.device import STATUSES, SWITCHES, MotionSensor, SmartLight, SmartLock, Thermostat
+
+# Set logging level to logging.ERROR to view error logs
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+# Default directory of the segment files
+TELEMETRY_DIR = "./telemetry"
+
+# Number of records per segment
+SEGMENT_RECORDS = 65536
+
+# Number of bytes kept for device identifiers in the records (longer ones are cut short)
+ID_SIZE = 32
+
+# The header at the start of every segment file
+MAGIC = b"SHTSEG01"
+HEADER = np.dtype([("magic", "S8"), ("count", "<u8"), ("capacity", "<u8"), ("itemsize", "<u8")])
+HEADER_SIZE = 64
+
+# The device classes whose readings are stored
+DEVICE_CLASSES = (SmartLight, MotionSensor, SmartLock, Thermostat)
+
+
+def record_dtype(device_cls):
+    """
+    Build the record layout of a device class from the readings of an instance: the time, the
+    identifier (as bytes), the status and switch (as booleans: True for 'active' and 'on') and the
+    numeric readings (as floats), in the order get_readings() returns them.
+
+    Args:
+        device_cls (type): The device class.
+
+    Returns:
+        numpy.dtype: The record layout.
+    """
+    fields = [("time", "<f8")]
+    for field, value in device_cls("schema").get_readings().items():
+        if field == "identifier":
+            fields.append((field, f"S{ID_SIZE}"))
+        elif value in STATUSES or value in SWITCHES:
+            fields.append((field, "?"))
+        else:
+            fields.append((field, "<f8"))
+    return np.dtype(fields)
+
+
+# The record layout of each device type
+RECORD_TYPES = {device_cls.__name__: record_dtype(device_cls) for device_cls in DEVICE_CLASSES}
+
+
+class Segment:
+    """
+    The Segment class is one memory-mapped segment file being written to.
+
+    Attributes:
+        path (str): Path of the segment file. dtype (numpy.dtype): The record layout. capacity
+        (int): Number of records the segment has room for. sequence (int): The sequence number of
+        the segment in its series.
+    """
+
+    def __init__(self, path, dtype, capacity=SEGMENT_RECORDS):
+        """
+        Open a segment file, creating it if it doesn't exist.
+
+        Args:
+            path (str): Path of the segment file. dtype (numpy.dtype): The record layout. capacity
+            (int): Number of records of a new segment (existing ones keep their own).
+
+        Raises:
+            ValueError: If the file isn't a segment of this record layout.
+        """
+        self.path = path
+        self.dtype = dtype
+        self.sequence = int(os.path.basename(path).split(".")[0].rsplit("-", 1)[1])
+
+        if not os.path.exists(path):
+            header = np.zeros(1, dtype=HEADER)
+            header["magic"] = MAGIC
+            header["capacity"] = capacity
+            header["itemsize"] = dtype.itemsize
+            with open(path, "wb") as segment:
+                segment.write(header.tobytes().ljust(HEADER_SIZE, b"\0"))
+                segment.truncate(HEADER_SIZE + capacity * dtype.itemsize)
+
+        self._header = np.memmap(path, dtype=HEADER, mode="r+", shape=(1,))
+        if self._header["magic"][0] != MAGIC or self._header["itemsize"][0] != dtype.itemsize:
+            raise ValueError(f"{path} isn't a segment of {dtype.itemsize} byte records")
+
+        self.capacity = int(self._header["capacity"][0])
+        self._records = np.memmap(
+            path, dtype=dtype, mode="r+", offset=HEADER_SIZE, shape=(self.capacity,)
+        )
+
+    def __len__(self):
+        return int(self._header["count"][0])
+
+    @property
+    def full(self):
+        """bool: Whether the segment has no room for more records."""
+        return len(self) >= self.capacity
+
+    def append(self, record):
+        """
+        Write a record after the last one.
+
+        Args:
+            record (tuple): The values of the record's fields, in order.
+        """
+        count = len(self)
+        self._records[count] = record
+        self._header["count"] = count + 1
+
+    def last_time(self):
+        """
+        Get the time of the last record.
+
+        Returns:
+            float: The time, or None if the segment is empty.
+        """
+        count = len(self)
+        return float(self._records["time"][count - 1]) if count else None
+
+    def records(self):
+        """
+        Get the records written so far.
+
+        Returns:
+            numpy.ndarray: A view of the mapped records (not a copy).
+        """
+        return self._records[: len(self)]
+
+    def flush(self):
+        """Write the changed pages of the mapping back to the file."""
+        self._records.flush()
+        self._header.flush()
+
+    def close(self):
+        """Flush and unmap the segment."""
+        self.flush()
+        del self._records, self._header
+
+
+def read_segment(path, dtype, cipher=None):
+    """
+    Read the records of a sealed (or idle) segment file.
+
+    Args:
+        path (str): Path of the segment file. dtype (numpy.dtype): The record layout. cipher
+        (Fernet): The cipher of encrypted ('.seg.enc') segments.
+
+    Returns:
+        numpy.ndarray: The records, as a read-only view of the mapped file or, for encrypted
+        segments, of the decrypted contents.
+
+    Raises:
+        ValueError: If the file isn't a segment of this record layout.
+    """
+    if path.endswith(".enc"):
+        with open(path, "rb") as segment:
+            data = cipher.decrypt(segment.read())
+        header = np.frombuffer(data, dtype=HEADER, count=1)
+    else:
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+        header = data[: HEADER.itemsize].view(HEADER)
+
+    if header["magic"][0] != MAGIC or header["itemsize"][0] != dtype.itemsize:
+        raise ValueError(f"{path} isn't a segment of {dtype.itemsize} byte records")
+
+    count = int(header["count"][0])
+    return np.frombuffer(data, dtype=dtype, count=count, offset=HEADER_SIZE)
+
+
+class TelemetryStore:
+    """
+    The TelemetryStore class writes the readings of the devices into segment files (see the module
+    docstring) and scans them back. Readings are recorded by the HUB server's event loop while
+    scans may come from other threads, so every access is made under a lock.
+
+    Attributes:
+        directory (str): Directory of the segment files. segment_records (int): Number of records
+        per segment.
+
+    Example usage:
+        store = TelemetryStore("./telemetry", fer_key) store.record("Light1", "SmartLight",
+        readings) for records in store.scan("SmartLight", start=time.time() - 86400): ...
+        store.close()
+    """
+
+    def __init__(self, directory=TELEMETRY_DIR, fer_key=None, segment_records=SEGMENT_RECORDS):
+        """
+        Initialize a new TelemetryStore instance.
+
+        Args:
+            directory (str): Directory of the segment files, created if it doesn't exist. fer_key
+            (bytes): Optional Fernet key used to encrypt sealed segments. segment_records (int):
+            Number of records per new segment.
+        """
+        self.directory = directory
+        self.segment_records = segment_records
+        self._cipher = utils.KEYRING.fernet(fer_key) if fer_key is not None else None
+        self._segments = {}
+        self._lock = threading.Lock()
+        # One thread seals the full segments, in the order they filled up
+        self._sealer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="telemetry-seal")
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, devtype):
+        """
+        List the segment files of a device type, oldest first.
+
+        Args:
+            devtype (str): The device type.
+
+        Returns:
+            list: The paths.
+        """
+        paths = {}
+        for path in glob.glob(os.path.join(self.directory, f"{devtype}-*.seg*")):
+            name, _, extension = os.path.basename(path).partition(".")
+            # A segment being sealed briefly exists both plain and encrypted; the encrypted file
+            # is complete as soon as it exists
+            if extension == "seg.enc" or (extension == "seg" and name not in paths):
+                paths[name] = path
+        return [paths[name] for name in sorted(paths)]
+
+    def _segment(self, devtype):
+        """
+        Get the segment being written to for a device type, starting a new one (and sealing the
+        full one in the background) if it is full (the caller holds the lock).
+
+        Args:
+            devtype (str): The device type.
+
+        Returns:
+            Segment: The segment.
+        """
+        segment = self._segments.get(devtype)
+        if segment is not None and not segment.full:
+            return segment
+
+        sequence = 0
+        if segment is not None:
+            del self._segments[devtype]
+            self._sealer.submit(self._seal, segment)
+            sequence = segment.sequence + 1
+
+        # Carry on writing to the last segment if it is a plain one with room left (e.g. the HUB
+        # was restarted), or start a new one
+        paths = self._paths(devtype) if segment is None else []
+        if paths:
+            last = paths[-1]
+            sequence = int(os.path.basename(last).split(".")[0].rsplit("-", 1)[1]) + 1
+            if last.endswith(".seg"):
+                segment = Segment(last, RECORD_TYPES[devtype])
+                if not segment.full:
+                    self._segments[devtype] = segment
+                    return segment
+                segment.close()
+
+        path = os.path.join(self.directory, f"{devtype}-{sequence:06d}.seg")
+        segment = self._segments[devtype] = Segment(
+            path, RECORD_TYPES[devtype], self.segment_records
+        )
+        return segment
+
+    def _seal(self, segment):
+        """
+        Close a segment no longer written to and, if encrypting, replace it with its encrypted
+        contents.
+
+        Args:
+            segment (Segment): The segment.
+        """
+        size = HEADER_SIZE + len(segment) * segment.dtype.itemsize
+        segment.close()
+        if self._cipher is None:
+            return
+
+        try:
+            with open(segment.path, "rb") as plain:
+                data = plain.read(size)
+            # Write the encrypted segment to a temporary file first, so that a crash never leaves a
+            # half-written segment behind
+            enc_path = segment.path + ".enc"
+            with open(enc_path + ".tmp", "wb") as enc:
+                enc.write(self._cipher.encrypt(data))
+            os.replace(enc_path + ".tmp", enc_path)
+            os.remove(segment.path)
+        except OSError as e:
+            logging.error(
+                "Error encrypting telemetry segment: %s",
+                e,
+                exc_info=True,
+            )
+
+    def record(self, deviceid, devtype, readings, timestamp=None):
+        """
+        Write the readings of a device as a record of its device type's segment.
+
+        Args:
+            deviceid (str): The device id. devtype (str): The device type. readings (dict): The
+            readings (missing numeric fields are stored as NaN). timestamp (float): The time of the
+            readings, or None for now.
+
+        Returns:
+            bool: Whether the readings were recorded (i.e. the device type is known).
+        """
+        dtype = RECORD_TYPES.get(devtype)
+        if dtype is None:
+            return False
+        if timestamp is None:
+            timestamp = time.time()
+
+        record = []
+        for field in dtype.names:
+            if field == "time":
+                record.append(timestamp)
+            elif field == "identifier":
+                record.append(deviceid.encode()[:ID_SIZE])
+            elif dtype[field] == np.bool_:
+                record.append(readings.get(field) in (STATUSES[1], SWITCHES[1]))
+            else:
+                value = readings.get(field)
+                number = isinstance(value, (int, float)) and not isinstance(value, bool)
+                record.append(value if number else np.nan)
+
+        with self._lock:
+            segment = self._segment(devtype)
+
+            # Keep the records of a segment series in time order, so that scans can find a range
+            # by binary search
+            latest = segment.last_time()
+            if latest is not None and record[0] < latest:
+                record[0] = latest
+
+            segment.append(tuple(record))
+        return True
+
+    def scan(self, devtype, start=None, end=None, deviceid=None):
+        """
+        Read the records of a device type in a time range, segment by segment.
+
+        Args:
+            devtype (str): The device type. start (float): Start of the range (inclusive), or None
+            for the oldest record. end (float): End of the range (exclusive), or None for the
+            newest record. deviceid (str): Optional device id to keep only the records of.
+
+        Yields:
+            numpy.ndarray: The records in the range of each segment (with at least one), oldest
+            first; views of the segment files unless filtered by device id.
+
+        Raises:
+            ValueError: If the device type is unknown.
+        """
+        dtype = RECORD_TYPES.get(devtype)
+        if dtype is None:
+            raise ValueError(f"Unknown device type {devtype}")
+
+        # Flush the segment being written to, so that it can be read back from its file
+        with self._lock:
+            if devtype in self._segments:
+                self._segments[devtype].flush()
+            paths = self._paths(devtype)
+
+        for path in paths:
+            try:
+                try:
+                    records = read_segment(path, dtype, self._cipher)
+                except FileNotFoundError:
+                    # The segment has been sealed since it was listed
+                    records = read_segment(path + ".enc", dtype, self._cipher)
+            except Exception as e:  # pylint: disable=broad-except
+                logging.error(
+                    "Error reading telemetry segment %s: %s",
+                    path,
+                    e,
+                    exc_info=True,
+                )
+                continue
+
+            times = records["time"]
+            first = 0 if start is None else int(np.searchsorted(times, start, side="left"))
+            last = len(times) if end is None else int(np.searchsorted(times, end, side="left"))
+            records = records[first:last]
+            if deviceid is not None:
+                records = records[records["identifier"] == deviceid.encode()[:ID_SIZE]]
+            if len(records):
+                yield records
+
+    def load(self, devtype, start=None, end=None, deviceid=None):
+        """
+        Read the records of a device type in a time range into one array (see scan()).
+
+        Returns:
+            numpy.ndarray: The records (a copy), oldest first.
+        """
+        parts = list(self.scan(devtype, start, end, deviceid))
+        return np.concatenate(parts) if parts else np.empty(0, dtype=RECORD_TYPES[devtype])
+
+    def flush(self):
+        """
+        Write the segments being written to back to their files, and wait for the full segments
+        being sealed.
+        """
+        with self._lock:
+            for segment in self._segments.values():
+                segment.flush()
+        self._sealer.submit(lambda: None).result()
+
+    def close(self):
+        """
+        Close the segments being written to. If encrypting, they are sealed (so that no plain
+        segment is left on disk) and new segments are started next time.
+        """
+        with self._lock:
+            for devtype in list(self._segments):
+                segment = self._segments.pop(devtype)
+                if self._cipher is not None:
+                    self._sealer.submit(self._seal, segment)
+                else:
+                    segment.close()
+        # Wait for the segments being sealed
+        self._sealer.shutdown(wait=True)
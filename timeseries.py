@@ -0,0 +1,453 @@
+"""
+Module with the HUB's in-memory time-series store of device readings. Every reading a device sends
+(pushed or polled) is recorded per device in columnar ring buffers: one array of timestamps plus one
+array per numeric field (e.g. 'temp', 'threshold'), so a range of readings is a slice of a few NumPy
+arrays rather than a list of dicts. Besides the raw readings, each device keeps rollup tiers (e.g.
+per minute and per hour) holding the min/max/mean of each field per time bucket. Every buffer has a
+fixed number of slots, so memory stays bounded: the raw readings cover the most recent readings, and
+the coarser tiers cover longer and longer spans at a lower resolution. Buffers start small and
+double in size as rows are added, so devices that report rarely (or only recently connected) don't
+take up the memory of a full history
+
+Example usage:
+    store = TimeSeriesStore() store.record("Therm1", {"temp": 21.5, "threshold": 23})
+    times, values = store.query("Therm1", start=time.time() - 3600) rollup =
+    store.rollup("Therm1", 60)
+"""
+
+import math
+import threading
+import time
+
+import numpy as np
+
+# Number of raw readings kept per device
+RAW_CAPACITY = 4096
+
+# Number of rows a buffer starts with, before growing on demand
+INITIAL_ROWS = 16
+
+# The rollup tiers kept per device: (resolution in seconds, number of buckets). The default keeps a
+# day of per-minute, a week of per-quarter-hour and a quarter of per-hour statistics
+ROLLUP_TIERS = ((60, 1440), (900, 672), (3600, 2160))
+
+# The statistics each rollup bucket keeps per field
+STATS = ("min", "max", "sum", "count")
+
+
+def numeric_fields(readings):
+    """
+    Pick the numeric fields of readings (booleans and strings such as 'status' are left out).
+
+    Args:
+        readings (dict): The readings of a device.
+
+    Returns:
+        dict: The numeric fields and their values as floats.
+    """
+    return {
+        field: float(value)
+        for field, value in readings.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    }
+
+
+class ColumnBuffer:
+    """
+    The ColumnBuffer class is a ring buffer of rows with a timestamp and a float per column. Rows
+    are written into arrays that start with INITIAL_ROWS rows and double in size whenever they are
+    full, up to twice the capacity; once the end of those is reached, the last capacity rows are
+    moved back to the start. This way the kept rows are always one contiguous slice (no wrapping),
+    so ranges can be found with a binary search and handed out without joining pieces. Columns can
+    be added at any time; rows written before a column existed hold NaN in it.
+
+    Attributes:
+        capacity (int): Number of rows kept. times (numpy.ndarray): The timestamp of each row.
+        columns (dict): The array of each column keyed by name.
+    """
+
+    def __init__(self, capacity):
+        """Initialize a new (empty) ColumnBuffer instance."""
+        self.capacity = capacity
+        self.times = np.empty(min(INITIAL_ROWS, 2 * capacity))
+        self.columns = {}
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    @property
+    def nbytes(self):
+        """int: Number of bytes taken up by the arrays."""
+        return self.times.nbytes + sum(array.nbytes for array in self.columns.values())
+
+    def _grow(self):
+        """Double the size of the arrays (up to twice the capacity), keeping the rows."""
+        size = min(2 * len(self.times), 2 * self.capacity)
+        rows = slice(self._start, self._end)
+        times = np.empty(size)
+        times[: len(self)] = self.times[rows]
+        self.times = times
+        for name, array in self.columns.items():
+            column = np.full(size, np.nan)
+            column[: len(self)] = array[rows]
+            self.columns[name] = column
+        self._start, self._end = 0, len(self)
+
+    def _column(self, name):
+        """
+        Get the array of a column, adding the column if it is new.
+
+        Args:
+            name (str): The column name.
+
+        Returns:
+            numpy.ndarray: The array.
+        """
+        array = self.columns.get(name)
+        if array is None:
+            array = self.columns[name] = np.full(len(self.times), np.nan)
+        return array
+
+    def append(self, timestamp, values):
+        """
+        Add a row, dropping the oldest one if the buffer is full.
+
+        Args:
+            timestamp (float): The timestamp of the row, not older than the latest row.
+            values (dict): The value of each column in the row; other columns get NaN.
+        """
+        if self._end == len(self.times) and len(self.times) < 2 * self.capacity:
+            self._grow()
+        if self._end == len(self.times):
+            # Move the newest rows back to the start of the arrays
+            keep = self.capacity - 1
+            for array in [self.times, *self.columns.values()]:
+                array[:keep] = array[self._end - keep : self._end]
+            self._start, self._end = 0, keep
+        elif self._end - self._start == self.capacity:
+            self._start += 1
+
+        row = self._end
+        self.times[row] = timestamp
+        for name, array in self.columns.items():
+            array[row] = values.get(name, np.nan)
+        for name in values.keys() - self.columns.keys():
+            self._column(name)[row] = values[name]
+        self._end += 1
+
+    def update_last(self, values):
+        """
+        Change values in the newest row.
+
+        Args:
+            values (dict): The new value of each changed column.
+        """
+        row = self._end - 1
+        for name, value in values.items():
+            self._column(name)[row] = value
+
+    def last(self, name):
+        """
+        Get a value of the newest row.
+
+        Args:
+            name (str): The column name.
+
+        Returns:
+            float: The value (NaN if the column has no value in that row).
+        """
+        array = self.columns.get(name)
+        return array[self._end - 1] if array is not None else np.nan
+
+    def last_time(self):
+        """
+        Get the timestamp of the newest row.
+
+        Returns:
+            float: The timestamp, or None if the buffer is empty.
+        """
+        return self.times[self._end - 1] if self._end > self._start else None
+
+    def slice(self, start=None, end=None, names=None):
+        """
+        Get the rows with a timestamp in a range.
+
+        Args:
+            start (float): Timestamp of the first row to include, or None for the oldest row. end
+            (float): Timestamp past the last row to include, or None for the newest row. names
+            (iterable): The columns to include, or None for all of them.
+
+        Returns:
+            tuple: Copies of the timestamps and of each included column (a dict keyed by name).
+        """
+        times = self.times[self._start : self._end]
+        first = 0 if start is None else int(np.searchsorted(times, start, side="left"))
+        last = len(times) if end is None else int(np.searchsorted(times, end, side="left"))
+
+        names = self.columns.keys() if names is None else names
+        rows = slice(self._start + first, self._start + last)
+        return times[first:last].copy(), {
+            name: self.columns[name][rows].copy() for name in names if name in self.columns
+        }
+
+
+class RollupTier:
+    """
+    The RollupTier class keeps the min, max, sum and count of each field per time bucket of a fixed
+    resolution, for a fixed number of buckets (see ColumnBuffer).
+
+    Attributes:
+        resolution (float): Number of seconds per bucket. buckets (ColumnBuffer): The statistics
+        per bucket, in columns named '<field>.min', '<field>.max', '<field>.sum' and
+        '<field>.count'; the timestamp of a bucket is its start.
+    """
+
+    def __init__(self, resolution, capacity):
+        """Initialize a new (empty) RollupTier instance."""
+        self.resolution = resolution
+        self.buckets = ColumnBuffer(capacity)
+
+    def add(self, timestamp, values):
+        """
+        Add a reading to the statistics of its bucket.
+
+        Args:
+            timestamp (float): The time of the reading. values (dict): The numeric fields of the
+            reading.
+        """
+        bucket = math.floor(timestamp / self.resolution) * self.resolution
+        latest = self.buckets.last_time()
+
+        if latest is None or bucket > latest:
+            row = {}
+            for field, value in values.items():
+                row[field + ".min"] = row[field + ".max"] = row[field + ".sum"] = value
+                row[field + ".count"] = 1.0
+            self.buckets.append(bucket, row)
+            return
+
+        # Readings stamped before the latest bucket (e.g. a clock step back) are counted in it
+        row = {}
+        for field, value in values.items():
+            count = self.buckets.last(field + ".count")
+            if np.isnan(count) or count == 0:
+                row[field + ".min"] = row[field + ".max"] = row[field + ".sum"] = value
+                row[field + ".count"] = 1.0
+            else:
+                row[field + ".min"] = min(self.buckets.last(field + ".min"), value)
+                row[field + ".max"] = max(self.buckets.last(field + ".max"), value)
+                row[field + ".sum"] = self.buckets.last(field + ".sum") + value
+                row[field + ".count"] = count + 1
+        self.buckets.update_last(row)
+
+    def query(self, start=None, end=None, fields=None):
+        """
+        Get the statistics of the buckets in a range.
+
+        Args:
+            start (float): Start of the range (the bucket holding it is included), or None for the
+            oldest bucket. end (float): End of the range, or None for the newest bucket. fields
+            (iterable): The fields to include, or None for all of them.
+
+        Returns:
+            dict: 'time' (the start of each bucket) and, for each field, a dict with the 'min',
+            'max' and 'mean' arrays (NaN for buckets without readings of the field) and 'count'.
+        """
+        if start is not None:
+            start = math.floor(start / self.resolution) * self.resolution
+
+        names = None
+        if fields is not None:
+            names = [f"{field}.{stat}" for field in fields for stat in STATS]
+        times, columns = self.buckets.slice(start, end, names)
+
+        result = {"time": times}
+        for name in columns:
+            field, _, stat = name.rpartition(".")
+            if stat != "count":
+                continue
+            count = np.nan_to_num(columns[name])
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean = columns[field + ".sum"] / count
+            result[field] = {
+                "min": columns[field + ".min"],
+                "max": columns[field + ".max"],
+                "mean": mean,
+                "count": count.astype(np.int64),
+            }
+        return result
+
+
+class DeviceSeries:
+    """
+    The DeviceSeries class holds the raw readings and the rollup tiers of one device.
+
+    Attributes:
+        raw (ColumnBuffer): The most recent raw readings. tiers (dict): The RollupTier of each
+        resolution.
+    """
+
+    def __init__(self, raw_capacity=RAW_CAPACITY, tiers=ROLLUP_TIERS):
+        """Initialize a new (empty) DeviceSeries instance."""
+        self.raw = ColumnBuffer(raw_capacity)
+        self.tiers = {
+            resolution: RollupTier(resolution, capacity) for resolution, capacity in tiers
+        }
+
+    def record(self, timestamp, values):
+        """
+        Record a reading.
+
+        Args:
+            timestamp (float): The time of the reading. values (dict): The numeric fields of the
+            reading.
+        """
+        # Keep the raw timestamps in order, so that ranges can be found by binary search
+        latest = self.raw.last_time()
+        if latest is not None and timestamp < latest:
+            timestamp = latest
+
+        self.raw.append(timestamp, values)
+        for tier in self.tiers.values():
+            tier.add(timestamp, values)
+
+    @property
+    def nbytes(self):
+        """int: Number of bytes taken up by the raw readings and the rollup tiers."""
+        return self.raw.nbytes + sum(tier.buckets.nbytes for tier in self.tiers.values())
+
+
+class TimeSeriesStore:
+    """
+    The TimeSeriesStore class records the numeric readings of every device and answers range and
+    rollup queries. Readings are recorded by the HUB server's event loop while queries come from
+    the menu thread, so every access is made under a lock.
+
+    Attributes:
+        raw_capacity (int): Number of raw readings kept per device. tiers (tuple): The rollup tiers
+        kept per device, as (resolution in seconds, number of buckets) pairs.
+
+    Example usage:
+        store = TimeSeriesStore() server.readings_listeners.append(store.record)
+    """
+
+    def __init__(self, raw_capacity=RAW_CAPACITY, tiers=ROLLUP_TIERS):
+        """Initialize a new (empty) TimeSeriesStore instance."""
+        self.raw_capacity = raw_capacity
+        self.tiers = tuple(sorted(tiers))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def record(self, deviceid, readings, timestamp=None):
+        """
+        Record the readings of a device. The signature matches the HUB server's readings listeners.
+
+        Args:
+            deviceid (str): The device id. readings (dict): The readings. timestamp (float): The
+            time of the readings, or None for now.
+        """
+        values = numeric_fields(readings)
+        if not values:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self._lock:
+            series = self._series.get(deviceid)
+            if series is None:
+                series = self._series[deviceid] = DeviceSeries(self.raw_capacity, self.tiers)
+            series.record(timestamp, values)
+
+    def devices(self):
+        """
+        Get the devices with recorded readings.
+
+        Returns:
+            list: The device ids.
+        """
+        with self._lock:
+            return list(self._series)
+
+    def resolutions(self):
+        """
+        Get the resolutions of the rollup tiers.
+
+        Returns:
+            list: The resolutions in seconds, finest first.
+        """
+        return [resolution for resolution, _ in self.tiers]
+
+    def query(self, deviceid, start=None, end=None, fields=None):
+        """
+        Get the raw readings of a device in a time range.
+
+        Args:
+            deviceid (str): The device id. start (float): Start of the range (inclusive), or None
+            for the oldest reading kept. end (float): End of the range (exclusive), or None for the
+            newest reading. fields (iterable): The fields to include, or None for all of them.
+
+        Returns:
+            tuple: The timestamps (numpy array) and the values of each field (a dict of numpy
+            arrays, NaN where a reading didn't have the field), or None if the device has no
+            recorded readings.
+        """
+        with self._lock:
+            series = self._series.get(deviceid)
+            if series is None:
+                return None
+            return series.raw.slice(start, end, fields)
+
+    def rollup(self, deviceid, resolution, start=None, end=None, fields=None):
+        """
+        Get the min/max/mean of the readings of a device per time bucket.
+
+        Args:
+            deviceid (str): The device id. resolution (float): The resolution in seconds, one of
+            resolutions(). start (float): Start of the range, or None for the oldest bucket kept.
+            end (float): End of the range, or None for the newest bucket. fields (iterable): The
+            fields to include, or None for all of them.
+
+        Returns:
+            dict: See RollupTier.query(), or None if the device has no recorded readings.
+
+        Raises:
+            ValueError: If there is no rollup tier of the resolution.
+        """
+        if resolution not in self.resolutions():
+            raise ValueError(
+                f"No rollup tier of {resolution} seconds (available: {self.resolutions()})"
+            )
+
+        with self._lock:
+            series = self._series.get(deviceid)
+            if series is None:
+                return None
+            return series.tiers[resolution].query(start, end, fields)
+
+    def nbytes(self, deviceid=None):
+        """
+        Get the memory taken up by the recorded readings.
+
+        Args:
+            deviceid (str): The device id, or None for all devices.
+
+        Returns:
+            int: Number of bytes (0 for a device without recorded readings).
+        """
+        with self._lock:
+            if deviceid is not None:
+                series = self._series.get(deviceid)
+                return series.nbytes if series is not None else 0
+            return sum(series.nbytes for series in self._series.values())
+
+    def forget(self, deviceid):
+        """
+        Drop the recorded readings of a device.
+
+        Args:
+            deviceid (str): The device id.
+        """
+        with self._lock:
+            self._series.pop(deviceid, None)
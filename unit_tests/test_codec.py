@@ -0,0 +1,87 @@
+import json
+import unittest
+import sys
+sys.path.append("../")
+
+import codec
+
+MESSAGES = [
+    {"action": "get_readings", "id": 7},
+    {
+        "result": {
+            "identifier": "Therm1",
+            "status": "active",
+            "threshold": 23,
+            "switch": "on",
+            "temp": 21.5,
+        },
+        "id": 300000,
+    },
+    {"result": ["success", "failure - unknown action", None, True, False], "id": 2**40},
+    {"event": "readings", "delta": {"seq": 3, "base": 1, "fields": {"motion": -4}}},
+    {"action": "set_thres", "value": 12.25, "note": "ünïcode"},
+]
+
+
+class TestBinaryCodec(unittest.TestCase):
+
+    def test_round_trip(self):
+        for msg in MESSAGES:
+            self.assertEqual(codec.BINARY.decode(codec.BINARY.encode(msg)), msg)
+
+    def test_smaller_than_json(self):
+        for msg in MESSAGES[:4]:
+            self.assertLess(len(codec.BINARY.encode(msg)), len(codec.JSON.encode(msg)))
+
+    def test_invalid_values(self):
+        with self.assertRaises(ValueError):
+            codec.BINARY.encode({"value": 2**64})
+        with self.assertRaises(ValueError):
+            codec.BINARY.encode({1: "a"})
+        with self.assertRaises(ValueError):
+            codec.BINARY.encode({"value": object()})
+
+    def test_length_limits(self):
+        longest = {"note": "x" * codec.MAX_LENGTH, "values": [0] * codec.MAX_LENGTH}
+        self.assertEqual(codec.BINARY.decode(codec.BINARY.encode(longest)), longest)
+        too_long = [
+            {"note": "x" * (codec.MAX_LENGTH + 1)},
+            # The limit is in bytes, not characters
+            {"note": "ü" * (codec.MAX_LENGTH // 2 + 1)},
+            {"values": [0] * (codec.MAX_LENGTH + 1)},
+            {str(i): i for i in range(codec.MAX_LENGTH + 1)},
+        ]
+        for msg in too_long:
+            with self.assertRaises(ValueError):
+                codec.BINARY.encode(msg)
+
+    def test_invalid_data(self):
+        data = codec.BINARY.encode(MESSAGES[1])
+        with self.assertRaises(ValueError):
+            codec.BINARY.decode(data[:-3])
+        with self.assertRaises(ValueError):
+            codec.BINARY.decode(data + b"\x00")
+        with self.assertRaises(ValueError):
+            codec.BINARY.decode(b"\xff")
+
+
+class TestNegotiation(unittest.TestCase):
+
+    def test_negotiate(self):
+        self.assertIs(codec.negotiate(["bin1", "json"]), codec.BINARY)
+        self.assertIs(codec.negotiate(["msgpack", "json"]), codec.JSON)
+        self.assertIs(codec.negotiate(None), codec.JSON)
+        self.assertIs(codec.negotiate("bin1"), codec.JSON)
+
+    def test_get_codec(self):
+        self.assertIs(codec.get_codec(None), codec.JSON)
+        self.assertIs(codec.get_codec("bin1"), codec.BINARY)
+        self.assertIsNone(codec.get_codec("msgpack"))
+
+    def test_json_codec(self):
+        self.assertEqual(codec.JSON.encode(MESSAGES[0]), json.dumps(MESSAGES[0]).encode("utf-8"))
+        self.assertEqual(codec.JSON.decode(codec.JSON.encode(MESSAGES[1])), MESSAGES[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import sys
+sys.path.append("../")
+
+import delta
+from delta import DeltaEncoder, DeltaMerger
+
+READINGS = {"identifier": "Light1", "status": "active", "switch": "on", "brightness": 90}
+
+
+class TestDelta(unittest.TestCase):
+
+    def test_first_message_is_full_snapshot(self):
+        msg = DeltaEncoder().encode(READINGS)
+        self.assertIsNone(msg["base"])
+        self.assertEqual(msg["fields"], READINGS)
+
+    def test_delta_after_ack(self):
+        encoder, merger = DeltaEncoder(), DeltaMerger()
+        merger.apply(encoder.encode(READINGS))
+        encoder.ack(merger.take_ack())
+
+        msg = encoder.encode(dict(READINGS, brightness=61))
+        self.assertEqual(msg["fields"], {"brightness": 61})
+        self.assertEqual(merger.apply(msg), dict(READINGS, brightness=61))
+
+    def test_deltas_against_acknowledged_snapshot(self):
+        encoder, merger = DeltaEncoder(), DeltaMerger()
+        merger.apply(encoder.encode(READINGS))
+        encoder.ack(merger.take_ack())
+
+        # Without further acknowledgements, every delta is taken against the same base
+        merger.apply(encoder.encode(dict(READINGS, brightness=61)))
+        msg = encoder.encode(dict(READINGS, brightness=61, switch="off"))
+        self.assertEqual(msg["fields"], {"brightness": 61, "switch": "off"})
+        self.assertEqual(merger.apply(msg), dict(READINGS, brightness=61, switch="off"))
+
+    def test_unknown_base(self):
+        encoder = DeltaEncoder()
+        encoder.encode(READINGS)
+        encoder.ack(1)
+        self.assertIsNone(DeltaMerger().apply(encoder.encode(READINGS)))
+
+        # After a reset the encoder starts over from a full snapshot
+        encoder.reset()
+        self.assertIsNone(encoder.encode(READINGS)["base"])
+
+    def test_ack_due(self):
+        encoder, merger = DeltaEncoder(), DeltaMerger()
+        merger.apply(encoder.encode(READINGS))
+        self.assertTrue(merger.ack_due())
+        encoder.ack(merger.take_ack())
+        self.assertIsNone(merger.take_ack())
+
+        for _ in range(delta.ACK_EVERY - 1):
+            merger.apply(encoder.encode(READINGS))
+            self.assertFalse(merger.ack_due())
+        merger.apply(encoder.encode(READINGS))
+        self.assertTrue(merger.ack_due())
+
+    def test_full_snapshot_when_too_far_behind(self):
+        encoder = DeltaEncoder()
+        encoder.encode(READINGS)
+        encoder.ack(1)
+        for _ in range(delta.MAX_UNACKED):
+            msg = encoder.encode(READINGS)
+        self.assertIsNotNone(msg["base"])
+        self.assertIsNone(encoder.encode(READINGS)["base"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,7 @@ sys.path.append("../")
 
 
 from model.device import *
+from model.dispatch import ActionRegistry, actions, handles
 
 
 class TestDevice(unittest.TestCase):
@@ -52,6 +53,18 @@ class TestDevice(unittest.TestCase):
         expected_str = 'Device| {"identifier": "device001", "status": "active", "threshold": 60}'
         self.assertEqual(str_repr, expected_str)
 
+    def test_compact_representation(self):
+        for device in (Device("d1"), SmartLight("l1"), MotionSensor("m1"), SmartLock("k1"),
+                       Thermostat("t1")):
+            self.assertFalse(hasattr(device, "__dict__"))
+        light = SmartLight("l1")
+        self.assertEqual(light.thres_max, SmartLight.thres_max)
+        self.assertEqual(Thermostat("t1").thres_max, 40)
+        light.status = "inactive"
+        self.assertIs(light.get_readings()["status"], "inactive")
+        with self.assertRaises(ValueError):
+            light.switch = "dimmed"
+
 
 class TestSmartLight(unittest.TestCase):
 
@@ -219,5 +232,47 @@ class TestThermostat(unittest.TestCase):
         self.assertEqual(readings['switch'], "on")
         self.assertEqual(readings['temp'], 15.0)
 
+class TestActionDispatch(unittest.TestCase):
+
+    def test_dispatch_base_class_handler(self):
+        thermostat = Thermostat("thermo001", 23)
+        result = actions.dispatch(thermostat, {"action": "set_thres", "value": 30})
+        self.assertEqual(result, "success")
+        self.assertEqual(thermostat.threshold, 30)
+        self.assertEqual(actions.dispatch(thermostat, {"action": "get_readings"}), thermostat.get_readings())
+
+    def test_dispatch_subclass_handler(self):
+        smart_light = SmartLight("light001", 60)
+        actions.dispatch(smart_light, {"action": "set_off"})
+        self.assertEqual(smart_light.switch, "off")
+        self.assertEqual(smart_light.status, "inactive")
+        smart_lock = SmartLock("lock001")
+        self.assertEqual(actions.dispatch(smart_lock, {"action": "set_on"}), "already locked")
+        smart_lock.deactivate()
+        self.assertEqual(actions.dispatch(smart_lock, {"action": "set_off"}), "failure - lock is inactive")
+
+    def test_dispatch_unknown_action(self):
+        device = Device("device001", 60)
+        self.assertEqual(actions.dispatch(device, {"action": "set_on"}), "failure - unknown action")
+        self.assertEqual(actions.dispatch(device, {}), "failure - unknown action")
+
+    def test_new_device_class_registers_handlers(self):
+        class Doorbell(Device):
+            @handles("ring")
+            def handle_ring(self, request_data):
+                return "ding dong"
+
+        self.assertEqual(actions.dispatch(Doorbell("bell001"), {"action": "ring"}), "ding dong")
+        self.assertEqual(actions.dispatch(Doorbell("bell001"), {"action": "set_activate"}), "already active")
+
+    def test_on_dispatch_hook(self):
+        registry = ActionRegistry()
+        registry.register_class(Device)
+        timings = []
+        registry.on_dispatch = lambda action, cls, elapsed: timings.append((action, cls))
+        registry.dispatch(Device("device001"), {"action": "set_deactivate"})
+        self.assertEqual(timings, [("set_deactivate", Device)])
+
+
 if __name__ == '__main__':
     unittest.main()
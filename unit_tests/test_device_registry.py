@@ -0,0 +1,135 @@
+import threading
+import unittest
+import sys
+sys.path.append("../")
+
+import device_registry
+from device_registry import DeviceRegistry
+
+
+class TestDeviceRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DeviceRegistry(
+            {"Light1": "SmartLight", "Lock1": "SmartLock", "Light2": "SmartLight"}
+        )
+
+    def test_loaded_devices_not_connected(self):
+        self.assertEqual(self.registry.ids(), ("Light1", "Lock1", "Light2"))
+        self.assertEqual(self.registry.ids(connected=True), ())
+        self.assertEqual(self.registry.get("Light1"), {"conn": None, "devtype": "SmartLight"})
+        self.assertIsNone(self.registry.conn("Light1"))
+        self.assertEqual(len(self.registry), 3)
+
+    def test_connect_and_disconnect(self):
+        conn = object()
+        self.assertEqual(self.registry.connect("Lock1", "SmartLock", conn), (None, False))
+        self.assertEqual(self.registry.connect("Therm1", "Thermostat", None), (None, True))
+        self.assertEqual(self.registry.ids(connected=True), ("Lock1",))
+        self.assertIs(self.registry.conn("Lock1"), conn)
+
+        # A stale connection doesn't mark a reconnected device as disconnected
+        newer = object()
+        self.assertEqual(self.registry.connect("Lock1", "SmartLock", newer), (conn, False))
+        self.assertFalse(self.registry.disconnect("Lock1", conn))
+        self.assertTrue(self.registry.disconnect("Lock1", newer))
+        self.assertEqual(self.registry.ids(connected=True), ())
+
+    def test_devtype_index(self):
+        self.registry.connect("Light2", "SmartLight", object())
+        self.assertEqual(self.registry.ids(devtype="SmartLight"), ("Light1", "Light2"))
+        self.assertEqual(self.registry.ids(connected=True, devtype="SmartLight"), ("Light2",))
+        self.registry.connect("Light1", "Thermostat", None)
+        self.assertEqual(
+            self.registry.devtypes(), {"SmartLight": 1, "SmartLock": 1, "Thermostat": 1}
+        )
+        self.registry.remove("Light1")
+        self.assertNotIn("Light1", self.registry)
+        self.assertEqual(self.registry.ids(devtype="Thermostat"), ())
+
+    def test_snapshots(self):
+        snapshot = self.registry.ids()
+        self.assertIs(self.registry.ids(), snapshot)
+        self.registry.connect("Light3", "SmartLight", None)
+        self.assertEqual(snapshot, ("Light1", "Lock1", "Light2"))
+        self.assertEqual(list(self.registry), ["Light1", "Lock1", "Light2", "Light3"])
+
+    def test_concurrent_readers(self):
+        errors = []
+
+        def read():
+            for _ in range(2000):
+                for deviceid in self.registry.ids(connected=True):
+                    if self.registry.get(deviceid) is None:
+                        errors.append(deviceid)
+
+        readers = [threading.Thread(target=read) for _ in range(2)]
+        for reader in readers:
+            reader.start()
+        for i in range(2000):
+            self.registry.connect(f"Dev{i % 50}", "SmartLight", object())
+            self.registry.disconnect(f"Dev{(i + 25) % 50}")
+        for reader in readers:
+            reader.join()
+        self.assertEqual(errors, [])
+
+
+class TestDeviceQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DeviceRegistry()
+        self.registry.connect("Therm1", "Thermostat", object())
+        self.registry.connect("Therm2", "Thermostat", None)
+        self.registry.connect("Lock1", "SmartLock", object())
+        self.registry.connect("Lock2", "SmartLock", None)
+        self.registry.update_readings(
+            "Therm1", {"status": "active", "threshold": 23, "temp": 25.0}
+        )
+        self.registry.update_readings(
+            "Therm2", {"status": "inactive", "threshold": 23, "temp": 15.0}
+        )
+        self.registry.update_readings("Lock1", {"status": "inactive", "threshold": 50})
+        self.registry.update_readings("Lock2", {"status": "active", "threshold": 50})
+
+    def test_over_threshold(self):
+        self.assertTrue(device_registry.over_threshold({"threshold": 5, "motion": 5}))
+        self.assertFalse(device_registry.over_threshold({"threshold": 50, "brightness": 49}))
+        self.assertFalse(device_registry.over_threshold({"threshold": 50, "switch": "on"}))
+
+    def test_canonical_readings(self):
+        readings = {"status": "".join(["in", "active"]), "switch": "".join(["o", "n"])}
+        self.registry.update_readings("Therm1", readings)
+        self.assertIs(readings["status"], device_registry.CANONICAL_VALUES["inactive"])
+        self.assertIs(readings["switch"], device_registry.CANONICAL_VALUES["on"])
+        self.assertEqual(device_registry.canonical_readings({"status": 1}), {"status": 1})
+
+    def test_queries(self):
+        self.assertEqual(self.registry.query(devtype="Thermostat", connected=True), ("Therm1",))
+        self.assertEqual(self.registry.query(devtype="SmartLock", status="inactive"), ("Lock1",))
+        self.assertEqual(self.registry.query(over=True), ("Therm1",))
+        self.assertEqual(self.registry.query(connected=False), ("Therm2", "Lock2"))
+        self.assertEqual(self.registry.query(status="inactive", connected=False), ("Therm2",))
+        self.assertEqual(self.registry.query(devtype="SmartLight"), ())
+        self.assertEqual(len(self.registry.query()), 4)
+
+    def test_indexes_follow_readings(self):
+        snapshot = self.registry.query(over=True)
+        self.registry.update_readings(
+            "Therm1", {"status": "active", "threshold": 23, "temp": 26.0}
+        )
+        self.assertIs(self.registry.query(over=True), snapshot)
+
+        self.registry.update_readings(
+            "Therm1", {"status": "inactive", "threshold": 23, "temp": 20.0}
+        )
+        self.assertEqual(self.registry.query(over=True), ())
+        self.assertEqual(self.registry.query(status="inactive"), ("Therm2", "Lock1", "Therm1"))
+
+        self.registry.remove("Therm1")
+        self.assertEqual(self.registry.query(status="inactive"), ("Therm2", "Lock1"))
+        self.registry.update_readings("Therm1", {"status": "active"})
+        self.assertEqual(self.registry.query(status="active"), ("Lock2",))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+import os
+import socket
+import unittest
+import sys
+sys.path.append("../")
+
+import device_service
+import framing
+import utils
+from delta import DeltaEncoder, DeltaMerger
+from device_service import (
+    TelemetrySubscription,
+    handle_batch,
+    handle_request,
+    push_readings,
+    readings_push,
+)
+from model.device import SmartLight
+
+
+class TestTelemetrySubscription(unittest.TestCase):
+
+    def setUp(self):
+        self.subscription = TelemetrySubscription()
+        self.readings = {"identifier": "Light1", "switch": "on", "brightness": 50}
+
+    def test_inactive_never_due(self):
+        self.assertFalse(self.subscription.take_due(self.readings, 0.0))
+
+    def test_push_on_every_change(self):
+        self.subscription.configure()
+        self.assertTrue(self.subscription.take_due(self.readings, 0.0))
+        self.assertFalse(self.subscription.take_due(dict(self.readings), 1.0))
+        self.assertTrue(self.subscription.take_due(dict(self.readings, brightness=51), 2.0))
+
+    def test_periodic_push(self):
+        self.subscription.configure(interval=5)
+        self.assertTrue(self.subscription.take_due(self.readings, 0.0))
+        self.assertFalse(self.subscription.take_due(dict(self.readings, brightness=0), 4.0))
+        self.assertTrue(self.subscription.take_due(self.readings, 5.0))
+
+    def test_change_threshold(self):
+        self.subscription.configure(change=10)
+        self.assertTrue(self.subscription.take_due(self.readings, 0.0))
+        self.assertFalse(self.subscription.take_due(dict(self.readings, brightness=59), 1.0))
+        self.assertTrue(self.subscription.take_due(dict(self.readings, brightness=60), 2.0))
+        # Anything but a numeric reading is a change however small
+        self.assertTrue(self.subscription.take_due(dict(self.readings, brightness=60,
+                                                        switch="off"), 3.0))
+
+    def test_cancel(self):
+        self.subscription.configure()
+        self.subscription.cancel()
+        self.assertFalse(self.subscription.take_due(self.readings, 0.0))
+
+        # Subscribing again starts over with a full push
+        self.subscription.configure(interval=5)
+        self.assertTrue(self.subscription.take_due(self.readings, 0.0))
+
+
+class TestHandleBatch(unittest.TestCase):
+
+    def setUp(self):
+        device_service.PRINT_REQUESTS = False
+        self.device = SmartLight("Light1", threshold=50)
+        self.device.deactivate()
+
+    def tearDown(self):
+        device_service.PRINT_REQUESTS = True
+
+    def batch(self, *actions):
+        return {"action": "batch", "actions": list(actions)}
+
+    def test_actions_run_in_order(self):
+        results = handle_batch(self.device, self.batch(
+            {"action": "set_thres", "value": 70},
+            {"action": "set_activate"},
+            {"action": "set_activate"},
+            {"action": "get_readings"},
+        ))
+        self.assertEqual(results[:3], ["success", "success", "already active"])
+        self.assertEqual(results[3]["threshold"], 70)
+        self.assertEqual(results[3]["status"], "active")
+
+    def test_partial_failure(self):
+        results = handle_batch(self.device, self.batch(
+            {"action": "set_thres"},
+            {"action": "set_activate"},
+        ))
+        self.assertEqual(results, ["failure - set_thres failed", "success"])
+        self.assertEqual(self.device.threshold, 50)
+        self.assertEqual(self.device.status, "active")
+
+    def test_unknown_and_refused_actions(self):
+        results = handle_batch(self.device, self.batch(
+            {"action": "self_destruct"},
+            {"action": "set_disconnect"},
+            self.batch({"action": "set_activate"}),
+            "set_activate",
+            {"value": 1},
+            {"action": "set_activate"},
+        ))
+        self.assertEqual(results, [
+            "failure - unknown action",
+            "failure - not allowed in batch",
+            "failure - not allowed in batch",
+            "failure - invalid action",
+            "failure - invalid action",
+            "success",
+        ])
+
+    def test_aggregated_response(self):
+        reply = handle_request(
+            self.device,
+            self.batch({"action": "set_activate"}, {"action": "self_destruct"}),
+            TelemetrySubscription(),
+            DeltaEncoder(),
+        )
+        self.assertEqual(reply, {"result": ["success", "failure - unknown action"]})
+        self.assertEqual(handle_batch(self.device, {"action": "batch"}), [])
+
+
+class TestReadingsPush(unittest.TestCase):
+
+    def setUp(self):
+        device_service.PRINT_REQUESTS = False
+        self.device = SmartLight("Light1", threshold=50)
+        self.subscription = TelemetrySubscription()
+        self.encoder = DeltaEncoder()
+
+    def tearDown(self):
+        device_service.PRINT_REQUESTS = True
+
+    def request(self, msg):
+        return handle_request(self.device, msg, self.subscription, self.encoder)
+
+    def test_subscribe_and_unsubscribe(self):
+        self.assertIsNone(readings_push(self.device, self.subscription, self.encoder))
+        reply = self.request({"action": "subscribe", "interval": 2, "change": None})
+        self.assertEqual(reply, {"result": "success"})
+        self.assertTrue(self.subscription.active)
+        self.assertEqual(self.subscription.interval, 2)
+
+        msg = readings_push(self.device, self.subscription, self.encoder)
+        self.assertEqual(msg, {"event": "readings", "result": self.device.get_readings()})
+        self.assertIsNone(readings_push(self.device, self.subscription, self.encoder))
+
+        self.assertEqual(self.request({"action": "unsubscribe"}), {"result": "success"})
+        self.assertFalse(self.subscription.active)
+
+    def test_delta_pushes(self):
+        self.request({"action": "subscribe", "encoding": "delta"})
+        merger = DeltaMerger()
+        msg = readings_push(self.device, self.subscription, self.encoder)
+        self.assertNotIn("result", msg)
+        self.assertEqual(merger.apply(msg["delta"]), self.device.get_readings())
+
+        # Only the readings that changed are sent, and merged back into the full readings
+        self.device.set_threshold(70)
+        msg = readings_push(self.device, self.subscription, self.encoder)
+        self.assertLess(len(msg["delta"]), len(self.device.get_readings()))
+        self.assertEqual(merger.apply(msg["delta"]), self.device.get_readings())
+
+    def test_push_readings_sends_to_hub(self):
+        key = os.urandom(32)
+        device_session = utils.SessionCipher(key, utils.DEVICE_TO_HUB, utils.HUB_TO_DEVICE)
+        hub_session = utils.SessionCipher(key, utils.HUB_TO_DEVICE, utils.DEVICE_TO_HUB)
+        device_sock, hub_sock = socket.socketpair()
+        self.addCleanup(device_sock.close)
+        self.addCleanup(hub_sock.close)
+        hub_sock.settimeout(5)
+
+        self.request({"action": "subscribe"})
+        push_readings(device_sock, device_session, self.device, self.subscription, self.encoder)
+        # Not due again until the readings change
+        push_readings(device_sock, device_session, self.device, self.subscription, self.encoder)
+        self.device.switch_off()
+        push_readings(device_sock, device_session, self.device, self.subscription, self.encoder)
+
+        reader = framing.FrameReader(hub_sock)
+        pushed = [utils.recv_encrypted_message(reader, hub_session)[1] for _ in range(2)]
+        self.assertEqual([msg["result"]["switch"] for msg in pushed], ["on", "off"])
+        self.assertTrue(all(msg["event"] == "readings" for msg in pushed))
+        device_sock.close()
+        self.assertEqual(utils.recv_encrypted_message(reader, hub_session), (False, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+import contextlib
+import copy
+import random
+import unittest
+import sys
+sys.path.append("../")
+
+import numpy as np
+
+from model.device import Device, MotionSensor, SmartLight, SmartLock, Thermostat
+from model.dispatch import actions
+from model.fleet import DeviceFleet, FleetSmartLight, device_type
+
+
+def random_devices(count, seed=1):
+    rnd = random.Random(seed)
+    devices = []
+    for i in range(count):
+        device_cls = rnd.choice([SmartLight, MotionSensor, SmartLock, Thermostat])
+        if device_cls is SmartLock:
+            device = SmartLock(f"Dev{i}")
+        else:
+            device = device_cls(f"Dev{i}", threshold=rnd.randint(0, 40))
+        if rnd.random() < 0.3:
+            device.deactivate()
+        if rnd.random() < 0.3:
+            device.switch = "off"
+        devices.append(device)
+    return devices
+
+
+class TestDeviceFleet(unittest.TestCase):
+
+    def test_views_keep_readings(self):
+        devices = random_devices(50)
+        fleet = DeviceFleet()
+        views = fleet.extend(devices)
+        for device, view in zip(devices, views):
+            self.assertEqual(view.get_readings(), device.get_readings())
+            self.assertIsInstance(view, device.__class__)
+        self.assertIs(fleet.get("Dev3"), views[3])
+        self.assertEqual(device_type(views[3]), device_type(devices[3]))
+        self.assertEqual(str(views[3]), str(devices[3]))
+        self.assertEqual(len(fleet), 50)
+
+    def test_tick_matches_sense(self):
+        devices = random_devices(200)
+        fleet = DeviceFleet(capacity=16)
+        views = fleet.extend(copy.deepcopy(devices))
+        rnd = random.Random(2)
+
+        for _ in range(20):
+            values = [rnd.randint(-5, 110) for _ in devices]
+            with contextlib.redirect_stdout(None):
+                for device, value in zip(devices, values):
+                    if not isinstance(device, SmartLock):
+                        device.sense(value)
+            fleet.tick(values)
+
+            for device, view in zip(devices, views):
+                self.assertEqual(view.get_readings(), device.get_readings())
+
+    def test_tick_events(self):
+        fleet = DeviceFleet()
+        light, motion, therm = fleet.extend(
+            [SmartLight("Light1", 50), MotionSensor("Motion1", 5), Thermostat("Therm1", 20)]
+        )
+        events = fleet.tick([60, 7, 25.5])
+        self.assertEqual(light.switch, "off")
+        self.assertEqual(therm.temp, 20)
+        self.assertEqual(events["off"].tolist(), [0])
+        self.assertEqual(events["motion"].tolist(), [1])
+        self.assertEqual(events["capped"].tolist(), [2])
+
+        events = fleet.tick([10, 2, 15.0])
+        self.assertEqual(light.switch, "on")
+        self.assertEqual(events["on"].tolist(), [0])
+        self.assertEqual(events["motion"].tolist(), [])
+
+    def test_random_walk(self):
+        fleet = DeviceFleet(seed=7)
+        light, motion, therm, lock = fleet.extend(
+            [SmartLight("Light1"), MotionSensor("Motion1"), Thermostat("Therm1", 40),
+             SmartLock("Lock1")]
+        )
+        for _ in range(100):
+            before = (light.brightness, motion.motion, therm.temp)
+            fleet.tick()
+            self.assertLessEqual(abs(light.brightness - before[0]), 2)
+            self.assertLessEqual(abs(motion.motion - before[1]), 1)
+            self.assertIn(round(therm.temp - before[2], 6), (-0.1, 0.0, 0.1))
+            self.assertTrue(0 <= light.brightness <= 100 and 0 <= motion.motion <= 10)
+        self.assertEqual(lock.get_readings(), SmartLock("Lock1").get_readings())
+
+    def test_views_handle_actions(self):
+        fleet = DeviceFleet()
+        light = fleet.add(SmartLight("Light1", 50))
+        result = actions.dispatch(light, {"action": "set_thres", "value": 150})
+        self.assertEqual(result, "success")
+        self.assertEqual(fleet.threshold[0], 100)
+        actions.dispatch(light, {"action": "set_off"})
+        self.assertEqual(light.get_readings()["status"], "inactive")
+        self.assertFalse(fleet.switch_on[0])
+
+        # Inactive lights no longer switch themselves
+        fleet.tick([0])
+        self.assertEqual(light.switch, "off")
+
+    def test_view_sense(self):
+        fleet = DeviceFleet()
+        light = fleet.add(SmartLight("Light1", 50))
+        with contextlib.redirect_stdout(None):
+            light.sense(70)
+        self.assertEqual(fleet.value[0], 70)
+        self.assertFalse(fleet.switch_on[0])
+
+    def test_rejects_unknown_and_duplicate_devices(self):
+        fleet = DeviceFleet()
+        with self.assertRaises(TypeError):
+            fleet.add(Device("Dev1"))
+        fleet.add(SmartLight("Light1"))
+        with self.assertRaises(ValueError):
+            fleet.add(SmartLight("Light1"))
+
+    def test_large_fleet(self):
+        fleet = DeviceFleet(seed=3)
+        fleet.extend(SmartLight(f"Light{i}") for i in range(5000))
+        self.assertGreaterEqual(len(fleet.kind), 5000)
+        fleet.tick()
+        self.assertTrue(np.all((fleet.value[:5000] >= 88) & (fleet.value[:5000] <= 92)))
+        self.assertIsInstance(fleet.views[4999], FleetSmartLight)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import asyncio
+import unittest
+import sys
+sys.path.append("../")
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import device_service
+import hub_server
+import utils
+from device_registry import DeviceRegistry
+from fleet_simulator import FleetSimulator, build_fleet, parse_mix
+
+CREDS = {"user": "user1", "pass": "user1password"}
+
+
+class TestFleet(unittest.TestCase):
+
+    def test_parse_mix(self):
+        self.assertEqual(
+            parse_mix("SmartLight=3, Thermostat"), {"SmartLight": 3.0, "Thermostat": 1.0}
+        )
+
+    def test_parse_mix_invalid(self):
+        for text in ("Toaster=1", "SmartLight=-1", "SmartLock=0", "", "SmartLight=x"):
+            with self.assertRaises(ValueError):
+                parse_mix(text)
+
+    def test_build_fleet_follows_mix(self):
+        fleet = build_fleet(10, {"SmartLight": 3, "SmartLock": 1, "Thermostat": 1})
+        types = [device.__class__.__name__ for device in fleet]
+        self.assertEqual(types.count("SmartLight"), 6)
+        self.assertEqual(types.count("SmartLock"), 2)
+        self.assertEqual(types.count("Thermostat"), 2)
+        self.assertEqual(len({device.identifier for device in fleet}), 10)
+
+    def test_build_fleet_interleaves_types(self):
+        fleet = build_fleet(8, {"SmartLight": 1, "MotionSensor": 1}, prefix="A")
+        types = sorted(device.__class__.__name__ for device in fleet[:4])
+        self.assertEqual(types, ["MotionSensor", "MotionSensor", "SmartLight", "SmartLight"])
+        self.assertTrue(all(device.identifier.startswith("A-") for device in fleet))
+
+    def test_build_fleet_rounding(self):
+        fleet = build_fleet(7, parse_mix("SmartLight,MotionSensor,SmartLock"))
+        self.assertEqual(len(fleet), 7)
+
+
+class TestFleetSimulator(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend()
+        )
+        device_service.PRINT_REQUESTS = False
+
+    @classmethod
+    def tearDownClass(cls):
+        device_service.PRINT_REQUESTS = True
+
+    async def asyncSetUp(self):
+        self.device_list = DeviceRegistry()
+        self.server = hub_server.HubServer(self.private_key, CREDS, self.device_list, port=0)
+        await self.server.start()
+        self.port = self.server._server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server._server.close()
+
+    def simulator(self, count, creds=CREDS):
+        crypto = utils.CryptoContext(public_key=self.private_key.public_key())
+        fleet = build_fleet(count, parse_mix("SmartLight,Thermostat,SmartLock"))
+        return FleetSimulator(fleet, "127.0.0.1", self.port, creds, crypto, ramp_up=1000)
+
+    async def test_fleet_connects_and_answers(self):
+        simulator = self.simulator(12)
+        task = asyncio.ensure_future(simulator.run())
+        while len(self.device_list.ids(connected=True)) < 12:
+            await asyncio.sleep(0.01)
+
+        self.assertEqual(self.device_list.devtypes()["Thermostat"], 4)
+        reply = await self.server.request("Sim-SmartLight-1", {"action": "get_readings"}, 5)
+        self.assertEqual(reply["result"]["identifier"], "Sim-SmartLight-1")
+        reply = await self.server.request("Sim-SmartLock-2", {"action": "set_deactivate"}, 5)
+        self.assertEqual(reply["result"], "success")
+
+        summary = simulator.summary()
+        self.assertEqual(summary["connected"], 12)
+        self.assertEqual(summary["failed"], 0)
+        self.assertIsNotNone(summary["p99_ms"])
+
+        simulator.stop()
+        await asyncio.wait_for(task, 5)
+        self.assertEqual(simulator.connected, 0)
+
+    async def test_duration_and_disconnect(self):
+        simulator = self.simulator(3)
+        task = asyncio.ensure_future(simulator.run(duration=2))
+        while len(self.device_list.ids(connected=True)) < 3:
+            await asyncio.sleep(0.01)
+
+        reply = await self.server.request("Sim-Thermostat-1", {"action": "set_disconnect"}, 5)
+        self.assertEqual(reply["result"], "success")
+        await asyncio.wait_for(task, 5)
+        self.assertEqual(simulator.summary()["connected"], 0)
+
+    async def test_refused_connections_counted(self):
+        simulator = self.simulator(2, creds={"user": "user1", "pass": "wrong"})
+        await asyncio.wait_for(simulator.run(), 5)
+        summary = simulator.summary()
+        self.assertEqual(summary["failed"], 2)
+        self.assertEqual(summary["failures"], {"ConnectionError": 2})
+        self.assertIsNone(summary["p50_ms"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+import socket
+import sys
+sys.path.append("../")
+
+import framing
+
+
+class TestFrameReader(unittest.TestCase):
+
+    def test_partial_reads_are_reassembled(self):
+        reader = framing.FrameReader()
+        data = framing.pack_frame(b"hello world")
+        reader.feed(data[:3])
+        self.assertIsNone(reader.next_frame())
+        reader.feed(data[3:7])
+        self.assertIsNone(reader.next_frame())
+        reader.feed(data[7:])
+        self.assertEqual(reader.next_frame(), b"hello world")
+        self.assertIsNone(reader.next_frame())
+
+    def test_pipelined_frames_are_split(self):
+        reader = framing.FrameReader()
+        reader.feed(framing.pack_frame(b"one") + framing.pack_frame(b"") + framing.pack_frame(b"three"))
+        self.assertEqual(reader.next_frame(), b"one")
+        self.assertEqual(reader.next_frame(), b"")
+        self.assertEqual(reader.next_frame(), b"three")
+        self.assertIsNone(reader.next_frame())
+
+    def test_oversized_frame_rejected(self):
+        reader = framing.FrameReader(max_frame_size=4)
+        reader.feed(framing.HEADER.pack(5))
+        with self.assertRaises(framing.FrameError):
+            reader.next_frame()
+        with self.assertRaises(framing.FrameError):
+            framing.pack_frame(b"12345", max_frame_size=4)
+
+
+class TestSocketFrames(unittest.TestCase):
+
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def test_send_and_recv_frames(self):
+        framing.send_frames(self.left, [b"a" * 100, b"b", b"c" * 70000], max_frame_size=100000)
+        reader = framing.FrameReader(self.right, max_frame_size=100000)
+        self.assertEqual(reader.recv_frame(), b"a" * 100)
+        self.assertEqual(reader.recv_frame(), b"b")
+        self.assertEqual(reader.recv_frame(), b"c" * 70000)
+
+    def test_recv_frame_on_closed_connection(self):
+        framing.send_frame(self.left, b"last")
+        self.left.close()
+        reader = framing.FrameReader(self.right)
+        self.assertEqual(reader.recv_frame(), b"last")
+        self.assertIsNone(reader.recv_frame())
+
+
+if __name__ == '__main__':
+    unittest.main()
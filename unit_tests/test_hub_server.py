@@ -0,0 +1,415 @@
+import asyncio
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+import sys
+sys.path.append("../")
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import codec
+import framing
+import hub_server
+import utils
+from device_registry import DeviceRegistry
+from fleet_simulator import FleetSimulator, build_fleet, parse_mix
+from hub_server import BroadcastResult
+
+CREDS = {"user": "user1", "pass": "user1password"}
+
+
+class TestBroadcastSummary(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(hub_server.percentile(values, 50), 50)
+        self.assertEqual(hub_server.percentile(values, 99), 99)
+        self.assertEqual(hub_server.percentile(values, 100), 100)
+        self.assertEqual(hub_server.percentile([7], 90), 7)
+        self.assertIsNone(hub_server.percentile([], 50))
+
+    def test_summarize_broadcast(self):
+        results = [
+            BroadcastResult("Light1", {"result": "success"}, None, 0.010),
+            BroadcastResult("Light2", {"result": "success"}, None, 0.030),
+            BroadcastResult("Light3", None, "timed out", 5.0),
+        ]
+        summary = hub_server.summarize_broadcast(results)
+        self.assertEqual(summary["devices"], 3)
+        self.assertEqual(summary["answered"], 2)
+        self.assertEqual(summary["failed"], 1)
+        self.assertEqual(summary["p50_ms"], 10.0)
+        self.assertEqual(summary["max_ms"], 30.0)
+
+    def test_subscribe_msg(self):
+        self.assertEqual(
+            hub_server.subscribe_msg(5),
+            {"action": "subscribe", "interval": 5, "change": None, "encoding": "delta"},
+        )
+
+    def test_summarize_broadcast_no_answers(self):
+        summary = hub_server.summarize_broadcast([BroadcastResult("Lock1", None, "timed out", 5.0)])
+        self.assertEqual(summary["answered"], 0)
+        self.assertIsNone(summary["p50_ms"])
+
+
+class FakeDevice:
+    """Minimal device that connects to a HubServer and answers requests in reverse order."""
+
+    def __init__(self, port, public_key, devid="Light1", batch=1, codecs=None, readings=None):
+        self.port = port
+        self.public_key = public_key
+        self.devid = devid
+        self.batch = batch
+        self.codecs = codecs
+        self.readings = readings
+        self.received = []
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+        msg = {"action": "connect", "devid": self.devid, "devtype": "SmartLight"}
+        msg.update(CREDS)
+        if self.codecs is not None:
+            msg["codecs"] = self.codecs
+        self.session, handshake = utils.seal_handshake(msg, self.public_key)
+        framing.write_frame(self.writer, handshake)
+        reply = self.session.decrypt(await framing.read_frame(self.reader))
+        assert reply["result"] == "success"
+        self.codec = reply.get("codec")
+        self.session.codec = codec.get_codec(self.codec)
+
+    async def serve(self):
+        while True:
+            requests = []
+            for _ in range(self.batch):
+                frame = await framing.read_frame(self.reader)
+                if frame is None:
+                    return
+                requests.append(self.session.decrypt(frame))
+            self.received.extend(requests)
+            for request in reversed(requests):
+                msg = {"result": request["action"]}
+                if request["action"] == "ping":
+                    msg = {"event": "pong"}
+                elif request["action"] == "get_readings" and self.readings is not None:
+                    msg = {"result": dict(self.readings, requests=len(self.received))}
+                framing.write_frame(self.writer, self.session.encrypt(utils.reply_to(request, msg)))
+            await self.writer.drain()
+
+
+class TestHubServer(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend()
+        )
+
+    async def asyncSetUp(self):
+        self.device_list = DeviceRegistry()
+        self.server = hub_server.HubServer(self.private_key, CREDS, self.device_list, port=0)
+        await self.server.start()
+        self.port = self.server._server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server._server.close()
+
+    async def start_device(self, devid="Light1", batch=1, codecs=None, readings=None):
+        device = FakeDevice(
+            self.port, self.private_key.public_key(), devid, batch, codecs, readings
+        )
+        await device.connect()
+        task = asyncio.ensure_future(device.serve())
+        while self.device_list.conn(devid) is None:
+            await asyncio.sleep(0.01)
+        return device, task
+
+    async def test_registration(self):
+        registered = []
+        self.server.on_register = lambda deviceid: registered.append(
+            (deviceid, threading.get_ident())
+        )
+        device, task = await self.start_device()
+        conn = self.device_list.conn("Light1")
+        self.assertEqual(self.device_list.get("Light1")["devtype"], "SmartLight")
+        self.assertEqual(conn.devid, "Light1")
+
+        # New devices are handed to on_register once, from the event loop's thread
+        self.assertEqual(registered, [("Light1", threading.get_ident())])
+
+        # A reconnection replaces (and closes) the previous connection without registering again
+        device2, task2 = await self.start_device()
+        while self.device_list.conn("Light1") is conn:
+            await asyncio.sleep(0.01)
+        await asyncio.wait_for(task, 5)
+        self.assertEqual(len(registered), 1)
+        reply = await self.server.request("Light1", {"action": "set_on"}, 5)
+        self.assertEqual(reply["result"], "set_on")
+        self.assertEqual(len(device2.received), 1)
+
+        device2.writer.close()
+        await task2
+        while self.device_list.conn("Light1") is not None:
+            await asyncio.sleep(0.01)
+        self.assertIsNotNone(self.device_list.get("Light1"))
+
+    async def test_bad_credentials_rejected(self):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        msg = {"action": "connect", "devid": "Light1", "devtype": "SmartLight",
+               "user": "user1", "pass": "wrong"}
+        session, handshake = utils.seal_handshake(msg, self.private_key.public_key())
+        framing.write_frame(writer, handshake)
+        reply = session.decrypt(await asyncio.wait_for(framing.read_frame(reader), 5))
+        self.assertEqual(reply, {"result": "failure"})
+        self.assertIsNone(await asyncio.wait_for(framing.read_frame(reader), 5))
+        self.assertIsNone(self.device_list.get("Light1"))
+        writer.close()
+
+    async def test_undecryptable_handshake_closed(self):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        framing.write_frame(writer, os.urandom(300))
+        self.assertIsNone(await asyncio.wait_for(framing.read_frame(reader), 5))
+        self.assertEqual(len(self.device_list.ids()), 0)
+        writer.close()
+
+    async def test_pipelined_requests_matched_by_id(self):
+        device, task = await self.start_device(batch=3)
+        replies = await asyncio.gather(
+            self.server.request("Light1", {"action": "get_readings"}, 5),
+            self.server.request("Light1", {"action": "set_thres", "value": 10}, 5),
+            self.server.request("Light1", {"action": "set_on"}, 5),
+        )
+        self.assertEqual([r["result"] for r in replies], ["get_readings", "set_thres", "set_on"])
+        self.assertEqual(self.device_list.conn("Light1").pending, {})
+        device.writer.close()
+        await task
+
+    async def test_binary_codec_negotiated(self):
+        device, task = await self.start_device(codecs=["msgpack", "bin1", "json"])
+        self.assertEqual(device.codec, "bin1")
+        reply = await self.server.request("Light1", {"action": "set_on"}, 5)
+        self.assertEqual(reply["result"], "set_on")
+        device.writer.close()
+        await task
+
+    async def test_codec_switched_before_drain(self):
+        # A request sent while the connection response is still draining (here, from on_register)
+        # must already use the negotiated codec
+        requests = []
+        self.server.on_register = lambda deviceid: requests.append(
+            asyncio.ensure_future(self.server.request(deviceid, {"action": "set_on"}, 5))
+        )
+        drain = asyncio.StreamWriter.drain
+
+        async def slow_drain(writer):
+            # Only the HUB's side of the connection is slowed down
+            if writer.get_extra_info("sockname")[1] == self.port:
+                await asyncio.sleep(0.05)
+            await drain(writer)
+
+        with mock.patch.object(asyncio.StreamWriter, "drain", slow_drain):
+            device, task = await self.start_device(codecs=["bin1", "json"])
+            reply = await requests[0]
+        self.assertEqual(reply["result"], "set_on")
+        self.assertEqual(device.received[0]["action"], "set_on")
+        device.writer.close()
+        await task
+
+    async def test_json_without_codecs(self):
+        device, task = await self.start_device()
+        self.assertIsNone(device.codec)
+        self.assertIs(self.device_list.conn("Light1").session.codec, codec.JSON)
+        device.writer.close()
+        await task
+
+    async def test_disconnect_fails_pending_request(self):
+        device, task = await self.start_device(batch=2)
+        request = asyncio.ensure_future(self.server.request("Light1", {"action": "get_readings"}))
+        await asyncio.sleep(0.05)
+        device.writer.close()
+        with self.assertRaises(ConnectionError):
+            await request
+        await task
+        self.assertIsNone(self.device_list.conn("Light1"))
+
+    async def test_get_readings_from_cache(self):
+        device, task = await self.start_device(readings={"identifier": "Light1", "brightness": 5})
+        reply = await self.server.request("Light1", {"action": "get_readings", "max_age": 10}, 5)
+        self.assertNotIn("cached", reply)
+        self.assertEqual(reply["result"]["requests"], 1)
+
+        # Served from the cache, without a round trip (and max_age isn't sent to the device)
+        reply = await self.server.request("Light1", {"action": "get_readings", "max_age": 10}, 5)
+        self.assertTrue(reply["cached"])
+        self.assertEqual(reply["result"]["requests"], 1)
+        self.assertEqual(len(device.received), 1)
+        self.assertNotIn("max_age", device.received[0])
+
+        # Too old for the caller (or for the server's TTL)
+        reply = await self.server.request("Light1", {"action": "get_readings", "max_age": 0}, 5)
+        self.assertEqual(reply["result"]["requests"], 2)
+        self.server.state_ttl = 0
+        reply = await self.server.request("Light1", {"action": "get_readings", "max_age": 10}, 5)
+        self.assertEqual(reply["result"]["requests"], 3)
+        self.server.state_ttl = hub_server.STATE_TTL
+
+        # Other actions invalidate the cached readings
+        await self.server.request("Light1", {"action": "set_on"}, 5)
+        self.assertIsNone(self.server.cached_readings("Light1"))
+        reply = await self.server.request("Light1", {"action": "get_readings", "max_age": 10}, 5)
+        self.assertEqual(reply["result"]["requests"], 5)
+        self.assertIsNotNone(self.server.cached_readings("Light1", 10))
+
+        device.writer.close()
+        await task
+        while self.device_list.conn("Light1") is not None:
+            await asyncio.sleep(0.01)
+        self.assertIsNone(self.server.cached_readings("Light1"))
+
+    async def test_heartbeats_evict_silent_devices(self):
+        device, task = await self.start_device()
+        silent = FakeDevice(self.port, self.private_key.public_key(), "Light2")
+        await silent.connect()
+        while self.device_list.conn("Light2") is None:
+            await asyncio.sleep(0.01)
+        conn, silent_conn = self.device_list.conn("Light1"), self.device_list.conn("Light2")
+
+        # Requests to a device that doesn't answer time out by default
+        self.server.request_timeout = 0.1
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.server.request("Light2", {"action": "set_on"})
+        self.server.request_timeout = hub_server.REQUEST_TIMEOUT
+
+        # Both connections have been quiet for an interval, so both are pinged; only Light1 answers
+        self.server.heartbeat_interval = 1.0
+        pinged = time.monotonic()
+        self.assertEqual(self.server.sweep(pinged + 1.0), [])
+        while conn.last_seen < pinged:
+            await asyncio.sleep(0.01)
+
+        pending = asyncio.ensure_future(self.server.request("Light2", {"action": "set_on"}))
+        await asyncio.sleep(0.05)
+        now = silent_conn.last_seen + 3.0 + (conn.last_seen - silent_conn.last_seen) / 2
+        self.assertEqual(self.server.sweep(now), ["Light2"])
+        self.assertIsNone(self.device_list.conn("Light2"))
+        self.assertIs(self.device_list.conn("Light1"), conn)
+        with self.assertRaises(ConnectionError):
+            await pending
+
+        self.server.heartbeat_interval = utils.HEARTBEAT_INTERVAL
+        device.writer.close()
+        silent.writer.close()
+        await task
+
+    async def test_pushing_device_kept_alive(self):
+        # A subscribed device only pushes, and (like device_service.py) gives up on a HUB it hasn't
+        # heard from for heartbeat_misses intervals
+        server = hub_server.HubServer(
+            self.private_key, CREDS, self.device_list, port=0, heartbeat_interval=0.05
+        )
+        await server.start()
+        device = FakeDevice(
+            server._server.sockets[0].getsockname()[1], self.private_key.public_key()
+        )
+        await device.connect()
+        deadline = server.heartbeat_interval * server.heartbeat_misses
+
+        async def push():
+            for seq in range(40):
+                msg = {"event": "readings", "result": {"identifier": "Light1", "brightness": seq}}
+                framing.write_frame(device.writer, device.session.encrypt(msg))
+                await device.writer.drain()
+                await asyncio.sleep(0.01)
+
+        async def listen():
+            while True:
+                frame = await asyncio.wait_for(framing.read_frame(device.reader), deadline)
+                if frame is None:
+                    return
+                request = device.session.decrypt(frame)
+                device.received.append(request)
+                reply = utils.reply_to(request, {"event": "pong"})
+                framing.write_frame(device.writer, device.session.encrypt(reply))
+
+        listener = asyncio.ensure_future(listen())
+        await push()
+        self.assertFalse(listener.done())
+        self.assertGreaterEqual(len(device.received), 3)
+        self.assertTrue(all(request["action"] == "ping" for request in device.received))
+        self.assertEqual(server.cached_readings("Light1")[0]["brightness"], 39)
+
+        device.writer.close()
+        await listener
+        server._server.close()
+        server._heartbeat_task.cancel()
+
+    async def test_failing_listener_isolated(self):
+        received = []
+        self.server.readings_listeners.append(lambda deviceid, readings: 1 / 0)
+        self.server.readings_listeners.append(lambda *args: received.append(args))
+        device, task = await self.start_device()
+        msg = {"event": "readings", "result": {"identifier": "Light1", "brightness": 7}}
+        framing.write_frame(device.writer, device.session.encrypt(msg))
+        while not received:
+            await asyncio.sleep(0.01)
+        self.assertEqual(received, [("Light1", msg["result"])])
+        reply = await self.server.request("Light1", {"action": "set_on"}, 5)
+        self.assertEqual(reply["result"], "set_on")
+        device.writer.close()
+        await task
+
+    async def test_subscribe_push_and_unsubscribe(self):
+        crypto = utils.CryptoContext(public_key=self.private_key.public_key())
+        fleet = build_fleet(1, parse_mix("Thermostat"))
+        simulator = FleetSimulator(
+            fleet, "127.0.0.1", self.port, CREDS, crypto, ramp_up=1000, sense_interval=0.02
+        )
+        task = asyncio.ensure_future(simulator.run())
+        while not self.device_list.ids(connected=True):
+            await asyncio.sleep(0.01)
+        vdev = simulator.devices[0]
+        devid = vdev.device.identifier
+        pushed = []
+        self.server.readings_listeners.append(lambda *args: pushed.append(args))
+
+        # The device pushes its readings as deltas, which are merged back into full readings
+        reply = await self.server.subscribe(devid, timeout=5)
+        self.assertEqual(reply["result"], "success")
+        self.assertEqual(vdev.subscription.encoding, "delta")
+        while len(pushed) < 5:
+            await asyncio.sleep(0.01)
+        self.assertGreater(vdev.encoder.seq, 0)
+        self.assertTrue(all(readings["identifier"] == devid for _, readings in pushed))
+        self.assertEqual(set(pushed[-1][1]), set(vdev.device.get_readings()))
+        self.assertEqual(self.server.live_view[devid]["readings"], pushed[-1][1])
+
+        reply = await self.server.request(devid, {"action": "unsubscribe"}, 5)
+        self.assertEqual(reply["result"], "success")
+        count = len(pushed)
+        await asyncio.sleep(0.1)
+        self.assertEqual(len(pushed), count)
+
+        simulator.stop()
+        await asyncio.wait_for(task, 5)
+
+    async def test_handshake_timeout(self):
+        self.server.request_timeout = 0.1
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        self.assertEqual(await asyncio.wait_for(reader.read(), 5), b"")
+        writer.close()
+
+    async def test_broadcast(self):
+        tasks = [(await self.start_device(devid))[1] for devid in ("Light1", "Light2")]
+        results = [r async for r in self.server.broadcast(["Light1", "Light2", "Light3"], {"action": "set_on"}, 5)]
+        errors = {r.deviceid: r.error for r in results}
+        self.assertEqual(errors, {"Light1": None, "Light2": None, "Light3": "unable to connect to the device"})
+        self.server.shutdown()
+        for task in tasks:
+            await task
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+import os
+import tempfile
+import threading
+import unittest
+import sys
+sys.path.append("../")
+
+from cryptography.fernet import Fernet
+
+import utils
+from registry_store import RegistryStore, WriteBehindPersister
+
+
+class TestRegistryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "stored_devices.log")
+        self.fer_key = Fernet.generate_key()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def reopen(self, **kwargs):
+        store = RegistryStore(self.path, self.fer_key, **kwargs)
+        return store, store.load()
+
+    def test_put_and_reload(self):
+        store, devices = self.reopen()
+        self.assertEqual(devices, {})
+        self.assertTrue(store.put("Light1", "SmartLight"))
+        self.assertTrue(store.put("Lock1", "SmartLock"))
+        self.assertTrue(store.put("Light1", "Thermostat"))
+        store.close()
+
+        store, devices = self.reopen()
+        self.assertEqual(devices, {"Light1": "Thermostat", "Lock1": "SmartLock"})
+        self.assertEqual(store.records, 3)
+
+    def test_only_changes_are_appended(self):
+        store, _ = self.reopen()
+        store.put("Light1", "SmartLight")
+        size = os.path.getsize(self.path)
+        store.put("Light1", "SmartLight")
+        self.assertEqual(os.path.getsize(self.path), size)
+        store.close()
+
+    def test_delete(self):
+        store, _ = self.reopen()
+        store.put("Light1", "SmartLight")
+        store.delete("Light1")
+        store.close()
+        self.assertEqual(self.reopen()[1], {})
+
+    def test_compaction(self):
+        store, _ = self.reopen(compact_ratio=2, compact_min_records=4)
+        for devtype in ("SmartLight", "SmartLock", "Thermostat", "MotionSensor"):
+            store.put("Light1", devtype)
+        self.assertEqual(store.records, 1)
+        store.close()
+
+        with open(self.path, "rb") as log:
+            self.assertEqual(len(log.readlines()), 1)
+        self.assertEqual(self.reopen()[1], {"Light1": "MotionSensor"})
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_torn_record_skipped(self):
+        store, _ = self.reopen()
+        store.put("Light1", "SmartLight")
+        store.close()
+        with open(self.path, "ab") as log:
+            log.write(b"gAAAAAB-half-written")
+
+        store, devices = self.reopen()
+        self.assertEqual(devices, {"Light1": "SmartLight"})
+        store.put("Lock1", "SmartLock")
+        store.close()
+        self.assertEqual(self.reopen()[1], {"Light1": "SmartLight", "Lock1": "SmartLock"})
+
+    def test_legacy_migration(self):
+        legacy = os.path.join(self.tmpdir.name, "stored_devices.bin")
+        devlist = {"Light1": {"devtype": "SmartLight"}, "Lock1": {"devtype": "SmartLock"}}
+        utils.encrypt_and_save_fernet(devlist, self.fer_key, legacy)
+
+        store = RegistryStore(self.path, self.fer_key)
+        self.assertEqual(store.load(legacy), {"Light1": "SmartLight", "Lock1": "SmartLock"})
+        self.assertEqual(self.reopen()[1], {"Light1": "SmartLight", "Lock1": "SmartLock"})
+
+
+class TestWriteBehindPersister(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "stored_devices.log")
+        self.fer_key = Fernet.generate_key()
+        self.store = RegistryStore(self.path, self.fer_key)
+        self.store.load()
+        self.flushes = []
+        self.flushed = threading.Event()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def on_flush(self, count, saved):
+        self.flushes.append((count, saved))
+        self.flushed.set()
+
+    def saved_devices(self):
+        return RegistryStore(self.path, self.fer_key).load()
+
+    def test_changes_coalesced_within_window(self):
+        persister = WriteBehindPersister(self.store, window=0.2, on_flush=self.on_flush)
+        persister.submit("Light1", "SmartLight")
+        persister.submit("Lock1", "SmartLock")
+        persister.submit("Light1", "Thermostat")
+        self.assertTrue(self.flushed.wait(5))
+        self.assertEqual(self.flushes, [(2, True)])
+        self.assertEqual(self.saved_devices(), {"Light1": "Thermostat", "Lock1": "SmartLock"})
+        persister.close()
+
+    def test_flush_when_enough_changes(self):
+        persister = WriteBehindPersister(
+            self.store, window=60, max_changes=3, on_flush=self.on_flush
+        )
+        for i in range(3):
+            persister.submit(f"Light{i}", "SmartLight")
+        self.assertTrue(self.flushed.wait(5))
+        self.assertEqual(len(self.saved_devices()), 3)
+        persister.close()
+
+    def test_close_flushes(self):
+        persister = WriteBehindPersister(self.store, window=60)
+        persister.submit("Light1", "SmartLight")
+        persister.remove("Light1")
+        persister.submit("Lock1", "SmartLock")
+        persister.close()
+        self.assertEqual(self.saved_devices(), {"Lock1": "SmartLock"})
+        with self.assertRaises(RuntimeError):
+            persister.submit("Light2", "SmartLight")
+
+    def test_flush_during_window(self):
+        persister = WriteBehindPersister(self.store, window=0.2, on_flush=self.on_flush)
+        persister.submit("Light1", "SmartLight")
+        self.assertTrue(persister.flush())
+        self.assertEqual(self.flushes, [(1, True)])
+
+        # The thread was waiting for the window of the flushed change, it must keep writing
+        self.flushed.clear()
+        persister.submit("Lock1", "SmartLock")
+        self.assertTrue(self.flushed.wait(5))
+        self.assertEqual(self.flushes, [(1, True), (1, True)])
+        self.assertEqual(self.saved_devices(), {"Light1": "SmartLight", "Lock1": "SmartLock"})
+        persister.close()
+
+    def test_failed_changes_retried(self):
+        apply = self.store.apply
+        failures = [OSError("disk full"), False]
+
+        def flaky_apply(changes):
+            if failures:
+                failure = failures.pop(0)
+                if isinstance(failure, Exception):
+                    raise failure
+                return failure
+            return apply(changes)
+
+        self.store.apply = flaky_apply
+        persister = WriteBehindPersister(self.store, window=60, on_flush=self.on_flush)
+        persister.submit("Light1", "SmartLight")
+        persister.submit("Lock1", "SmartLock")
+        self.assertFalse(persister.flush())
+
+        # A newer change of a device replaces the failed one, the others are written again
+        persister.submit("Light1", "Thermostat")
+        self.assertFalse(persister.flush())
+        self.assertTrue(persister.flush())
+        self.assertEqual(self.flushes, [(2, False), (2, False), (2, True)])
+        self.assertEqual(self.saved_devices(), {"Light1": "Thermostat", "Lock1": "SmartLock"})
+        persister.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+import sys
+sys.path.append("../")
+
+from rules import Rule, RuleEngine
+
+
+class TestRule(unittest.TestCase):
+
+    def test_parse(self):
+        rule = Rule("if  Motion1.motion >= threshold then Light1 set_on")
+        self.assertEqual(str(rule), "if Motion1.motion >= threshold then Light1 set_on")
+        self.assertEqual(rule.keys(), [("Motion1", "motion"), ("Motion1", "threshold")])
+        self.assertEqual(rule.message(), {"action": "set_on"})
+
+        rule = Rule("if Therm1.temp > 21.5 then Therm2 set_thres 25")
+        self.assertEqual(rule.keys(), [("Therm1", "temp")])
+        self.assertEqual(rule.message(), {"action": "set_thres", "value": 25})
+        self.assertEqual(Rule("if Light1.switch == off then Lock1 set_on").right, ("const", "off"))
+        self.assertEqual(
+            Rule("if Therm1.temp < Therm2.temp then Therm1 set_on").keys(),
+            [("Therm1", "temp"), ("Therm2", "temp")],
+        )
+
+    def test_parse_invalid(self):
+        for text in (
+            "",
+            "Motion1.motion >= 5 then Light1 set_on",
+            "if Motion1.motion => 5 then Light1 set_on",
+            "if motion >= 5 then Light1 set_on",
+            "if Motion1.motion >= 5 then Light1",
+            "if Therm1.temp > 30 then Therm1 set_thres high",
+        ):
+            with self.assertRaises(ValueError):
+                Rule(text)
+
+
+class TestRuleEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.fired = []
+        self.engine = RuleEngine(on_fire=self.fired.append)
+        self.rule = self.engine.add("if Motion1.motion >= threshold then Light1 set_on")
+
+    def test_edge_triggered(self):
+        self.assertEqual(self.engine.update("Motion1", {"motion": 2, "threshold": 5}), [])
+        self.assertEqual(self.engine.update("Motion1", {"motion": 6, "threshold": 5}), [self.rule])
+        self.assertEqual(self.engine.update("Motion1", {"motion": 8, "threshold": 5}), [])
+        self.engine.update("Motion1", {"motion": 1, "threshold": 5})
+        self.engine.update("Motion1", {"motion": 1, "threshold": 1})
+        self.assertEqual(self.fired, [self.rule, self.rule])
+        self.assertEqual(self.rule.fired, 2)
+
+    def test_only_affected_rules_evaluated(self):
+        other = self.engine.add("if Therm1.temp > Therm2.temp then Therm2 set_thres 25")
+        with mock.patch.object(Rule, "evaluate", autospec=True, return_value=False) as evaluate:
+            self.engine.update("Motion1", {"motion": 6, "threshold": 5, "status": "active"})
+            self.assertEqual([call.args[0] for call in evaluate.call_args_list], [self.rule])
+            evaluate.reset_mock()
+            self.engine.update("Therm2", {"temp": 20.0})
+            self.engine.update("Therm2", {"temp": 20.0})
+            self.assertEqual([call.args[0] for call in evaluate.call_args_list], [other])
+
+    def test_cross_device_and_missing_readings(self):
+        rule = self.engine.add("if Therm1.temp > Therm2.temp then Therm2 set_on")
+        self.assertEqual(self.engine.update("Therm1", {"temp": 25.0}), [])
+        self.assertEqual(self.engine.update("Therm2", {"temp": 20.0}), [rule])
+        self.assertEqual(self.engine.update("Light1", {"switch": "on"}), [])
+
+    def test_remove_and_failing_callback(self):
+        self.engine.remove(self.rule)
+        self.assertEqual(self.engine.update("Motion1", {"motion": 6, "threshold": 5}), [])
+        engine = RuleEngine(on_fire=lambda rule: 1 / 0)
+        rule = engine.add("if Light1.switch == off then Motion1 set_off")
+        self.assertEqual(engine.update("Light1", {"switch": "off"}), [rule])
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "rules.txt")
+            with open(path, "w", encoding="utf-8") as rules_file:
+                rules_file.write("# Lights\nif Light1.brightness < 10 then Light1 set_on\n\n"
+                                 "not a rule\n")
+            self.assertEqual(self.engine.load(path), 1)
+            self.assertEqual(self.engine.load(os.path.join(tmpdir, "missing.txt")), 0)
+        self.assertEqual(len(self.engine.rules), 2)
+
+    def test_many_rules(self):
+        engine = RuleEngine()
+        for i in range(5000):
+            engine.add(f"if Motion{i}.motion >= threshold then Light{i} set_on")
+        start = time.perf_counter()
+        for i in range(1000):
+            engine.update("Motion7", {"motion": i % 10, "threshold": 5, "status": "active"})
+        self.assertLess((time.perf_counter() - start) / 1000, 0.001)
+        self.assertEqual(engine.rules[7].fired, 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+import threading
+import time
+import unittest
+import sys
+sys.path.append("../")
+
+from scheduler import TickScheduler
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTickScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = TickScheduler(clock=self.clock, seed=1)
+        self.ticks = []
+
+    def job(self, name, interval, jitter=0.0, delay=0.0):
+        return self.scheduler.schedule(
+            lambda: self.ticks.append((name, self.clock.now)), interval, jitter, delay
+        )
+
+    def test_fixed_rate_without_drift(self):
+        job = self.job("a", 5)
+        # Each tick runs a little late, but the next one is still due on the 5 second grid
+        for late in (0.0, 0.7, 1.3, 0.2):
+            self.clock.now = job.due + late
+            self.assertEqual(self.scheduler.run_pending(), 1)
+        self.assertEqual([t for _, t in self.ticks], [100.0, 105.7, 111.3, 115.2])
+        self.assertEqual(job.due, 120.0)
+        self.assertEqual(job.runs, 4)
+
+    def test_missed_ticks_skipped(self):
+        job = self.job("a", 5)
+        self.clock.now = 123.0
+        self.assertEqual(self.scheduler.run_pending(), 1)
+        self.assertEqual(job.missed, 4)
+        self.assertEqual(job.due, 125.0)
+
+    def test_jobs_run_in_order_of_due_time(self):
+        self.job("slow", 10)
+        self.job("fast", 3)
+        while self.scheduler.next_time() <= 110.0:
+            self.clock.now = self.scheduler.next_time()
+            self.scheduler.run_pending()
+        names = [name for name, _ in self.ticks]
+        self.assertEqual(names.count("fast"), 4)
+        self.assertEqual(names.count("slow"), 2)
+
+    def test_jitter_stays_within_bounds(self):
+        job = self.job("a", 5, jitter=1.0)
+        for _ in range(50):
+            self.assertLessEqual(abs(job.when - job.due), 1.0)
+            self.clock.now = job.when
+            self.scheduler.run_pending()
+        self.assertEqual(job.runs, 50)
+        self.assertEqual(job.missed, 0)
+
+    def test_default_delay_spreads_jobs(self):
+        jobs = [self.scheduler.schedule(lambda: None, 5) for _ in range(20)]
+        offsets = {job.due - self.clock.now for job in jobs}
+        self.assertEqual(len(offsets), 20)
+        self.assertTrue(all(0 <= offset <= 5 for offset in offsets))
+
+    def test_cancel_and_reschedule(self):
+        a = self.job("a", 5)
+        b = self.job("b", 5)
+        self.scheduler.cancel(a)
+        self.assertEqual(len(self.scheduler), 1)
+        self.scheduler.run_pending()
+        self.scheduler.reschedule(b, 2)
+        self.assertEqual(b.due, 102.0)
+        self.clock.now = 105.0
+        self.scheduler.run_pending()
+        self.assertEqual(b.due, 106.0)
+        self.assertEqual([name for name, _ in self.ticks], ["b", "b"])
+
+    def test_reschedule_takes_effect_right_away(self):
+        job = self.job("a", 100)
+        self.scheduler.run_pending()
+        self.clock.now = 103.5
+        self.scheduler.reschedule(job, 1, jitter=0.0)
+        self.assertEqual(self.scheduler.next_time(), 103.5)
+        for now in (103.5, 104.5, 105.5):
+            self.clock.now = now
+            self.assertEqual(self.scheduler.run_pending(), 1)
+        self.assertEqual(len(self.scheduler), 1)
+        self.assertEqual(len(self.ticks), 4)
+
+        # Slowing down counts from the last tick as well
+        self.scheduler.reschedule(job, 10)
+        self.assertEqual(job.due, 115.5)
+        with self.assertRaises(ValueError):
+            self.scheduler.reschedule(job, 1, jitter=-1)
+
+    def test_invalid_jobs(self):
+        with self.assertRaises(ValueError):
+            self.scheduler.schedule(lambda: None, 0)
+        with self.assertRaises(ValueError):
+            self.scheduler.schedule(lambda: None, 1, jitter=-1)
+
+    def test_failing_job_doesnt_stop_others(self):
+        self.scheduler.schedule(lambda: 1 / 0, 5, delay=0)
+        self.job("a", 5)
+        self.assertEqual(self.scheduler.run_pending(), 2)
+        self.assertEqual(len(self.ticks), 1)
+
+    def test_thread_drives_many_jobs(self):
+        scheduler = TickScheduler()
+        counts = [0] * 200
+        lock = threading.Lock()
+
+        def tick(i):
+            with lock:
+                counts[i] += 1
+
+        for i in range(200):
+            scheduler.schedule(lambda i=i: tick(i), 0.02)
+        scheduler.start()
+        thread = scheduler._thread
+        scheduler.start()
+        self.assertIs(scheduler._thread, thread)
+        time.sleep(0.25)
+        scheduler.stop()
+        self.assertFalse(thread.is_alive())
+
+        stopped = list(counts)
+        time.sleep(0.05)
+        self.assertEqual(counts, stopped)
+        self.assertTrue(all(count >= 5 for count in counts))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import sys
+sys.path.append("../")
+
+import numpy as np
+from cryptography.fernet import Fernet
+
+from telemetry import RECORD_TYPES, TelemetryStore
+
+
+def light_readings(i):
+    return {"identifier": f"Light{i % 3}", "status": "active", "threshold": 50,
+            "switch": "on" if i % 2 else "off", "brightness": i % 100}
+
+
+class TestTelemetryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dir = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_record_layouts(self):
+        self.assertEqual(
+            RECORD_TYPES["SmartLight"].names,
+            ("time", "identifier", "status", "threshold", "switch", "brightness"),
+        )
+        self.assertEqual(
+            RECORD_TYPES["SmartLock"].names,
+            ("time", "identifier", "status", "threshold", "switch"),
+        )
+        self.assertEqual(RECORD_TYPES["Thermostat"]["temp"], np.float64)
+
+    def test_record_and_scan(self):
+        store = TelemetryStore(self.dir, segment_records=100)
+        for i in range(250):
+            store.record(f"Light{i % 3}", "SmartLight", light_readings(i), timestamp=1000 + i)
+        self.assertFalse(store.record("Toaster1", "Toaster", {}))
+
+        parts = list(store.scan("SmartLight"))
+        self.assertEqual([len(part) for part in parts], [100, 100, 50])
+        self.assertFalse(parts[0].flags.owndata)
+        self.assertFalse(parts[0].flags.writeable)
+
+        records = store.load("SmartLight", start=1090, end=1110)
+        self.assertEqual(records["time"].tolist(), list(range(1090, 1110)))
+        self.assertEqual(records["brightness"][0], 90)
+        self.assertEqual(records["switch"].tolist()[:2], [False, True])
+
+        records = store.load("SmartLight", deviceid="Light1")
+        self.assertEqual(len(records), 83)
+        self.assertTrue(np.all(records["identifier"] == b"Light1"))
+        self.assertEqual(len(store.load("Thermostat")), 0)
+        with self.assertRaises(ValueError):
+            store.load("Toaster")
+        store.close()
+
+    def test_reopen_continues_last_segment(self):
+        store = TelemetryStore(self.dir, segment_records=10)
+        for i in range(15):
+            store.record("Light1", "SmartLight", light_readings(i), timestamp=i)
+        store.close()
+
+        store = TelemetryStore(self.dir, segment_records=10)
+        store.record("Light1", "SmartLight", light_readings(15), timestamp=15)
+        self.assertEqual(store.load("SmartLight")["time"].tolist(), list(range(16)))
+        self.assertEqual(len(os.listdir(self.dir)), 2)
+        store.close()
+
+    def test_encrypted_segments(self):
+        key = Fernet.generate_key()
+        store = TelemetryStore(self.dir, fer_key=key, segment_records=10)
+        for i in range(25):
+            store.record("Therm1", "Thermostat", {"status": "active", "temp": 20 + i / 10},
+                         timestamp=i)
+        store.flush()
+        names = sorted(os.listdir(self.dir))
+        self.assertEqual(names, ["Thermostat-000000.seg.enc", "Thermostat-000001.seg.enc",
+                                 "Thermostat-000002.seg"])
+        with open(os.path.join(self.dir, names[0]), "rb") as segment:
+            Fernet(key).decrypt(segment.read())
+
+        store.close()
+        self.assertTrue(all(name.endswith(".enc") for name in os.listdir(self.dir)))
+
+        store = TelemetryStore(self.dir, fer_key=key)
+        records = store.load("Thermostat")
+        self.assertEqual(len(records), 25)
+        self.assertAlmostEqual(records["temp"][-1], 22.4)
+        self.assertTrue(np.isnan(records["threshold"][0]))
+
+        # Without the key the encrypted segments can't be read
+        self.assertEqual(len(TelemetryStore(self.dir).load("Thermostat")), 0)
+
+    def test_sealing_doesnt_block_recording(self):
+        store = TelemetryStore(self.dir, fer_key=Fernet.generate_key(), segment_records=10)
+        seal = store._seal
+        release = threading.Event()
+
+        def slow_seal(segment):
+            release.wait(5)
+            seal(segment)
+
+        with mock.patch.object(store, "_seal", slow_seal):
+            for i in range(25):
+                store.record("Light1", "SmartLight", light_readings(i), timestamp=i)
+            # Both full segments are still waiting to be sealed, yet every record was written and
+            # can be read
+            self.assertFalse(any(name.endswith(".enc") for name in os.listdir(self.dir)))
+            self.assertEqual(store.load("SmartLight")["time"].tolist(), list(range(25)))
+            release.set()
+            store.flush()
+
+        self.assertEqual(sorted(os.listdir(self.dir)), [
+            "SmartLight-000000.seg.enc", "SmartLight-000001.seg.enc", "SmartLight-000002.seg"
+        ])
+        self.assertEqual(len(store.load("SmartLight")), 25)
+        store.close()
+        self.assertEqual(len(os.listdir(self.dir)), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+import unittest
+import sys
+sys.path.append("../")
+
+import numpy as np
+
+from timeseries import INITIAL_ROWS, ColumnBuffer, TimeSeriesStore, numeric_fields
+
+
+class TestColumnBuffer(unittest.TestCase):
+
+    def test_keeps_latest_rows_in_order(self):
+        buffer = ColumnBuffer(5)
+        for t in range(23):
+            buffer.append(float(t), {"v": t * 2.0})
+        self.assertEqual(len(buffer), 5)
+        times, columns = buffer.slice()
+        self.assertEqual(times.tolist(), [18, 19, 20, 21, 22])
+        self.assertEqual(columns["v"].tolist(), [36, 38, 40, 42, 44])
+
+    def test_new_columns_and_ranges(self):
+        buffer = ColumnBuffer(10)
+        buffer.append(1.0, {"a": 1})
+        buffer.append(2.0, {"a": 2, "b": 5})
+        buffer.append(3.0, {"b": 6})
+        times, columns = buffer.slice(2, 3)
+        self.assertEqual(times.tolist(), [2])
+        times, columns = buffer.slice(names=["b"])
+        self.assertEqual(list(columns), ["b"])
+        self.assertTrue(np.isnan(columns["b"][0]))
+        self.assertEqual(columns["b"][1:].tolist(), [5, 6])
+
+        # Slices are copies, so they don't change as rows are added
+        buffer.append(4.0, {"b": 7})
+        self.assertEqual(times.tolist(), [1, 2, 3])
+
+    def test_grows_on_demand(self):
+        buffer = ColumnBuffer(100)
+        buffer.append(0.0, {"a": 0})
+        self.assertEqual(len(buffer.times), INITIAL_ROWS)
+        for t in range(1, 150):
+            buffer.append(float(t), {"a": t, "b": -t} if t >= 20 else {"a": t})
+        self.assertEqual(len(buffer.times), 200)
+        self.assertEqual(len(buffer.columns["b"]), 200)
+
+        # Growing keeps the rows (and the NaNs of rows from before a column existed)
+        times, columns = buffer.slice()
+        self.assertEqual(times.tolist(), list(range(50, 150)))
+        self.assertEqual(columns["a"].tolist(), list(range(50, 150)))
+        self.assertEqual(columns["b"].tolist(), [-t for t in range(50, 150)])
+        small = ColumnBuffer(100)
+        small.append(0.0, {"a": 0})
+        small.append(1.0, {"b": 1})
+        for t in range(2, INITIAL_ROWS + 1):
+            small.append(float(t), {"a": t})
+        self.assertEqual(len(small.times), 2 * INITIAL_ROWS)
+        self.assertTrue(np.isnan(small.slice()[1]["b"][0]))
+        self.assertEqual(small.slice()[1]["b"][1], 1)
+
+        # Never beyond twice the capacity
+        for t in range(150, 1000):
+            buffer.append(float(t), {"a": t})
+        self.assertEqual(len(buffer.times), 200)
+        self.assertEqual(buffer.slice()[0][0], 900)
+
+
+class TestTimeSeriesStore(unittest.TestCase):
+
+    def test_numeric_fields(self):
+        readings = {"identifier": "Therm1", "status": "active", "temp": 21.5, "threshold": 23,
+                    "locked": True}
+        self.assertEqual(numeric_fields(readings), {"temp": 21.5, "threshold": 23.0})
+
+    def test_query(self):
+        store = TimeSeriesStore()
+        for t in range(100):
+            store.record("Therm1", {"temp": 20 + t / 10, "status": "active"}, timestamp=1000 + t)
+        store.record("Lock1", {"status": "active", "switch": "on"})
+        self.assertEqual(store.devices(), ["Therm1"])
+        self.assertIsNone(store.query("Lock1"))
+
+        times, values = store.query("Therm1", start=1010, end=1020)
+        self.assertEqual(times.tolist(), list(range(1010, 1020)))
+        self.assertAlmostEqual(values["temp"][0], 21.0)
+
+    def test_out_of_order_timestamps(self):
+        store = TimeSeriesStore()
+        store.record("Light1", {"brightness": 10}, timestamp=100)
+        store.record("Light1", {"brightness": 20}, timestamp=90)
+        times, values = store.query("Light1")
+        self.assertEqual(times.tolist(), [100, 100])
+        self.assertEqual(values["brightness"].tolist(), [10, 20])
+
+    def test_rollup(self):
+        store = TimeSeriesStore(tiers=((60, 10), (3600, 5)))
+        for t in range(0, 600, 10):
+            store.record("Light1", {"brightness": t % 60}, timestamp=3600 + t)
+        store.record("Light1", {"threshold": 50}, timestamp=3600 + 590)
+
+        rollup = store.rollup("Light1", 60, start=3600 + 130)
+        self.assertEqual(rollup["time"].tolist(), [3600 + 60 * i for i in range(2, 10)])
+        self.assertEqual(rollup["brightness"]["min"].tolist(), [0] * 8)
+        self.assertEqual(rollup["brightness"]["max"].tolist(), [50] * 8)
+        self.assertEqual(rollup["brightness"]["mean"].tolist(), [25] * 8)
+        self.assertEqual(rollup["threshold"]["count"].tolist(), [0] * 7 + [1])
+
+        hourly = store.rollup("Light1", 3600, fields=["brightness"])
+        self.assertEqual(list(hourly), ["time", "brightness"])
+        self.assertEqual(hourly["brightness"]["count"].tolist(), [60])
+
+        with self.assertRaises(ValueError):
+            store.rollup("Light1", 120)
+
+    def test_bounded_memory(self):
+        store = TimeSeriesStore(raw_capacity=100, tiers=((60, 24),))
+        for t in range(10000):
+            store.record("Motion1", {"motion": t % 10}, timestamp=t)
+        times, _ = store.query("Motion1")
+        self.assertEqual(times[0], 9900)
+        rollup = store.rollup("Motion1", 60)
+        self.assertEqual(len(rollup["time"]), 24)
+        self.assertEqual(rollup["time"][-1], 9960)
+
+    def test_memory_per_device(self):
+        store = TimeSeriesStore()
+        self.assertEqual(store.nbytes("Therm1"), 0)
+
+        # A device with a few readings only takes up a few small arrays: the timestamps and the
+        # two fields of the raw readings, and the timestamps and four statistics of each field in
+        # each rollup tier
+        for t in range(5):
+            store.record("Therm1", {"temp": 20.0 + t, "threshold": 23}, timestamp=t)
+        arrays = 3 + 3 * (1 + 2 * 4)
+        self.assertEqual(store.nbytes("Therm1"), arrays * INITIAL_ROWS * 8)
+        self.assertLess(store.nbytes("Therm1"), 4096)
+
+        # A device with a long history grows up to (twice) its capacity
+        for t in range(10000):
+            store.record("Motion1", {"motion": t % 10}, timestamp=t)
+        raw = 2 * 2 * 4096 * 8
+        self.assertGreater(store.nbytes("Motion1"), raw)
+        self.assertEqual(store.nbytes(), store.nbytes("Therm1") + store.nbytes("Motion1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
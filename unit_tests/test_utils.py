@@ -0,0 +1,153 @@
+import os
+import socket
+import tempfile
+import unittest
+import sys
+sys.path.append("../")
+
+from cryptography.fernet import Fernet
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import utils
+
+
+class TestSessionHandshake(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.hub_private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend()
+        )
+        cls.hub_public_key = cls.hub_private_key.public_key()
+
+    def connect(self, msg=None):
+        msg = msg or {"action": "connect", "devid": "Light1", "devtype": "SmartLight"}
+        dev_session, handshake = utils.seal_handshake(msg, self.hub_public_key)
+        hub_session, request_data = utils.open_handshake(handshake, self.hub_private_key)
+        return dev_session, hub_session, request_data
+
+    def test_handshake_round_trip(self):
+        _, hub_session, request_data = self.connect()
+        self.assertIsNotNone(hub_session)
+        self.assertEqual(request_data["devid"], "Light1")
+
+    def test_handshake_not_limited_by_rsa_payload(self):
+        msg = {"action": "connect", "padding": "x" * 1000}
+        _, _, request_data = self.connect(msg)
+        self.assertEqual(request_data, msg)
+
+    def test_both_directions(self):
+        dev_session, hub_session, _ = self.connect()
+        reply = dev_session.decrypt(hub_session.encrypt({"result": "success"}))
+        self.assertEqual(reply, {"result": "success"})
+        request = hub_session.decrypt(dev_session.encrypt({"action": "get_readings"}))
+        self.assertEqual(request, {"action": "get_readings"})
+
+    def test_replayed_frame_rejected(self):
+        dev_session, hub_session, _ = self.connect()
+        frame = hub_session.encrypt({"action": "set_on"})
+        self.assertIsNotNone(dev_session.decrypt(frame))
+        self.assertIsNone(dev_session.decrypt(frame))
+
+    def test_own_frame_rejected(self):
+        dev_session, _, _ = self.connect()
+        self.assertIsNone(dev_session.decrypt(dev_session.encrypt({"action": "set_on"})))
+
+    def test_tampered_handshake_rejected(self):
+        _, handshake = utils.seal_handshake({"action": "connect"}, self.hub_public_key)
+        tampered = handshake[:-1] + bytes([handshake[-1] ^ 1])
+        self.assertEqual(utils.open_handshake(tampered, self.hub_private_key), (None, None))
+
+
+class TestCryptoContext(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend()
+        )
+        cls.crypto = utils.CryptoContext(private_key=cls.private_key)
+
+    def test_seal_open(self):
+        self.assertEqual(self.crypto.sealed_size, 256)
+        self.assertEqual(self.crypto.open(self.crypto.seal(b"secret")), b"secret")
+
+    def test_messages(self):
+        msgs = [{"action": "set_on"}, {"action": "get_readings", "id": 2}]
+        sealed = utils.CryptoContext(public_key=self.private_key.public_key()).seal_messages(msgs)
+        self.assertEqual(self.crypto.open_messages(sealed), msgs)
+        self.assertEqual(self.crypto.open_message(self.crypto.seal_message(msgs[0])), msgs[0])
+
+    def test_missing_key(self):
+        with self.assertRaises(ValueError):
+            utils.CryptoContext(public_key=self.private_key.public_key()).open(b"x" * 256)
+        with self.assertRaises(ValueError):
+            utils.CryptoContext().seal(b"secret")
+
+    def test_legacy_functions_accept_context(self):
+        data = utils.encrypt_message({"result": "success"}, self.crypto)
+        self.assertEqual(utils.decrypt_message(data, self.private_key), {"result": "success"})
+        self.assertIsNone(utils.decrypt_message(b"garbage", self.crypto))
+
+    def test_handshake_with_context(self):
+        session, handshake = utils.seal_handshake({"action": "connect"}, self.crypto)
+        hub_session, msg = utils.open_handshake(handshake, self.crypto)
+        self.assertEqual(msg, {"action": "connect"})
+        self.assertEqual(hub_session.key, session.key)
+
+
+class TestKeyRing(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.key_file = os.path.join(self.tmpdir.name, "dev_enc.key")
+        with open(self.key_file, "wb") as file:
+            file.write(Fernet.generate_key())
+        self.keyring = utils.KeyRing()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_key_cached(self):
+        key = self.keyring.fernet_key(self.key_file)
+        self.assertIs(self.keyring.fernet_key(self.key_file), key)
+        self.assertIs(self.keyring.fernet(key), self.keyring.fernet(key))
+
+    def test_key_reloaded_when_file_changes(self):
+        key = self.keyring.fernet_key(self.key_file)
+        new_key = Fernet.generate_key()
+        with open(self.key_file, "wb") as file:
+            file.write(new_key)
+        stat = os.stat(self.key_file)
+        os.utime(self.key_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertNotEqual(key, new_key)
+        self.assertEqual(self.keyring.fernet_key(self.key_file), new_key)
+
+    def test_missing_file(self):
+        with self.assertRaises(OSError):
+            self.keyring.fernet_key(os.path.join(self.tmpdir.name, "missing.key"))
+        self.assertIsNone(utils.load_fernet_key(os.path.join(self.tmpdir.name, "missing.key")))
+
+    def test_fernet_round_trip(self):
+        key = utils.load_fernet_key(self.key_file)
+        data_file = os.path.join(self.tmpdir.name, "data.bin")
+        self.assertTrue(utils.encrypt_and_save_fernet({"Light1": "SmartLight"}, key, data_file))
+        self.assertEqual(utils.load_and_decrypt_fernet(key, data_file), {"Light1": "SmartLight"})
+
+
+
+class TestKeepalive(unittest.TestCase):
+
+    def test_set_keepalive(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            utils.set_keepalive(sock, idle=5, interval=2, count=4)
+            self.assertTrue(sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                self.assertEqual(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE), 5)
+            if hasattr(socket, "TCP_KEEPCNT"):
+                self.assertEqual(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,15 +5,349 @@ messages
 
 import json
 import logging
+import os
+import socket
+import struct
+import threading
 
 from cryptography.fernet import Fernet
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import codec
+import framing
 
 # Set logging level to logging.ERROR to view error logs
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
 
+# Nonce prefixes for the two directions of a session. Both ends share one AES key, so each direction
+# gets its own 4-byte prefix in front of the 8-byte counter to make sure a nonce is never reused
+DEVICE_TO_HUB = b"\x00\x00\x00\x01"
+HUB_TO_DEVICE = b"\x00\x00\x00\x02"
+
+# The message counter is sent in clear in front of every session frame
+COUNTER = struct.Struct("!Q")
+
+# The HUB sends a heartbeat ('ping', answered with a 'pong' event) to every connection it hasn't
+# heard from or written to for this many seconds...
+HEARTBEAT_INTERVAL = 10.0
+
+# ...and drops connections it hasn't heard from for this many intervals. Devices likewise give up on
+# a HUB they haven't heard from for as long
+HEARTBEAT_MISSES = 3
+
+# TCP keepalive probing of idle connections: start after this many idle seconds, probe every this
+# many seconds and give up after this many unanswered probes, so that the operating system notices
+# dead peers (e.g. unplugged devices) even when nothing is being sent
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+# RSA padding used for every RSA operation. The padding object holds no state, so a single instance
+# is shared instead of building a new one per call
+OAEP_PADDING = padding.OAEP(
+    mgf=padding.MGF1(algorithm=hashes.SHA256()),
+    algorithm=hashes.SHA256(),
+    label=None,
+)
+
+
+class KeyRing:
+    """
+    The KeyRing class caches the keys loaded from files and the Fernet ciphers built from them, so
+    that loading the same key again (e.g. for each of hundreds of simulated devices) doesn't re-read
+    and re-parse the file. A cached key is reloaded when its file's modification time or size
+    changes, so keys regenerated by './initialise.py' are picked up without a restart.
+
+    Example usage:
+        keyring = KeyRing() public_key = keyring.public_key("./Secrets/hub_pub.key")
+    """
+
+    def __init__(self):
+        """Initialize a new (empty) KeyRing instance."""
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._fernets = {}
+
+    def _load(self, kind, key_file, parse):
+        """
+        Get a key from the cache, loading it from its file if it isn't cached or the file changed.
+
+        Args:
+            kind (str): The kind of key, e.g. 'public'. key_file (str): Path to the key file. parse
+            (callable): Function turning the file contents into the key.
+
+        Returns:
+            The key.
+
+        Raises:
+            OSError: If the file can't be read. ValueError: If the key can't be parsed.
+        """
+        stat = os.stat(key_file)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        cache_key = (kind, os.path.abspath(key_file))
+
+        with self._lock:
+            cached = self._keys.get(cache_key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        with open(key_file, "rb") as file:
+            key = parse(file.read())
+
+        with self._lock:
+            self._keys[cache_key] = (stamp, key)
+        return key
+
+    def public_key(self, public_key_file):
+        """
+        Get an RSA public key.
+
+        Args:
+            public_key_file (str): Path to the file containing the public key in PEM format.
+
+        Returns:
+            RSAPublicKey: The public key.
+        """
+        return self._load(
+            "public",
+            public_key_file,
+            lambda pem: serialization.load_pem_public_key(pem, backend=default_backend()),
+        )
+
+    def private_key(self, private_key_file):
+        """
+        Get an RSA private key.
+
+        Args:
+            private_key_file (str): Path to the file containing the private key in PEM format.
+
+        Returns:
+            RSAPrivateKey: The private key.
+        """
+        return self._load(
+            "private",
+            private_key_file,
+            lambda pem: serialization.load_pem_private_key(
+                pem, backend=default_backend(), password=None
+            ),
+        )
+
+    def fernet_key(self, fernet_key_file):
+        """
+        Get a Fernet key.
+
+        Args:
+            fernet_key_file (str): Path to the file containing the Fernet key.
+
+        Returns:
+            bytes: The Fernet key.
+        """
+        return self._load("fernet", fernet_key_file, bytes)
+
+    def fernet(self, fer_key):
+        """
+        Get the Fernet cipher of a key.
+
+        Args:
+            fer_key (bytes): The Fernet key.
+
+        Returns:
+            Fernet: The cipher, built once per key.
+        """
+        with self._lock:
+            cipher_suite = self._fernets.get(fer_key)
+            if cipher_suite is None:
+                cipher_suite = self._fernets[fer_key] = Fernet(fer_key)
+            return cipher_suite
+
+    def clear(self):
+        """Drop all cached keys and ciphers."""
+        with self._lock:
+            self._keys.clear()
+            self._fernets.clear()
+
+
+# The key ring shared by all the key loaders in this process
+KEYRING = KeyRing()
+
+
+class CryptoContext:
+    """
+    The CryptoContext class holds everything the RSA operations with one key pair need: the key
+    handles, the OAEP padding (with its hash algorithms) and the message codec. It is set up once,
+    e.g. when the HUB starts, and reused for every message instead of each call looking these up
+    again. seal() encrypts with the public key and open() decrypts with the private key; either key
+    may be left out if that side only seals or only opens.
+
+    Attributes:
+        public_key (RSAPublicKey): Key to seal with (worked out from the private key if not given).
+        private_key (RSAPrivateKey): Key to open with, or None. padding (OAEP): The RSA padding.
+        codec: The codec messages are encoded with (see codec.py). sealed_size (int): Size in bytes
+        of everything sealed with the public key (the size of the RSA modulus).
+
+    Example usage:
+        crypto = CryptoContext(public_key=hub_pub_key) data = crypto.seal_message({"action":
+        "connect"})
+    """
+
+    def __init__(self, public_key=None, private_key=None, msg_codec=codec.JSON, oaep=OAEP_PADDING):
+        """
+        Initialize a new CryptoContext instance.
+
+        Args:
+            public_key (RSAPublicKey): The RSA public key. private_key (RSAPrivateKey): The RSA
+            private key. msg_codec: The message codec. oaep (OAEP): The RSA padding.
+        """
+        if public_key is None and private_key is not None:
+            public_key = private_key.public_key()
+
+        self.public_key = public_key
+        self.private_key = private_key
+        self.padding = oaep
+        self.codec = msg_codec
+        self.sealed_size = public_key.key_size // 8 if public_key is not None else None
+
+    def _encryptor(self):
+        """Get the bound encrypt function of the public key."""
+        if self.public_key is None:
+            raise ValueError("No public key to seal with")
+        return self.public_key.encrypt
+
+    def _decryptor(self):
+        """Get the bound decrypt function of the private key."""
+        if self.private_key is None:
+            raise ValueError("No private key to open with")
+        return self.private_key.decrypt
+
+    def seal(self, data):
+        """
+        Encrypt bytes with the public key.
+
+        Args:
+            data (bytes): The bytes to encrypt.
+
+        Returns:
+            bytes: The encrypted bytes.
+
+        Raises:
+            ValueError: If there is no public key or the data is too large for the key.
+        """
+        return self._encryptor()(data, self.padding)
+
+    def open(self, data):
+        """
+        Decrypt bytes with the private key.
+
+        Args:
+            data (bytes): The encrypted bytes.
+
+        Returns:
+            bytes: The decrypted bytes.
+
+        Raises:
+            ValueError: If there is no private key or the data can't be decrypted.
+        """
+        return self._decryptor()(data, self.padding)
+
+    def seal_message(self, msg, msg_codec=None):
+        """
+        Encode a message and encrypt it with the public key.
+
+        Args:
+            msg (dict): The message to encrypt. msg_codec: The codec to use instead of the
+            context's own.
+
+        Returns:
+            bytes: The encrypted message.
+        """
+        return self.seal((msg_codec or self.codec).encode(msg))
+
+    def open_message(self, data, msg_codec=None):
+        """
+        Decrypt a message with the private key and decode it.
+
+        Args:
+            data (bytes): The encrypted message. msg_codec: The codec to use instead of the
+            context's own.
+
+        Returns:
+            dict: The decrypted message.
+        """
+        return (msg_codec or self.codec).decode(self.open(data))
+
+    def seal_many(self, payloads):
+        """
+        Encrypt several payloads with the public key.
+
+        Args:
+            payloads (iterable): The bytes to encrypt.
+
+        Returns:
+            list: The encrypted bytes, in the same order.
+        """
+        encrypt, oaep = self._encryptor(), self.padding
+        return [encrypt(data, oaep) for data in payloads]
+
+    def open_many(self, payloads):
+        """
+        Decrypt several payloads with the private key.
+
+        Args:
+            payloads (iterable): The encrypted bytes.
+
+        Returns:
+            list: The decrypted bytes, in the same order.
+        """
+        decrypt, oaep = self._decryptor(), self.padding
+        return [decrypt(data, oaep) for data in payloads]
+
+    def seal_messages(self, msgs):
+        """
+        Encode several messages and encrypt them with the public key.
+
+        Args:
+            msgs (iterable): The messages to encrypt.
+
+        Returns:
+            list: The encrypted messages, in the same order.
+        """
+        encode = self.codec.encode
+        return self.seal_many(encode(msg) for msg in msgs)
+
+    def open_messages(self, payloads):
+        """
+        Decrypt several messages with the private key and decode them.
+
+        Args:
+            payloads (iterable): The encrypted messages.
+
+        Returns:
+            list: The decrypted messages, in the same order.
+        """
+        decode = self.codec.decode
+        return [decode(data) for data in self.open_many(payloads)]
+
+
+def as_crypto_context(public_key=None, private_key=None):
+    """
+    Get the CryptoContext of RSA keys. Functions taking keys use this so that they can be given a
+    CryptoContext set up in advance instead, which is passed through unchanged.
+
+    Args:
+        public_key (RSAPublicKey or CryptoContext): The RSA public key. private_key (RSAPrivateKey
+        or CryptoContext): The RSA private key.
+
+    Returns:
+        CryptoContext: The crypto context.
+    """
+    for key in (public_key, private_key):
+        if isinstance(key, CryptoContext):
+            return key
+    return CryptoContext(public_key, private_key)
+
 
 def load_fernet_key(fernet_key_file):
     """
@@ -25,10 +359,8 @@ def load_fernet_key(fernet_key_file):
     Returns:
         bytes: The Fernet key as bytes, or None if the file is not found.
     """
-    try:  # try retrieving the Fernet encryption key from bin file
-        with open(fernet_key_file, "rb") as encfile:
-            enc_key = encfile.read()
-        return enc_key
+    try:  # try retrieving the Fernet encryption key from bin file (or the key ring)
+        return KEYRING.fernet_key(fernet_key_file)
     except OSError as e:
         logging.error(
             "Error loading fernet key: %s",
@@ -53,8 +385,8 @@ def load_and_decrypt_fernet(fer_key, filename):
         with open(filename, "rb") as file:
             encrypted_data = file.read()
 
-        # Initialize a Fernet cipher with the key
-        cipher_suite = Fernet(fer_key)
+        # Get the Fernet cipher of the key
+        cipher_suite = KEYRING.fernet(fer_key)
 
         # Decrypt and deserialize the data
         decrypted_data = cipher_suite.decrypt(encrypted_data)
@@ -81,7 +413,7 @@ def encrypt_and_save_fernet(data, enc_key, filename):
         bool: True if encryption and saving are successful, False otherwise.
     """
     try:
-        cipher_suite = Fernet(enc_key)
+        cipher_suite = KEYRING.fernet(enc_key)
 
         encrypted_data = cipher_suite.encrypt(json.dumps(data).encode("utf-8"))
 
@@ -112,13 +444,7 @@ def load_public_key(public_key_file):
         error occurs.
     """
     try:
-        with open(public_key_file, "rb") as pub_key_file:
-            public_key_pem = pub_key_file.read()
-            public_key = serialization.load_pem_public_key(
-                public_key_pem, backend=default_backend()
-            )
-
-        return public_key
+        return KEYRING.public_key(public_key_file)
 
     except FileNotFoundError as e:
         logging.error(
@@ -144,21 +470,13 @@ def load_keys(public_key_file=None, private_key_file=None):
     try:
         public_key = None
         if public_key_file:
-            # Load the public key from the specified file
-            with open(public_key_file, "rb") as pub_key_file:
-                public_key_pem = pub_key_file.read()
-                public_key = serialization.load_pem_public_key(
-                    public_key_pem, backend=default_backend()
-                )
+            # Load the public key from the specified file (or the key ring)
+            public_key = KEYRING.public_key(public_key_file)
 
         private_key = None
         if private_key_file:
-            # Load the private key from the specified file
-            with open(private_key_file, "rb") as pri_key_file:
-                private_key_pem = pri_key_file.read()
-                private_key = serialization.load_pem_private_key(
-                    private_key_pem, backend=default_backend(), password=None
-                )
+            # Load the private key from the specified file (or the key ring)
+            private_key = KEYRING.private_key(private_key_file)
 
         return public_key, private_key
     except FileNotFoundError as e:
@@ -170,29 +488,21 @@ def load_keys(public_key_file=None, private_key_file=None):
         return None, None
 
 
-def decrypt_message(enc_msg, private_key):
+def decrypt_message(enc_msg, private_key, msg_codec=codec.JSON):
     """
     Decrypt an encrypted message using a private key.
 
     Args:
-        enc_msg (bytes): The encrypted message to decrypt. private_key (RSAPrivateKey): The private
-        key for decryption.
+        enc_msg (bytes): The encrypted message to decrypt. private_key (RSAPrivateKey or
+        CryptoContext): The private key for decryption. msg_codec: The codec the message was encoded
+        with (see codec.py).
 
     Returns:
         dict: The decrypted message as a dictionary, or None if decryption fails.
     """
     try:
         # Decrypt the message using the private key
-        decrypted_message = private_key.decrypt(
-            enc_msg,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None,
-            ),
-        )
-
-        return json.loads(decrypted_message.decode("utf-8"))
+        return as_crypto_context(private_key=private_key).open_message(enc_msg, msg_codec)
 
     except (ValueError, Exception) as e:
         logging.error(
@@ -204,32 +514,21 @@ def decrypt_message(enc_msg, private_key):
 
 
 # Function to create and encrypt a message
-def encrypt_message(msg, pub_key):
+def encrypt_message(msg, pub_key, msg_codec=codec.JSON):
     """
     Encrypt a message using an RSA public key.
 
     Args:
-        msg (dict): The message to encrypt as a dictionary. pub_key (RSAPublicKey): The RSA public
-        key for encryption.
+        msg (dict): The message to encrypt as a dictionary. pub_key (RSAPublicKey or CryptoContext):
+        The RSA public key for encryption. msg_codec: The codec to encode the message with (see
+        codec.py); the binary codec fits larger messages within the RSA payload limit.
 
     Returns:
         bytes: The encrypted message, or None if encryption fails.
     """
     try:
-        # Create the message as a JSON object
-        message = json.dumps(msg).encode("utf-8")
-
-        # Encrypt the message using the RSA public key
-        encrypted_message = pub_key.encrypt(
-            message,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None,
-            ),
-        )
-
-        return encrypted_message
+        # Encode the message (as a JSON object by default) and encrypt it using the RSA public key
+        return as_crypto_context(public_key=pub_key).seal_message(msg, msg_codec)
 
     except Exception as e:
         logging.error(
@@ -245,9 +544,9 @@ def encrypt_and_save(data, pub_key, output_filename):
     Encrypt data using a public key and save it to a file.
 
     Args:
-        data (dict): The data to encrypt and save as a dictionary. pub_key (RSAPublicKey): The RSA
-        public key for encryption. output_filename (str): Path to the file where the encrypted data
-        will be saved.
+        data (dict): The data to encrypt and save as a dictionary. pub_key (RSAPublicKey or
+        CryptoContext): The RSA public key for encryption. output_filename (str): Path to the file
+        where the encrypted data will be saved.
 
     Returns:
         bool: True if encryption and saving are successful, False otherwise.
@@ -279,7 +578,7 @@ def load_and_decrypt(input_filename, private_key):
 
     Args:
         input_filename (str): Path to the file containing the encrypted data. private_key
-        (RSAPrivateKey): The RSA private key for decryption.
+        (RSAPrivateKey or CryptoContext): The RSA private key for decryption.
 
     Returns:
         str: The decrypted data as a string, or None if decryption fails.
@@ -290,14 +589,7 @@ def load_and_decrypt(input_filename, private_key):
             encrypted_data = input_file.read()
 
         # Decrypt the data using the private key
-        decrypted_data = private_key.decrypt(
-            encrypted_data,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None,
-            ),
-        )
+        decrypted_data = as_crypto_context(private_key=private_key).open(encrypted_data)
 
         return decrypted_data.decode("utf-8")
 
@@ -310,33 +602,276 @@ def load_and_decrypt(input_filename, private_key):
         return None
 
 
+class SessionCipher:
+    """
+    The SessionCipher class holds the per-connection AES-GCM key agreed in the 'connect' exchange and
+    encrypts/decrypts every later message of that connection with it. Each frame is the 8-byte
+    message counter followed by the AES-GCM ciphertext; the counter (together with the direction
+    prefix) forms the nonce, and the receiving side only accepts counters larger than the last one
+    it has seen so that frames can't be replayed.
+
+    Attributes:
+        lock (threading.RLock): Lock that callers hold while encrypting and sending a frame, so that
+        frames leave the socket in counter order when several threads share a connection. It is
+        re-entrant so that a caller can build a message and send it under the same lock. codec:
+        The codec messages are encoded with (see codec.py). Sessions start out with JSON and switch
+        to the codec negotiated in the 'connect' exchange once it is agreed.
+    """
+
+    def __init__(self, key, send_prefix, recv_prefix):
+        """
+        Initialize a new SessionCipher.
+
+        Args:
+            key (bytes): The 256-bit AES session key. send_prefix (bytes): Nonce prefix of outgoing
+            frames. recv_prefix (bytes): Nonce prefix of incoming frames.
+        """
+        self.key = key
+        self.lock = threading.RLock()
+        self.codec = codec.JSON
+        self._aead = AESGCM(key)
+        self._send_prefix = send_prefix
+        self._recv_prefix = recv_prefix
+        self._send_counter = 0
+        self._recv_counter = -1
+
+    def encrypt(self, msg):
+        """
+        Encrypt a message for the other end of the session.
+
+        Args:
+            msg (dict): The message to encrypt as a dictionary.
+
+        Returns:
+            bytes: The counter followed by the encrypted message.
+        """
+        counter = COUNTER.pack(self._send_counter)
+        self._send_counter += 1
+
+        ciphertext = self._aead.encrypt(
+            self._send_prefix + counter, self.codec.encode(msg), None
+        )
+        return counter + ciphertext
+
+    def decrypt(self, data):
+        """
+        Decrypt a message received from the other end of the session.
+
+        Args:
+            data (bytes): The counter followed by the encrypted message.
+
+        Returns:
+            dict: The decrypted message as a dictionary, or None if decryption fails or the frame is
+            a replay.
+        """
+        try:
+            counter = data[: COUNTER.size]
+            (value,) = COUNTER.unpack(counter)
+
+            # Frames must arrive with strictly increasing counters, anything else is a replay
+            if value <= self._recv_counter:
+                raise ValueError(f"Replayed or out of order frame counter {value}")
+
+            plaintext = self._aead.decrypt(
+                self._recv_prefix + counter, data[COUNTER.size :], None
+            )
+            self._recv_counter = value
+
+            return self.codec.decode(plaintext)
+
+        except Exception as e:
+            logging.error(
+                "Error decrypting session message: %s",
+                e,
+                exc_info=True,
+            )
+            return None
+
+
+def seal_handshake(msg, pub_key):
+    """
+    Create a new session key and build the 'connect' message carrying it. The session key is wrapped
+    with the HUB's RSA public key (the only RSA operation of the connection) and the message itself
+    is encrypted with the new session key, so its size is not limited by RSA.
+
+    Args:
+        msg (dict): The connection message as a dictionary. pub_key (RSAPublicKey or CryptoContext):
+        The HUB's RSA public key.
+
+    Returns:
+        tuple: The device side SessionCipher and the handshake bytes to send, or (None, None) if
+        encryption fails.
+    """
+    try:
+        key = AESGCM.generate_key(bit_length=256)
+
+        # Wrap the session key using the RSA public key
+        wrapped_key = as_crypto_context(public_key=pub_key).seal(key)
+
+        session = SessionCipher(key, DEVICE_TO_HUB, HUB_TO_DEVICE)
+        return session, wrapped_key + session.encrypt(msg)
+
+    except Exception as e:
+        logging.error(
+            "Error creating handshake message: %s",
+            e,
+            exc_info=True,
+        )
+        return None, None
+
+
+def open_handshake(data, private_key):
+    """
+    Unwrap the session key of a 'connect' message using the HUB's RSA private key and decrypt the
+    message with it.
+
+    Args:
+        data (bytes): The handshake bytes received from the device. private_key (RSAPrivateKey or
+        CryptoContext): The HUB's RSA private key.
+
+    Returns:
+        tuple: The HUB side SessionCipher and the decrypted message as a dictionary, or (None, None)
+        if decryption fails.
+    """
+    try:
+        crypto = as_crypto_context(private_key=private_key)
+
+        # The wrapped key is exactly as long as the RSA modulus
+        key_len = crypto.sealed_size
+
+        key = crypto.open(data[:key_len])
+
+        session = SessionCipher(key, HUB_TO_DEVICE, DEVICE_TO_HUB)
+        msg = session.decrypt(data[key_len:])
+        if msg is None:
+            return None, None
+
+        return session, msg
+
+    except Exception as e:
+        logging.error(
+            "Error opening handshake message: %s",
+            e,
+            exc_info=True,
+        )
+        return None, None
+
+
+def reply_to(request_data, msg):
+    """
+    Tag a response with the message id of the request it answers, so that the HUB can match it to
+    the request even when several requests are outstanding on the same connection.
+
+    Args:
+        request_data (dict): The request being answered. msg (dict): The response.
+
+    Returns:
+        dict: The response, carrying the request's message id if it had one.
+    """
+    if "id" in request_data:
+        msg["id"] = request_data["id"]
+    return msg
+
+
+def set_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    """
+    Turn on TCP keepalive on a socket, with the given timings where the platform allows setting
+    them (the option names differ between platforms, and some don't have them at all).
+
+    Args:
+        sock (socket): The connected socket. idle (int): Number of idle seconds before probing.
+        interval (int): Number of seconds between probes. count (int): Number of unanswered probes
+        before the connection is dropped.
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # macOS calls the idle time TCP_KEEPALIVE
+        idle_option = getattr(socket, "TCP_KEEPIDLE", getattr(socket, "TCP_KEEPALIVE", None))
+        for option, value in (
+            (idle_option, idle),
+            (getattr(socket, "TCP_KEEPINTVL", None), interval),
+            (getattr(socket, "TCP_KEEPCNT", None), count),
+        ):
+            if option is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+    except OSError as e:
+        logging.error(
+            "Unable to set TCP keepalive: %s",
+            e,
+            exc_info=True,
+        )
+
+
 # Function to create, encrypt, and send a message
-def send_encrypted_message(client_sock, msg, pub_key):
+def send_encrypted_message(client_sock, msg, session):
     """
-    Create, encrypt, and send a message through a socket using an RSA public key.
+    Create, encrypt, and send a message through a socket using the connection's session cipher.
 
     Args:
         client_sock (socket): The socket for sending the encrypted message. msg (dict): The message
-        to send as a dictionary. pub_key (RSAPublicKey): The RSA public key for encryption.
+        to send as a dictionary. session (SessionCipher): The session cipher of the connection.
 
     Returns:
         bool: True if sending is successful, False otherwise.
     """
     try:
-        # Create the message as a JSON object message = json.dumps(msg).encode('utf-8')
+        # Encrypt and send while holding the session lock so frames go out in counter order
+        with session.lock:
+            encrypted_message = session.encrypt(msg)
+            framing.send_frame(client_sock, encrypted_message)
+
+        return True
 
-        # Encrypt the message using the RSA public key
-        encrypted_message = encrypt_message(msg, pub_key)
+    except Exception as e:
+        logging.error(
+            "Error sending encrypted message: %s",
+            e,
+            exc_info=True,
+        )
+        return False
 
-        # Send the encrypted message
-        client_sock.send(encrypted_message)
+
+def send_encrypted_messages(client_sock, msgs, session):
+    """
+    Encrypt several messages and send them through a socket in a single send call.
+
+    Args:
+        client_sock (socket): The socket for sending the encrypted messages. msgs (list): The
+        messages to send as dictionaries. session (SessionCipher): The session cipher of the
+        connection.
+
+    Returns:
+        bool: True if sending is successful, False otherwise.
+    """
+    try:
+        with session.lock:
+            framing.send_frames(client_sock, [session.encrypt(msg) for msg in msgs])
 
         return True
 
     except Exception as e:
         logging.error(
-            "Error loading public key: %s",
+            "Error sending encrypted messages: %s",
             e,
             exc_info=True,
         )
         return False
+
+
+def recv_encrypted_message(reader, session):
+    """
+    Receive the next frame from a connection and decrypt it using the connection's session cipher.
+
+    Args:
+        reader (FrameReader): The frame reader of the connection. session (SessionCipher): The
+        session cipher of the connection.
+
+    Returns:
+        tuple: A tuple containing a bool which is False if the connection was closed, and the
+        decrypted message as a dictionary (or None if it couldn't be decrypted).
+    """
+    frame = reader.recv_frame()
+    if frame is None:
+        return False, None
+
+    return True, session.decrypt(frame)